@@ -1,6 +1,20 @@
 import paho.mqtt.client as PahoMQTT
 import json
 
+# Presence of the services. Every service keeps a retained status on baseTopic/presence/<service>, followed by the catalog
+# to know which services are alive without pings (see ServiceRegistry in catalog3.py):
+# - presenceWill, before connecting: the broker publishes {"status": "offline"} as soon as the connection is lost
+# - presenceOnline, at every connection: a Last Will may have replaced the status while the service was disconnected
+# - presenceOffline, before disconnecting on purpose: the Last Will is sent only when the connection is lost
+def presenceWill(client, topic):
+    client.will_set(topic, json.dumps({"status": "offline"}), 1, True)
+
+def presenceOnline(client, topic):
+    client.publish(topic, json.dumps({"status": "online"}), 1, True)
+
+def presenceOffline(client, topic):
+    client.publish(topic, json.dumps({"status": "offline"}), 1, True)
+
 class MyMQTT:
     def __init__(self, clientID, broker, port, notifier):
         self.broker = broker
@@ -9,23 +23,31 @@ class MyMQTT:
         self.clientID = clientID
         self._topic = ""
         self._isSubscriber = False
+        self.connected = False # True while the connection to the broker is up
         # create an instance of paho.mqtt.client
         self._paho_mqtt = PahoMQTT.Client(clientID,True)  
         # register the callback
         self._paho_mqtt.on_connect = self.myOnConnect
         self._paho_mqtt.on_message = self.myOnMessageReceived
+        self._paho_mqtt.on_disconnect = self.myOnDisconnect
  
  
     def myOnConnect (self, paho_mqtt, userdata, flags, rc):
-        pass
+        self.connected = (rc == 0)
+        if (self._isSubscriber):
+            # the subscription is lost with the connection (clean session): subscribe again after a reconnection
+            self._paho_mqtt.subscribe(self._topic, 2)
+
+    def myOnDisconnect (self, paho_mqtt, userdata, rc):
+        self.connected = False
 
     def myOnMessageReceived (self, paho_mqtt , userdata, msg):
         # A new message is received
         self.notifier.notify (msg.topic, msg.payload)
  
-    def myPublish (self, topic, msg):
+    def myPublish (self, topic, msg, qos=2):
         # publish a message with a certain topic
-        self._paho_mqtt.publish(topic, json.dumps(msg), 2)
+        self._paho_mqtt.publish(topic, json.dumps(msg), qos)
 
  
     def mySubscribe (self, topic):
@@ -41,6 +63,12 @@ class MyMQTT:
         #manage connection to broker
         self._paho_mqtt.connect(self.broker , self.port)
         self._paho_mqtt.loop_start()
+
+    def startAsync(self):
+        # connect in background, retrying until the broker is reachable: it does not fail if the broker is not running yet
+        self._paho_mqtt.connect_async(self.broker , self.port)
+        self._paho_mqtt.loop_start()
+
     def unsubscribe(self):
         if (self._isSubscriber):
             # remember to unsuscribe if it is working also as subscriber 
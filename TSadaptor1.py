@@ -4,8 +4,10 @@ import json
 import threading
 import requests 
 import paho.mqtt.client as PahoMQTT 
+from MyMQTT import presenceWill, presenceOnline, presenceOffline
 
 confFile = "conf.json"
+batchSize = 300 # Devices asked to the catalog with a single "devices" request: the keys are in the query string, whose length is limited by the front ends of the catalog
 
 '''
 Reads from the catalog all the pairs patient-device. For each pair, it generates 
@@ -21,6 +23,12 @@ on thingspeak sending a POST.
 # create list of thingspeak channel ID for each pair user-device
 listID={}
 lock = threading.Lock()
+
+def getDevices(catalogURI, keys): # Number of slots and channel of the devices "patientID/deviceID", with a request every batchSize devices
+    devices = {}
+    for i in range(0, len(keys), batchSize):
+        devices.update(requests.get(catalogURI + "devices", params={"keys": ",".join(keys[i:i + batchSize]), "fields": "numSlots,thingSpeakChannel"}).json()["devices"])
+    return devices
  
 class TSupload:
     def __init__(self,apiKeyWrite,Data_list):
@@ -46,12 +54,14 @@ class MQTTinterface:
         self.baseTopic = baseTopic
         self.timeShiftTopic=baseTopic+"/+/+/timeShift"
         self.tempHumTopic=baseTopic+"/+/+/temperatureHumidity"
+        self.presenceTopic=baseTopic+"/presence/thingSpeakAdapter" # Retained status of the service, followed by the catalog
         self._paho_mqtt = PahoMQTT.Client(clientID, True)
+        presenceWill(self._paho_mqtt, self.presenceTopic)
         self._paho_mqtt.on_connect = self.myOnConnect
         self._paho_mqtt.on_message = self.myOnMessageReceived 
        
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
-        pass
+        presenceOnline(self._paho_mqtt, self.presenceTopic)
         #print("[",time.ctime(),"] - Time shift connected to", self.broker, "with result code", rc)
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
@@ -81,6 +91,7 @@ class MQTTinterface:
         
         
     def stop(self):
+        presenceOffline(self._paho_mqtt, self.presenceTopic)
         self.unsubscribe()
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -126,8 +137,8 @@ class MQTTinterface:
             if payload["e"]["message"] == 5: # daily stat
                 # request the number of channels for each device
                 print("STATS RECEIVED")
-                num = requests.get(catalogURI+"getSlotsNumber/"+patientID+'/'+deviceID).json()
-                num_slots = num["slots"]
+                num = requests.get(catalogURI+"device/"+patientID+'/'+deviceID, params={"fields": "numSlots"}).json()
+                num_slots = num["numSlots"]
                 stat = payload["e"]["slot"]
                 stat_list = []
                 list_slots = []
@@ -170,8 +181,9 @@ if __name__ == '__main__':
     port = conf["port"]
     baseTopic = conf["baseTopic"]
     apiKeyWrite = conf["apiKeyWrite"]
+    presence = conf.get("presence", "http") # "mqtt": the catalog knows we are alive from the presence topic, so no ping is needed and the modifications can be waited for longer
     listID={}
-    last_update_cat = '00:00:00'
+    last_update_cat = None # Version of the catalog we have read. The catalog increases it at every modification
     channels = {
             "api_key": apiKeyWrite,
             "description": "Statistics of App-Pills Application",
@@ -184,26 +196,26 @@ if __name__ == '__main__':
         }
     print("start")
     
-    cat_last_update = requests.get("http://127.0.0.1:8080"+'/getLU').json()["LU"]
-    cat_last_update = cat_last_update.split(" ")[3]
+    cat_last_update = requests.get(catalogURI+"changes").json()["version"] # Read before the catalog, so that no modification is lost
     if cat_last_update!=last_update_cat:
         last_update_cat = cat_last_update
         lock.acquire()
         catalog = requests.get(catalogURI + "getCatalog").json()
+        keys = [str(patient["userID"])+"/"+str(device["deviceID"]) for patient in catalog["patientList"] for device in patient["devices"]]
+        devices = getDevices(catalogURI, keys) # Number of slots and channel of every device, with a few requests
         for patient in catalog["patientList"]:
                 userID = patient["userID"]
                 for device in patient["devices"]:
                     deviceID = device["deviceID"]
                     k=str(userID)+"/"+str(deviceID)
-                    num = requests.get(catalogURI+"getSlotsNumber/"+k).json()
-                    num_slots = num["slots"]
+                    num_slots = devices[k]["numSlots"]
                     channels1 = channels
                     for i in range(num_slots): 
                         if i<=5: 
                             channels1["field"+str(i+3)] = "slot"+str(i+1)
                         else:
                             print("No more than 8 field available on thingspeak")
-                    ch = requests.get(catalogURI + "thingSpeakChannel/"+k).json()["channel"]
+                    ch = devices[k]["thingSpeakChannel"]
                     print(ch)
                     if ch!="None": 
                         listID[k]=ch
@@ -236,29 +248,33 @@ if __name__ == '__main__':
     while True: 
 
         # Ping every 5 seconds to say I'm alive 
-        requests.put(catalogURI+"ping", data=json.dumps({"service": "thingSpeakAdapter"}))
-        # check the last update of the catalog and update the list if catalog has been changed
-        cat_last_update = requests.get("http://127.0.0.1:8080"+'/getLU').json()["LU"]
-        cat_last_update = cat_last_update.split(" ")[3]
-        if cat_last_update!=last_update_cat:
-            last_update_cat = cat_last_update
+        if presence != "mqtt":
+            requests.put(catalogURI+"ping", data=json.dumps({"service": "thingSpeakAdapter"}))
+        # wait up to 5 seconds (55 without pings) for a modification of the devices, and update the list only for the devices that changed
+        feed = requests.get(catalogURI+"changes", params={"since": last_update_cat, "timeout": 55 if presence == "mqtt" else 5, "tables": "devices"}).json()
+        if "reset" in feed: # Too many modifications were missed: read again all the devices
+            catalog = requests.get(catalogURI + "getCatalog").json()
+            keys = [str(patient["userID"])+"/"+str(device["deviceID"]) for patient in catalog["patientList"] for device in patient["devices"]]
+            devices = getDevices(catalogURI, keys)
+        else:
+            devices = feed["changes"].get("devices", {})
+        last_update_cat = feed["version"]
+        if len(devices) > 0:
             print("update Tthingspeak")
             lock.acquire()
-            catalog = requests.get(catalogURI + "getCatalog").json()
-            for patient in catalog["patientList"]:
-                userID = patient["userID"]
-                for device in patient["devices"]:
-                    deviceID = device["deviceID"]
-                    k=str(userID)+"/"+str(deviceID)
-                    num = requests.get(catalogURI+"getSlotsNumber/"+k).json()
-                    num_slots = num["slots"]
+            for k, device in devices.items():
+                    userID, deviceID = k.split("/")
+                    if device == None: # The device was removed
+                        listID.pop(k, None)
+                        continue
+                    num_slots = device["numSlots"]
                     channels1 = channels
                     for i in range(num_slots): 
                         if i<=5: 
                             channels1["field"+str(i+3)] = "slot"+str(i+1)
                         else:
                             print("No more than 8 field available on thingspeak")
-                    ch = requests.get(catalogURI + "thingSpeakChannel/"+k).json()["channel"]
+                    ch = device["thingSpeakChannel"]
                     print(ch)
                     if ch!="None": 
                         listID[k]=ch
@@ -280,7 +296,6 @@ if __name__ == '__main__':
                             pass
                        
             lock.release()
-        time.sleep(5) # or more, no many updates
     
                 
                 
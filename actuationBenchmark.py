@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import sys
+import json
+import time
+import requests
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+'''
+Benchmark of the requests that TimeShift sends to the devices when many alarms ring at the same time (ex. 500 patients
+with the same dose at 08:00). A local HTTP server simulates the smart cases, answering every request after "delay"
+seconds. For every alarm the "alarm" and the "led" of the device are switched on, and it measures how long it takes
+from the alarm to the answer of the devices (the last one, and the percentiles):
+- "sequential": one request after the other, with a new connection every time (as the scheduling thread used to do)
+- "pool": queued in the DeviceActuator, sent by its pool of threads over connections kept alive
+Usage: python actuationBenchmark.py [number of alarms] [delay of the devices in seconds]   (default: 500 0.02)
+'''
+
+alarms = 500
+delay = 0.02
+
+class DeviceHandler(BaseHTTPRequestHandler): # Smart case: every PUT is answered after delay seconds
+
+    protocol_version = "HTTP/1.1" # Connections kept alive, as CherryPy on the devices
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(delay)
+        body = json.dumps({"ok": 1}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def percentiles(latencies):
+
+    latencies = sorted(latencies)
+    return [latencies[min(len(latencies) - 1, int(q * len(latencies)))] for q in [0.5, 0.95]] + [latencies[-1]]
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        alarms = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        delay = float(sys.argv[2])
+    ThreadingHTTPServer.request_queue_size = 128 # The workers connect all at once
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DeviceHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    devices = ["http://127.0.0.1:" + str(server.server_address[1]) + "/" + str(i) for i in range(alarms)]
+    alarm_msg = json.dumps({"bn": "appPills-TimeShift", "on": 1})
+    led_msg = json.dumps({"bn": "appPills-TimeShift", "slotID": 0, "on": 1})
+    print("%12s %8s %14s %10s %10s %10s" % ("mode", "alarms", "all done (s)", "p50 (ms)", "p95 (ms)", "max (ms)"))
+
+    due = time.time()
+    latencies = []
+    for deviceURI in devices:
+        requests.put(url=deviceURI + "/alarm", data=alarm_msg)
+        requests.put(url=deviceURI + "/led", data=led_msg)
+        latencies.append(time.time() - due)
+    print("%12s %8d %14.2f %10.0f %10.0f %10.0f" % tuple(["sequential", alarms, time.time() - due] + [latency * 1000 for latency in percentiles(latencies)]))
+
+    from deviceActuator import DeviceActuator
+    actuator = DeviceActuator()
+    actuator.start()
+    due = time.time()
+    for i, deviceURI in enumerate(devices):
+        actuator.put("1/" + str(i), deviceURI, "/alarm", alarm_msg, due)
+        actuator.put("1/" + str(i), deviceURI, "/led", led_msg, due)
+    while actuator.stats()["sent"] + actuator.stats()["failed"] < 2 * alarms:
+        time.sleep(0.01)
+    stats = actuator.stats()
+    print("%12s %8d %14.2f %10.0f %10.0f %10.0f" % ("pool", alarms, stats["max"], stats["p50"] * 1000, stats["p95"] * 1000, stats["max"] * 1000))
@@ -4,6 +4,7 @@ from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 import json
 import time
 import paho.mqtt.client as PahoMQTT
+from MyMQTT import presenceWill, presenceOnline, presenceOffline
 import requests
 import os
 import imgkit
@@ -41,8 +42,10 @@ class TelegramBot:
         self.broker=broker
         self.port=port
         self.catalogURI=catalogURI
+        self.presenceTopic=baseTopic+"/presence/assistantTelegramBot" # Retained status of the service, followed by the catalog
         self.timeShiftTopic=baseTopic+"/+/+/timeShift"
         self._paho_mqtt=PahoMQTT.Client(self.clientID, True)
+        presenceWill(self._paho_mqtt, self.presenceTopic)
         self._paho_mqtt.on_connect=self.myOnConnect
         self._paho_mqtt.on_message=self.myOnMessageReceived
         MessageLoop(self.bot, {"chat" : self.on_chat_message, 'callback_query':self.on_callback_query}).run_as_thread()
@@ -56,6 +59,7 @@ class TelegramBot:
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
 
         print("\n[",time.ctime(),"] - Assistant Telegram Bot connected to", self.broker, "with result code", rc)
+        presenceOnline(self._paho_mqtt, self.presenceTopic)
     
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
 
@@ -79,6 +83,7 @@ class TelegramBot:
 
     def stop(self):
 
+        presenceOffline(self._paho_mqtt, self.presenceTopic)
         self.unsubscribe(self.timeShiftTopic)
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -90,7 +95,8 @@ class TelegramBot:
         patientID=str(topic.split("/")[1])
         deviceID=str(topic.split("/")[2])
         sender=str(topic.split("/")[3])
-        chatIDs = requests.get(self.catalogURI+ "getAssistantChatID/" + patientID).json()["chatID"] # Request the chatIDs of the assistants that are following the patient with the notification 
+        device = requests.get(self.catalogURI+ "device/" + patientID + "/" + deviceID, params={"fields": "assistantChatIDs,slotsName"}).json()
+        chatIDs = device.get("assistantChatIDs", []) # The chatIDs of the assistants that are following the patient with the notification 
         
         if chatIDs != []: # Notify only if there are assistants connected to the patient account
 
@@ -98,7 +104,7 @@ class TelegramBot:
             if sender == "timeShift":
 
                 slot = int(payload["e"]["slot"]) 
-                slotNames = requests.get(self.catalogURI+"getSlotsName/"+str(patientID)+"/"+str(deviceID)).json()["slots"]
+                slotNames = device["slotsName"]
 
                 pillName = slotNames[slot]
                 
@@ -343,8 +349,9 @@ if __name__=="__main__":
     bot=TelegramBot(token, "SmartCase-assistantTelegramBot", conf["broker"], conf["port"], conf["baseTopic"], catalogURI, "assistantChatStates.json")
     bot.start()
     lastPing = 0
+    presence = conf.get("presence", "http") # "mqtt": the catalog knows we are alive from the presence topic, so no ping is needed
     while True:
         time.sleep(0.1) # Need high reactivity for messages
-        if time.time() - lastPing > 5: # But lower frequency for pings (5 seconds)
+        if presence != "mqtt" and time.time() - lastPing > 5: # But lower frequency for pings (5 seconds)
             requests.put(catalogURI+"ping", data=json.dumps({"service": "assistantTelegramBot"}))
             lastPing = time.time()
@@ -1,905 +1,1670 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import cherrypy
 import json
 import time
-import requests
 import threading 
+import collections
+import functools
+import heapq
+import bisect
+import signal
+import asyncio
+import subprocess
+import concurrent.futures
+from catalogStore import JournalStore, SQLiteStore, SQLiteReplica
+from MyMQTT import MyMQTT
+from deviceOutbox import DeviceOutbox
 
 filename= "mycat.json"
-threadLock = threading.Lock() # Needed to coordinate the REST interface and the service "cleaner" that checkes which service is alive 
+confFile = "conf.json"
+outboxFilename = "outbox.json" # Requests to the devices not yet delivered (see deviceOutbox.py)
+dbFilename = "mycat.db" # Database used when the "catalogStore" key of the conf.json file is "sqlite". Can be overwritten with the "catalogDB" key
+changeLogSize = 1000 # Number of modifications kept in memory for the "changes" request. A service that is further behind must read again the whole catalog
+serviceTimeout = 60 # Seconds after the last ping after which a service is considered not reachable
+presenceMode = "http" # Default way in which the services say they are alive: "http" (ping every 5 seconds) or "mqtt" (retained status and Last Will on baseTopic/presence/<service>). Can be overwritten with the "presence" key of the catalog
+actuationMode = "http" # Default way in which the alarm and the leds of the devices are switched on and off: "http" (PUT on the REST interface of the device) or "mqtt" (message on baseTopic/<userID>/<deviceID>/cmd/alarm and .../cmd/led). Can be overwritten with the "actuation" key of the catalog
+maxLongPoll = 60 # Maximum number of seconds a "changes" request waits for a modification
+publishedTables = ["devices", "newDevices", "patients", "assistants"] # Tables whose modifications are published on MQTT
+pingSections = {"openingControl": ["times"], "conservationControl": ["patients"], "pillDifference": ["pillCount"]} # Sections of the catalog sent back to the services when they ping
+confKeys = ["baseTopic", "broker", "port", "token", "apiKeyWrite", "assistant-token", "presence", "actuation"] # Keys of the catalog returned by the "conf" request
+latencyBuckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60] # Upper bounds in seconds of the buckets of the latency histograms. The last ones are for the "changes" requests, that can wait for a minute
+serverType = "cherrypy" # Default HTTP front end of the catalog: "cherrypy" (one thread for every request) or "asyncio" (aiohttp, see AsyncCatalogServer). Can be overwritten with the "catalogServer" key of the conf.json file
+asyncThreads = 16 # Default number of threads that answer the requests received by the asyncio front end. Can be overwritten with the "asyncThreads" key of the conf.json file
+catalogPort = 8080 # Port of the REST interface
+workerCount = 0 # Default number of worker processes that answer the requests on catalogPort, besides the main process (0: the main process answers them). Can be overwritten with the "catalogWorkers" key of the conf.json file
+primaryPort = 8081 # Port, on localhost only, on which the main process answers the requests forwarded by the worker processes. Can be overwritten with the "primaryPort" key of the conf.json file
+primaryRoutes = ["getCatalog", "aliveServices"] # GET requests forwarded by the workers to the main process, since only the main process knows which services are alive
+replicaPoll = 0.05 # Seconds between two checks of the database by the worker processes, to wake up the "changes" requests
+cacheSize = 1000 # Maximum number of answers kept in the response cache
+deviceFields = ["chatID", "assistantChatIDs", "deviceURI", "slotsName", "numSlots", "tempUpperThresh", "tempLowerThresh", "humUpperThresh", "humLowerThresh", "schedule", "thingSpeakChannel"] # Fields returned by the "device" and "devices" requests
+storeType = "json" # Default storage engine of the catalog: "json" (catalog file and journal) or "sqlite". Can be overwritten with the "catalogStore" key of the conf.json file
+flushInterval = 0.5 # Default number of seconds between two writes of the journal on disk. Can be overwritten with the "flushInterval" key of the conf.json file
+compactionSize = 1000000 # Default size in bytes of the journal after which it is rolled into the catalog file. Can be overwritten with the "compactionSize" key of the conf.json file
+streamingLoad = False # Default way of reading the catalog file at startup: True to decode it one line at a time while the catalog is built, instead of reading it all at once. Can be overwritten with the "streamingLoad" key of the conf.json file
+@functools.lru_cache(maxsize=None) # There are only 86400 different times, so they are converted once
+def daySeconds(text): # Seconds since midnight of a time of the day "HH:MM:SS" or "HH:MM". Raise ValueError if it is not valid
+
+    parts = [int(part) for part in text.split(":")]
+    if len(parts) == 2:
+        parts.append(0)
+    if len(parts) != 3 or not (0 <= parts[0] < 24 and 0 <= parts[1] < 60 and 0 <= parts[2] < 60):
+        raise ValueError("Invalid time " + text)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+threadLock = threading.Lock() # Serializes the writers of the catalog (REST interface and the service "cleaner" that checkes which service is alive). Readers do not need it, since they work on a published version of the catalog
+
+class CatalogState(object): # One version of the catalog. A published version is never modified: writers change a copy of it and then publish the copy, so readers never need a lock
+
+    tables = ["data", "patients", "devices", "assistants", "newDevices", "patientChats", "assistantChats", "userNames", "alarms", "patientAssistants", "assistantPatients"]
+    indexes = ["patientChats", "assistantChats", "userNames"] # Tables built only the first time they are used (see __getattr__). The same for alarms and for the relations between patients and assistants
+    relations = ["patientAssistants", "assistantPatients"]
+
+    def __init__(self, catalog): # catalog is the json structure of the catalog file, or an iterator of its (key, value) pairs (see streamCatalog in catalogStore.py)
+
+        self.data = {} # Configuration, services and opening records. patientList, assistantList and newDevices are kept only for their position in the json structure
+        self.patients = {} # userID -> patient
+        self.devices = {} # (userID, deviceID) -> device. The device is the same object contained in the "devices" list of the patient
+        self.assistants = {} # userID -> assistant
+        self.newDevices = {} # deviceID -> device not yet registered to a user
+        # patientChats (chatID -> userID of the patient), assistantChats (chatID -> userID of the assistant) and userNames (userName -> userID, for both patients and assistants) are built when first used
+        # The same for alarms: minute of the day -> {(userID, deviceID, slotNum, alarmNum): (seconds of the day, device)}, the index of the alarms by time of the day. Once built, it is kept up to date by putPatient
+        # The same for patientAssistants (patientID -> frozenset of the assistantIDs that follow the patient) and assistantPatients (assistantID -> frozenset of the patientIDs it follows), with only the users that have at least one relation. Once built, they are kept up to date by putPatient and putAssistant
+        self.copied = set(self.tables) # Tables that belong only to this version, and can therefore be modified in place
+        self.changed = {} # (table, key) of the entities modified by this version, used to write the journal
+        self.versions = {} # Section of the catalog ("patients", "assistants", "newDevices" or a key of data, like "times") -> version of its last modification
+
+        # Single pass on the catalog: the devices index and the maximum (int) user and device IDs are built while the entities are read, so that new devices and users will be added with an ID that is progressively 1 unit higher
+        self.maxUserID = 0
+        self.maxDeviceID = 0
+        ids = None
+        for key, value in (catalog.items() if isinstance(catalog, dict) else catalog):
+            if key == "ids": # Header of the catalog file with the ID counters: the IDs of removed users and devices are never given again
+                ids = value
+                continue
+            if key == "patientList":
+                for patient in value:
+                    self.loadPatient(patient)
+                value = []
+            elif key == "assistantList":
+                for assistant in value:
+                    userID = int(assistant["userID"])
+                    self.assistants[userID] = assistant
+                    if userID > self.maxUserID:
+                        self.maxUserID = userID
+                value = []
+            elif key == "newDevices":
+                for device in value:
+                    deviceID = int(device["deviceID"])
+                    self.newDevices[deviceID] = device
+                    if deviceID > self.maxDeviceID:
+                        self.maxDeviceID = deviceID
+                value = []
+            self.data[key] = value
+        if ids != None:
+            self.maxUserID = max(self.maxUserID, ids[0])
+            self.maxDeviceID = max(self.maxDeviceID, ids[1])
+        self.startVersion = self.data.get("version", 0) # Version of the sections that were not modified since the catalog was loaded
+
+    def loadPatient(self, patient): # Add a patient while the catalog is loaded. Same as putPatient, without checking what it replaces
+
+        userID = int(patient["userID"])
+        self.patients[userID] = patient
+        if userID > self.maxUserID:
+            self.maxUserID = userID
+        for device in patient["devices"]:
+            deviceID = int(device["deviceID"])
+            self.devices[(userID, deviceID)] = device
+            if deviceID > self.maxDeviceID:
+                self.maxDeviceID = deviceID
+
+    def __getattr__(self, name): # Called only for the attributes not yet set: build the indexes by chatID and userName, or the one of the alarms, the first time one of them is used
+
+        if name == "alarms":
+            alarms = {}
+            for (userID, deviceID), device in self.devices.items():
+                for seconds, key in self.alarmEntries(userID, device):
+                    alarms.setdefault(seconds // 60, {})[key] = (seconds, device)
+            self.alarms = alarms
+            self.copied.add("alarms")
+            return alarms
+        if name in CatalogState.relations:
+            self.patientAssistants = dict([(userID, self.relationSet(patient["assistants"], "assistantID")) for userID, patient in self.patients.items() if len(patient["assistants"]) > 0])
+            self.assistantPatients = dict([(userID, self.relationSet(assistant["assistedPatients"], "patientID")) for userID, assistant in self.assistants.items() if len(assistant["assistedPatients"]) > 0])
+            self.copied.update(CatalogState.relations)
+            return getattr(self, name)
+        if name not in CatalogState.indexes:
+            raise AttributeError(name)
+        patientChats = {}
+        assistantChats = {}
+        userNames = {}
+        for userID, patient in self.patients.items():
+            patientChats[patient["chatID"]] = userID
+            userNames.setdefault(patient["userName"], userID)
+        for userID, assistant in self.assistants.items():
+            assistantChats[assistant["chatID"]] = userID
+            userNames.setdefault(assistant["userName"], userID)
+        self.patientChats = patientChats # Two readers can build them at the same time: they get the same result
+        self.assistantChats = assistantChats
+        self.userNames = userNames
+        self.copied.update(CatalogState.indexes)
+        return getattr(self, name)
+
+    def copy(self): # Return a new version sharing all the tables with this one. A table is copied only when the writer modifies it
+
+        state = CatalogState.__new__(CatalogState)
+        state.__dict__.update(self.__dict__)
+        state.copied = set()
+        state.changed = {}
+        return state
+
+    def table(self, name): # Return the table with the given name, copying it first if it is still shared with the published version
+
+        if name not in self.copied:
+            setattr(self, name, dict(getattr(self, name)))
+            self.copied.add(name)
+        return getattr(self, name)
+
+    def export(self): # Rebuild the whole catalog in its json structure
+        catalog = dict(self.data)
+        catalog["patientList"] = list(self.patients.values())
+        catalog["assistantList"] = list(self.assistants.values())
+        catalog["newDevices"] = list(self.newDevices.values())
+        return catalog
+
+    def snapshot(self): # Json structure written in the catalog file: the catalog, preceded by the header with the ID counters
+
+        catalog = {"ids": [self.maxUserID, self.maxDeviceID]}
+        catalog.update(self.export())
+        return catalog
+
+    def newVersion(self): # Give the next version number to this modification, and record which sections of the catalog it modified. The version is monotonic, and it is saved with the catalog
+
+        self.setData("version", self.data.get("version", 0) + 1)
+        self.markVersion()
+
+    def markVersion(self): # Record which sections of the catalog were modified by this version. Also used by the worker processes for the versions they replay
+
+        version = self.data["version"]
+        sections = [key if table == "data" else table for (table, key) in self.changed if (table, key) != ("data", "version")]
+        self.versions = dict(self.versions)
+        for section in sections:
+            self.versions[section] = version
+
+    def changes(self, old): # Entities modified with respect to the old version, as {table: {key: value}} (value is None if the entity was removed). Devices are reported one by one, with key "userID/deviceID"; patients without their devices and password
+
+        changes = {}
+        for (table, key) in self.changed:
+            if table == "patients":
+                patient = self.patients.get(key)
+                oldPatient = old.patients.get(key)
+                devices = {}
+                oldDevices = {}
+                if patient != None:
+                    devices = dict([(device["deviceID"], device) for device in patient["devices"]])
+                if oldPatient != None:
+                    oldDevices = dict([(device["deviceID"], device) for device in oldPatient["devices"]])
+                for deviceID in list(devices.keys()) + [deviceID for deviceID in oldDevices if deviceID not in devices]:
+                    if devices.get(deviceID) != oldDevices.get(deviceID): # An unchanged device is usually the same object, but the versions replayed by the worker processes contain new ones
+                        changes.setdefault("devices", {})[str(key) + "/" + str(deviceID)] = devices.get(deviceID)
+                summary = self.patientSummary(patient)
+                if summary != self.patientSummary(oldPatient):
+                    changes.setdefault("patients", {})[key] = summary
+            elif table == "data":
+                if key != "version":
+                    changes.setdefault("data", {})[key] = self.data.get(key)
+            elif table != "ids":
+                changes.setdefault(table, {})[key] = getattr(self, table).get(key)
+        return changes
+
+    def patientSummary(self, patient): # Patient without its devices and password, as reported by the "changes" request
+
+        if patient == None:
+            return None
+        return dict([(key, value) for key, value in patient.items() if key not in ["devices", "password"]])
+
+    def sectionVersion(self, sections): # Version of the last modification of any of the sections
+
+        return max([self.versions.get(section, self.startVersion) for section in sections])
+
+    def records(self): # Return the records [table, key, value] describing the modifications of this version. value is None if the entity was removed
+
+        records = []
+        for (table, key) in self.changed:
+            if table == "ids":
+                records.append(["ids", None, [self.maxUserID, self.maxDeviceID]])
+            else:
+                records.append([table, key, getattr(self, table).get(key)])
+        return records
+
+    def apply(self, records): # Apply the records of a modification, read from the journal
+
+        for table, key, value in records:
+            if table == "patients":
+                self.putPatient(value)
+            elif table == "assistants":
+                self.putAssistant(value)
+            elif table == "newDevices" and value == None:
+                self.removeNewDevice(key)
+            elif table == "newDevices":
+                self.putNewDevice(value)
+            elif table == "data":
+                self.setData(key, value)
+            elif table == "ids":
+                self.maxUserID = value[0]
+                self.maxDeviceID = value[1]
+
+    def setData(self, key, value): # Change a field of the configuration, services and opening records
+
+        self.table("data")[key] = value
+        self.changed[("data", key)] = True
+
+    def newUserID(self): # UserID is the maiximum ID registered in the Catalog, +1.
+
+        self.maxUserID += 1
+        self.changed[("ids", None)] = True
+        return self.maxUserID
+
+    def newDeviceID(self): # Assign the device ID as the max deviceID in the catalog + 1
+
+        self.maxDeviceID += 1
+        self.changed[("ids", None)] = True
+        return self.maxDeviceID
+
+    def putNewDevice(self, device): # Add a device to the newDevices
+
+        self.table("newDevices")[int(device["deviceID"])] = device
+        self.changed[("newDevices", int(device["deviceID"]))] = True
+
+    def removeNewDevice(self, deviceID): # Remove a device from the newDevices, since it was registered to a user
+
+        del self.table("newDevices")[int(deviceID)]
+        self.changed[("newDevices", int(deviceID))] = True
+
+    def findDevice(self, userID, deviceID): # Return the device with deviceID registered to the user with userID, or None
+
+        return self.devices.get((int(userID), int(deviceID)))
+
+    def putPatient(self, patient): # Add or replace a patient, together with all his devices
+
+        userID = int(patient["userID"])
+        old = self.patients.get(userID)
+        self.table("patients")[userID] = patient
+        self.changed[("patients", userID)] = True
+        if old == None or old["devices"] is not patient["devices"]:
+            devices = self.table("devices")
+            if old != None:
+                for device in old["devices"]:
+                    del devices[(userID, int(device["deviceID"]))]
+            for device in patient["devices"]:
+                devices[(userID, int(device["deviceID"]))] = device
+            if "alarms" in self.__dict__: # The index of the alarms was already built
+                self.updateAlarms(userID, old["devices"] if old != None else [], patient["devices"])
+        if "patientAssistants" in self.__dict__ and (old == None or old["assistants"] is not patient["assistants"]):
+            self.putRelation("patientAssistants", userID, self.relationSet(patient["assistants"], "assistantID"))
+        if old == None:
+            self.table("patientChats")[patient["chatID"]] = userID
+            if patient["userName"] not in self.userNames:
+                self.table("userNames")[patient["userName"]] = userID
+
+    def alarmEntries(self, userID, device): # Yield (seconds of the day, key) for every alarm of a device, as kept in the index of the alarms
+
+        deviceID = int(device["deviceID"])
+        for slotNum, slot in enumerate(device["slots"]):
+            for alarmNum, alarm in enumerate(slot["schedule"]):
+                try:
+                    seconds = daySeconds(alarm["time"])
+                except ValueError: # Never rings
+                    continue
+                yield seconds, (userID, deviceID, slotNum, alarmNum)
+
+    def updateAlarms(self, userID, oldDevices, newDevices): # Replace in the index the alarms of the devices of a patient that changed. Only the buckets of the minutes involved are copied
+
+        oldDevices = dict([(int(device["deviceID"]), device) for device in oldDevices])
+        newDevices = dict([(int(device["deviceID"]), device) for device in newDevices])
+        changes = {} # minute -> [(key, (seconds, device) or None if it was removed)]
+        for deviceID, device in oldDevices.items():
+            if newDevices.get(deviceID) is not device:
+                for seconds, key in self.alarmEntries(userID, device):
+                    changes.setdefault(seconds // 60, []).append((key, None))
+        for deviceID, device in newDevices.items():
+            if oldDevices.get(deviceID) is not device:
+                for seconds, key in self.alarmEntries(userID, device):
+                    changes.setdefault(seconds // 60, []).append((key, (seconds, device)))
+        if len(changes) == 0:
+            return
+        alarms = self.table("alarms")
+        for minute, items in changes.items():
+            bucket = dict(alarms.get(minute, {}))
+            for key, value in items:
+                if value == None:
+                    bucket.pop(key, None)
+                else:
+                    bucket[key] = value
+            if len(bucket) > 0:
+                alarms[minute] = bucket
+            else:
+                alarms.pop(minute, None)
+
+    def dueAlarms(self, start, end): # Alarms with a time in [start, end) seconds of the day, in the order in which they ring. If start > end the window crosses midnight
+
+        if start <= end:
+            windows = [(start, end)]
+        else:
+            windows = [(start, 24 * 3600), (0, end)]
+        due = []
+        alarms = self.alarms
+        for first, last in windows:
+            for minute in range(first // 60, (last + 59) // 60):
+                for key, (seconds, device) in alarms.get(minute, {}).items():
+                    if first <= seconds < last:
+                        due.append((seconds, key, device))
+        due.sort(key=lambda item: ((item[0] - start) % (24 * 3600), item[1]))
+        result = []
+        for seconds, (userID, deviceID, slotNum, alarmNum), device in due:
+            alarm = device["slots"][slotNum]["schedule"][alarmNum]
+            result.append({"patientID": userID, "deviceID": deviceID, "slot": slotNum, "alarmNum": alarmNum, "time": alarm["time"], "numPill": alarm["numPill"], "alarm": alarm["alarm"], "deviceURI": device["deviceURI"]})
+        return result
+
+    def putDevice(self, userID, device): # Add or replace a device of a patient. The patient is copied, since his list of devices changes
+
+        patient = dict(self.patients[int(userID)])
+        devices = []
+        for item in patient["devices"]:
+            if int(item["deviceID"]) != int(device["deviceID"]):
+                devices.append(item)
+            else:
+                devices.append(device)
+        if (int(userID), int(device["deviceID"])) not in self.devices:
+            devices.append(device)
+        patient["devices"] = devices
+        self.putPatient(patient)
+
+    def removeDevice(self, userID, deviceID): # Remove a device from a patient
+
+        patient = dict(self.patients[int(userID)])
+        patient["devices"] = [device for device in patient["devices"] if int(device["deviceID"]) != int(deviceID)]
+        self.putPatient(patient)
+
+    def putAssistant(self, assistant): # Add or replace an assistant
+
+        userID = int(assistant["userID"])
+        old = self.assistants.get(userID)
+        self.table("assistants")[userID] = assistant
+        self.changed[("assistants", userID)] = True
+        if "assistantPatients" in self.__dict__ and (old == None or old["assistedPatients"] is not assistant["assistedPatients"]):
+            self.putRelation("assistantPatients", userID, self.relationSet(assistant["assistedPatients"], "patientID"))
+        if old == None:
+            self.table("assistantChats")[assistant["chatID"]] = userID
+            if assistant["userName"] not in self.userNames:
+                self.table("userNames")[assistant["userName"]] = userID
+
+    def relationSet(self, items, key): # IDs in the "assistants" list of a patient (key "assistantID") or in the "assistedPatients" list of an assistant (key "patientID")
+
+        return frozenset([int(item[key]) for item in items])
+
+    def putRelation(self, name, userID, ids): # Only the users with at least one relation are in the table, so a write copies a table as big as the relations, not as the users
+
+        if len(ids) > 0:
+            self.table(name)[userID] = ids
+        elif userID in self.__dict__[name]:
+            del self.table(name)[userID]
+
+    def updateSlot(self, userID, device, slotNum, key, value): # Change a field of a slot of a device, copying the slot and the device
+
+        device = dict(device)
+        device["slots"] = list(device["slots"])
+        slot = dict(device["slots"][slotNum])
+        slot[key] = value
+        device["slots"][slotNum] = slot
+        self.putDevice(userID, device)
+
+def modification(method): # Decorator of the methods of Catalog that modify it: if the method fails between begin() and commit() (ex. a key missing in the body of the request), the modification is aborted, so the writer lock is never kept forever. Only if this thread still holds the lock: after commit() it may already belong to the next writer
+
+    @functools.wraps(method)
+    def modify(self, *args):
+        try:
+            return method(self, *args)
+        except BaseException:
+            if self.writer == threading.get_ident():
+                self.abort()
+            raise
+    return modify
 
 class Catalog(object):
-    
-    def __init__(self,filename):
-        # Create a file if its not present yet
-        if os.path.isfile(filename):
-            pass
-        else: 
-            json.dump({}, open(self.chatStateFile, "w"))
-        data = self.read()
-        
-        self.filename = filename
 
-        # Check what is the maximum (int) user and device IDs, so that new devices and users will be added with an ID that is progressively 1 unit higher 
-        self.maxDeviceID = 0
-        self.maxUserID = 0
-        for patient in data["patientList"]:
-            if int(patient["userID"]) > self.maxUserID:
-                self.maxUserID = patient["userID"]
-            for device in patient["devices"]:
-                if int(device["deviceID"]) >= self.maxDeviceID:
-                    self.maxDeviceID = int(device["deviceID"])
+    def __init__(self,store,outbox):
 
-        for assistant in data["assistantList"]:
-            if int(assistant["userID"]) > self.maxUserID:
-                self.maxUserID = assistant["userID"]
+        self.store = store # Makes the modifications durable (see catalogStore.py)
+        self.outbox = outbox # Sends the requests to the devices, outside the modifications of the catalog
+        catalog, records = self.store.load() # The file is parsed only once: from now on the catalog lives in memory
+        self.state = CatalogState(catalog) # Current version of the catalog, the one seen by the readers
+        for modification in records: # Replay the modifications that were not yet in the catalog file
+            self.state.apply(modification)
+        self.state.changed = {}
+        self.state.startVersion = self.state.data.get("version", 0)
+        self.changeLog = collections.deque(maxlen=changeLogSize) # (version, changes) of the last modifications, for the "changes" request
+        self.changeVersion = self.state.startVersion # Version of the last modification in changeLog
+        self.changeCondition = threading.Condition() # Wakes up the "changes" requests waiting for a modification
+        self.changeListeners = [] # Functions called after every modification, ex. to wake up the "changes" requests of the asyncio front end
+        self.publisher = None # ChangePublisher that sends the modifications on MQTT, if any
+        self.services = ServiceRegistry(serviceTimeout) # Services that are alive. Kept only in memory, since the pings arrive every few seconds
+        self.cache = ResponseCache(cacheSize) # Answers of the most frequent requests, already encoded
+        self.shared = False # True if worker processes read the database: a modification is then answered only once it is on disk, so it is seen by the next request on any worker
+        self.writer = None # Identifier of the thread that holds the writer lock, between begin() and commit() or abort()
 
-        for device in data["newDevices"]:
-            self.maxDeviceID = max(self.maxDeviceID, int(device["deviceID"]))
-    
-    def save(self, data): # Method to access the json file and save it
-        with open(filename, 'w') as fp:
-            json.dump(data, fp, indent=6)
+    def start(self): # Start writing the modifications on disk and sending the requests to the devices
 
-    def read(self): # Method to access the json file and read it 
-        with open(filename) as fp:
-            return json.load(fp)
+        self.store.start(self.state)
+        self.outbox.start()
 
-    def updateLU(self): # Update the last usage of the whole catalog. Method used by the Time Shift 
+    def close(self): # Write on disk all the modifications. Called when the server is stopped
 
-        threadLock.acquire()
-        catalog=self.read()
-        catalog["lastUpdate"] = time.ctime()
-        self.save(catalog)
-        threadLock.release()
-    
-    def getSchedule(self,userID,deviceID): # Get the alarm schedule of every slot, specifying a useriD and deviceID. Used by the Telegram Bot
+        self.store.close()
+        self.outbox.close()
+
+    def begin(self): # Start a modification of the catalog. Writers are serialized, and they work on a copy of the current version
 
         threadLock.acquire()
-        catalog=self.read()
+        self.writer = threading.get_ident()
+        return self.state.copy()
+
+    def commit(self, state): # Publish the modified version, so that it is seen by the following readers. Its records are queued for the journal while the writer lock is held, so they are written in the same order of the versions
+
+        try:
+            if len(state.changed) > 0: # Something was actually modified
+                state.newVersion()
+                self.store.commit(state, state.records())
+                changes = self.publish(state)
+                if self.publisher != None: # Published while the writer lock is held, so the events are sent in the same order of the versions
+                    self.publisher.publishChanges(state.data["version"], changes)
+        finally:
+            self.writer = None # Before releasing the lock, so that the next writer is never reset
+            threadLock.release()
+
+    def abort(self): # End a modification without publishing anything
+
+        self.writer = None
         threadLock.release()
-        for user in catalog["patientList"]:
-            if int(user["userID"]) == int(userID):
-                for device in user["devices"]:
-                    if int(device["deviceID"]) == int(deviceID):
-                        result = []
-                        for slot in device["slots"]:
-                            result.append(slot["schedule"])
-                        return json.dumps({"slots":result})
-                    
+
+    def checkIndex(self, items, index, name): # Refuse a slot or an alarm that the device does not have. Negative indexes are refused too, instead of counting from the end of the list. Called inside a modification, that is then aborted
+
+        if index < 0 or index >= len(items):
+            raise RequestError(400, "Invalid " + name + " " + str(index))
+
+    def publish(self, state): # Make a new version visible to the readers and to the "changes" requests. Return its changes. Called with the writer lock acquired
+
+        changes = state.changes(self.state)
+        self.state = state
+        self.changeCondition.acquire()
+        self.changeLog.append((state.data["version"], changes))
+        self.changeVersion = state.data["version"]
+        self.changeCondition.notify_all()
+        self.changeCondition.release()
+        for listener in self.changeListeners:
+            listener()
+        return changes
+
+    def refresh(self): # Bring the catalog up to date before answering a request. Only the worker processes have something to do (see CatalogReplica)
+        pass
+
+    def sync(self): # Wait until the current version is on disk, if the worker processes read it. Called after a modification, before answering
+        if self.shared:
+            self.store.waitWritten(self.state.data.get("version", 0))
+
+    def read(self): # Method to access the whole catalog. It is built from the in-memory current version, so no file is read
+        catalog = self.state.export()
+        catalog["aliveServices"] = self.services.alive()
+        return catalog
+
+    def getChanges(self, since=None, timeout=0, tables=None): # Return the entities modified after version since. If there are none, wait up to timeout seconds for a modification. Used by the services to keep their copy of the catalog up to date
+
+        self.changeCondition.acquire()
+        if since == None: # The service only wants to know the current version
+            result = {"version": self.changeVersion, "reset": 1}
+        else:
+            deadline = time.time() + min(float(timeout), maxLongPoll)
+            while True:
+                result = self.collectChanges(int(since), tables)
+                remaining = deadline - time.time()
+                if "reset" in result or len(result["changes"]) > 0 or remaining <= 0:
+                    break
+                self.changeCondition.wait(remaining)
+        self.changeCondition.release()
+        return json.dumps(result)
+
+    def hasChanges(self, since, tables): # True if a "changes" request would be answered immediately. Used by the asyncio front end, that waits for a modification without holding a thread
+
+        self.changeCondition.acquire()
+        result = self.collectChanges(since, tables)
+        self.changeCondition.release()
+        return "reset" in result or len(result["changes"]) > 0
+
+    def collectChanges(self, since, tables): # Merge the changes of the versions after since, keeping only the last value of every entity. Called with changeCondition acquired
+
+        if since > self.changeVersion or (since < self.changeVersion and (len(self.changeLog) == 0 or self.changeLog[0][0] > since + 1)):
+            return {"version": self.changeVersion, "reset": 1} # Some modifications are not in changeLog any more (or the catalog was restarted): the service must read again the whole catalog
+        newer = []
+        for version, changes in reversed(self.changeLog):
+            if version <= since:
+                break
+            newer.append(changes)
+        result = {}
+        for changes in reversed(newer):
+            for table in changes:
+                if tables == None or table in tables:
+                    result.setdefault(table, {}).update(changes[table])
+        return {"version": self.changeVersion, "changes": result}
+
+    def getETag(self, sections=None): # ETag of the answers built from the given sections of the catalog (ex. ["patients"]). Without sections, the ETag changes with every modification
+
+        state = self.state
+        if sections == None: # The whole catalog also contains the services that are alive
+            return '"' + str(state.data.get("version", 0)) + "." + str(self.services.version) + '"'
+        return '"' + str(state.sectionVersion(sections)) + '"'
+
+    def getSchedule(self,userID,deviceID): # Get the alarm schedule of every slot, specifying a useriD and deviceID. Used by the Telegram Bot
+
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            result = []
+            for slot in device["slots"]:
+                result.append(slot["schedule"])
+            return json.dumps({"slots":result})
+
     def getSchedules(self): # Get the alarm schedule for every device of every user. Used by the Time Shift.
 
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
         send = {}
-        for user in catalog["patientList"]:
-            for device in user["devices"]:
-                key = str(user["userID"]) + "/" + str(device["deviceID"])
-                sched = [] 
-                for slot in device["slots"]:
-                    sched.append(slot["schedule"])
-                send[key] = sched
+        for (userID, deviceID), device in self.state.devices.items():
+            key = str(userID) + "/" + str(deviceID)
+            sched = []
+            for slot in device["slots"]:
+                sched.append(slot["schedule"])
+            send[key] = sched
         return json.dumps(send)
-                
 
-    def getDeviceURI(self,userID,deviceID): # Get the device URI given the userID and the deviceID. This is used by the Telegram Bots in order to retrieve the number of pills by contacting directly the device. 
+    def getDueAlarms(self, start, end): # Alarms due between start and end (seconds of the day, end excluded), with what is needed to ring them. Used by the schedulers, that ask only for the next few minutes
 
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        found=False
-        for user in catalog["patientList"]:
-            if int(user["userID"]) == int(userID):
-                for device in user["devices"]:
-                    if int(device["deviceID"]) == int(deviceID):
-                        found=True
-                        return json.dumps({"deviceURI":device["deviceURI"]})
-        if found==False:
-            return json.dumps({"deviceURI":None})
+        return json.dumps(self.state.dueAlarms(start, end))
+
+    def getDeviceURI(self,userID,deviceID): # Get the device URI given the userID and the deviceID. This is used by the Telegram Bots in order to retrieve the number of pills by contacting directly the device.
+
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            return json.dumps({"deviceURI":device["deviceURI"]})
+        return json.dumps({"deviceURI":None})
 
     def getTempThresh(self,userID,deviceID): # Return the temperature thresholds. Used both by Telegram Bot and the Conservation Control
-        
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        for user in catalog["patientList"]:
-            if int(user["userID"]) == int(userID):
-                for device in user["devices"]:
-                    if int(device["deviceID"]) == int(deviceID):
-                        return json.dumps({"tempUpperThresh":device["tempUpperThresh"],"tempLowerThresh":device["tempLowerThresh"]})
+
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            return json.dumps({"tempUpperThresh":device["tempUpperThresh"],"tempLowerThresh":device["tempLowerThresh"]})
 
     def getHumThresh(self,userID,deviceID): # Return the temperature thresholds. Used both by Telegram Bot and the Conservation Control
 
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        for user in catalog["patientList"]:
-            if int(user["userID"]) == int(userID):
-                for device in user["devices"]:
-                    if int(device["deviceID"]) == int(deviceID):
-                        return json.dumps({"humUpperThresh":device["humUpperThresh"],"humLowerThresh":device["humLowerThresh"]})
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            return json.dumps({"humUpperThresh":device["humUpperThresh"],"humLowerThresh":device["humLowerThresh"]})
 
-    def getChatID(self,userID): # Get chatID given userID. Used for notifications on Telegram bot, when a MQTT message is received. 
+    def getChatID(self,userID): # Get chatID given userID. Used for notifications on Telegram bot, when a MQTT message is received.
 
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        found=False
-        for user in catalog["patientList"]:
-            if int(user["userID"])==int(userID):
-                found = True
-                return json.dumps({"chatID":user["chatID"]})
-        if found==False:
-            return json.dumps({"chatID":None})
+        user = self.state.patients.get(int(userID))
+        if user != None:
+            return json.dumps({"chatID":user["chatID"]})
+        return json.dumps({"chatID":None})
 
-    def getDevices(self, userID): # Get the full list of devices register to the user with the specified userID 
+    def getDevices(self, userID): # Get the full list of devices register to the user with the specified userID
+
+        user = self.state.patients.get(int(userID))
+        if user != None and len(user["devices"])>0:
+            toSend = []
+            for device in user["devices"]:
+                toSend.append(device["deviceID"])
+            return json.dumps({"devices":toSend})
+        return json.dumps({"devices":None})
 
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        found=False
-        toSend = []
-        for user in catalog["patientList"]:
-            if int(user["userID"])==int(userID):
-                found = True
-                for device in user["devices"]:
-                    toSend.append(device["deviceID"])
-                if len(toSend)>0:
-                    return json.dumps({"devices":toSend})
-                else:
-                    return json.dumps({"devices":None})
-        if found==False:
-            return json.dumps({"devices":None})
-                    
     def getUserID(self, chatID): # Given the chatID, return the userID. Used by the TelegramBot to know which user is writing on Telegram
 
-        chatID=int(chatID)
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        found = False
-        for user in catalog["patientList"]:
-            if user["chatID"]==chatID:
-                found = True
-                return json.dumps({"userID":int(user["userID"])})
-        if found == False:
-            return json.dumps({"userID":None})
-
-    def getUserProfileData(self, userID): # Return username, password and type of useage. Used by TelegramBot. 
-        
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        found = False
-        for user in catalog["patientList"]:
-            if int(user["userID"]) == int(userID):
-                found = True
-                return json.dumps({"username":user["userName"], "password": user["password"], "usage": user["usage"]})
-        if found == False:
-            return json.dumps({"username":None, "password": None, "usage": None})
-
-    def getSlotsName(self, userID, deviceID): # Return a list containing all the slots names, given userID and deviceID. Used by TelegramBot. 
-        
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        result = []
-                        for slot in device["slots"]:
-                            result.append(slot["pillName"])
-                        return json.dumps({"slots":result}) 
-                    
+        return json.dumps({"userID":self.state.patientChats.get(int(chatID))})
+
+    def getUserProfileData(self, userID): # Return username, password and type of useage. Used by TelegramBot.
+
+        user = self.state.patients.get(int(userID))
+        if user != None:
+            return json.dumps({"username":user["userName"], "password": user["password"], "usage": user["usage"]})
+        return json.dumps({"username":None, "password": None, "usage": None})
+
+    def getSlotsName(self, userID, deviceID): # Return a list containing all the slots names, given userID and deviceID. Used by TelegramBot.
+
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            result = []
+            for slot in device["slots"]:
+                result.append(slot["pillName"])
+            return json.dumps({"slots":result})
+
     def getSlotsNumber(self, userID, deviceID): # Return the number of slots. Used by the TelegramBot.
-        
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        result = len(device["slots"])
-                        return json.dumps({"slots":result}) 
 
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            return json.dumps({"slots":len(device["slots"])})
+
+    def deviceContext(self, state, userID, deviceID, fields): # Collect the requested fields about a device and its owner from a single version of the catalog. Return None if the device is not registered to the user
+
+        device = state.findDevice(userID, deviceID)
+        if device == None:
+            return None
+        user = state.patients[int(userID)]
+        context = {"found":1}
+        for field in fields:
+            if field == "chatID":
+                context["chatID"] = user["chatID"]
+            elif field == "assistantChatIDs":
+                context["assistantChatIDs"] = [state.assistants[int(item["assistantID"])]["chatID"] for item in user["assistants"] if int(item["assistantID"]) in state.assistants]
+            elif field == "slotsName":
+                context["slotsName"] = [slot["pillName"] for slot in device["slots"]]
+            elif field == "schedule":
+                context["schedule"] = [slot["schedule"] for slot in device["slots"]]
+            elif field in deviceFields:
+                context[field] = device[field]
+        return context
+
+    def getDevice(self, userID, deviceID, fields=deviceFields): # Return everything the services need to know about a device in a single request, instead of one request for every field. Used by the services when they receive a MQTT message from a device
+
+        context = self.deviceContext(self.state, userID, deviceID, fields)
+        if context == None:
+            return json.dumps({"found":0})
+        return json.dumps(context)
+
+    def getDeviceList(self, keys, fields=deviceFields): # Same as getDevice, for many "userID/deviceID" keys at once. Used by the ThingSpeak adaptor
+
+        state = self.state # All the devices are read from the same version of the catalog
+        result = {}
+        for key in keys:
+            try:
+                userID, deviceID = [int(ID) for ID in key.split("/")]
+            except ValueError: # Not two IDs separated by "/", or not numbers
+                raise RequestError(400, "Invalid device " + key + ": the keys are userID/deviceID")
+            context = self.deviceContext(state, userID, deviceID, fields)
+            if context == None:
+                context = {"found":0}
+            result[key] = context
+        return json.dumps({"devices":result})
+
+    @modification
     def addUser(self,patient_json): # Add a new user, that just pressed /start on Telegram and inserted username and password.
-        
-        threadLock.acquire()
-        catalog=self.read()
-        for user in catalog["patientList"]:
-            if user["userName"] == patient_json["userName"]:
-                threadLock.release()
-                return json.dumps({"usernameExists" : 1}) # There cannot be two people with the same username!!! Alert thorugh the telegram bot to chose another username 
-        #Perform the same operation for the assistant list
-        for user in catalog["assistantList"]:
-            if user["userName"] == patient_json["userName"]:
-                threadLock.release()
-                return json.dumps({"usernameExists" : 1})  
-        userID = self.maxUserID + 1 # UserID is the maiximum ID registered in the Catalog, +1.
-        self.maxUserID += 1 # Update the maximum number of user ID
-        if (patient_json["usage"].lower() == "h"): # Type of usage of the system
+
+        state = self.begin()
+        if patient_json["userName"] in state.userNames: # There cannot be two people with the same username, either patients or assistants!!! Alert thorugh the telegram bot to chose another username
+            self.abort()
+            return json.dumps({"usernameExists" : 1})
+        userID = state.newUserID() # UserID is the maiximum ID registered in the Catalog, +1.
+        if (patient_json["usage"].lower() == "h"): # Type of usage of the system
             usage = "hospital"
-        else: 
+        else:
             usage = "personal"
         # Add the record of the new user to the Catalog
-        catalog["patientList"].append({"userID": int(userID), "userName":patient_json["userName"], "password":patient_json["password"], "usage": usage, "chatID":patient_json["chatID"], "last_update":time.ctime(), "devices":[], "assistants": []})
-        self.save(catalog)
-        threadLock.release()
+        state.putPatient({"userID": int(userID), "userName":patient_json["userName"], "password":patient_json["password"], "usage": usage, "chatID":patient_json["chatID"], "last_update":time.ctime(), "devices":[], "assistants": []})
+        self.commit(state)
         return json.dumps({"usernameExists" : 0})
-    
-    def addDevice(self,deviceID,userID): # Move a device from newDevices to a user that just registered it 
-        
-        threadLock.acquire()
-        catalog=self.read()
-        found = False
-        for device in catalog["newDevices"]:
-            if int(device["deviceID"]) == int(deviceID):
-                found =True
-                toAddDevice = device # Save in a variable the information of the device to be added
-                catalog["newDevices"].remove(device) # Remove the device from the newDevices list 
-                self.save(catalog)
-                requests.put(device["deviceURI"]+"/userID", json.dumps({"userID":int(userID)})) # Inform the device that it was correctly registered, and inform to which user
-                break
-        
-        if found == False: # If the deviceID given by the user is not present in newDevices, send an error message back 
-            threadLock.release()
-            return json.dumps({"found":0})
 
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                slots = [ {"pillName":"","schedule":[]} for _ in range(toAddDevice["numSlots"]) ]
-                deviceID = toAddDevice["deviceID"]
-                # Add the newly registered device to the correct user
-                user["devices"].append({"deviceID": deviceID, "deviceURI":toAddDevice["deviceURI"], "thingSpeakChannel":"None", "tempUpperThresh":30.0,"tempLowerThresh":10.0, "humUpperThresh":60.0,"humLowerThresh":40.0, "numSlots": toAddDevice["numSlots"], "slots": slots})
-                self.save(catalog)
-                threadLock.release()
-                return json.dumps({"found":1})  
-
-        # In the case user ID was not found
-        threadLock.release()
+    @modification
+    def addDevice(self,deviceID,userID): # Move a device from newDevices to a user that just registered it
 
-    def addPill(self,pill_json,userID,deviceID,slotNum): # Give a pill name to a slot. Information coming from the TelegramBot. 
-        
-        threadLock.acquire()
-        catalog=self.read()
-        
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        device["slots"][slotNum]["pillName"]=pill_json["pillName"]
-                        self.save(catalog)
-                        threadLock.release()
-                        return json.dumps({"added":1})
-        
-        threadLock.release()
-                    
-    def addSchedule(self,schedule_json,userID,deviceID,slotNumber): # Add an alarm schedule for a pill. Information coming from the TelegramBot.
-        
-        threadLock.acquire()
-        catalog=self.read()
-        
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        device["slots"][slotNumber]["schedule"].append({"alarm":0,"numPill":int(schedule_json["numPill"]),"time":schedule_json["time"] + ":00"})                            
-                        self.save(catalog)
-                        threadLock.release()
-                        return json.dumps({"added":1})
-        threadLock.release()
+        state = self.begin()
+        toAddDevice = state.newDevices.get(int(deviceID))
+        if toAddDevice == None: # If the deviceID given by the user is not present in newDevices, send an error message back
+            self.abort()
+            return json.dumps({"found":0})
+
+        if int(userID) not in state.patients: # In the case user ID was not found
+            self.abort()
+            return
+
+        state.removeNewDevice(deviceID) # Remove the device from the newDevices list
+        self.outbox.put("PUT", toAddDevice["deviceURI"]+"/userID", json.dumps({"userID":int(userID)})) # Inform the device that it was correctly registered, and inform to which user. Queued while the writer lock is held, so the requests to a device follow the order of the modifications
+        slots = [ {"pillName":"","schedule":[]} for _ in range(toAddDevice["numSlots"]) ]
+        deviceID = toAddDevice["deviceID"]
+        # Add the newly registered device to the correct user
+        state.putDevice(userID, {"deviceID": deviceID, "deviceURI":toAddDevice["deviceURI"], "thingSpeakChannel":"None", "tempUpperThresh":30.0,"tempLowerThresh":10.0, "humUpperThresh":60.0,"humLowerThresh":40.0, "numSlots": toAddDevice["numSlots"], "slots": slots})
+        self.commit(state)
+        return json.dumps({"found":1})
+
+    @modification
+    def addPill(self,pill_json,userID,deviceID,slotNum): # Give a pill name to a slot. Information coming from the TelegramBot.
+
+        state = self.begin()
+        device = state.findDevice(userID, deviceID)
+        if device != None:
+            self.checkIndex(device["slots"], slotNum, "slot")
+            state.updateSlot(userID, device, slotNum, "pillName", pill_json["pillName"])
+            self.commit(state)
+            return json.dumps({"added":1})
+        self.abort()
+
+    @modification
+    def addSchedule(self,schedule_json,userID,deviceID,slotNumber): # Add an alarm schedule for a pill. Information coming from the TelegramBot.
+
+        state = self.begin()
+        device = state.findDevice(userID, deviceID)
+        if device != None:
+            self.checkIndex(device["slots"], slotNumber, "slot")
+            schedule = device["slots"][slotNumber]["schedule"] + [{"alarm":0,"numPill":int(schedule_json["numPill"]),"time":schedule_json["time"] + ":00"}]
+            state.updateSlot(userID, device, slotNumber, "schedule", schedule)
+            self.commit(state)
+            return json.dumps({"added":1})
+        self.abort()
 
+    @modification
     def updateTempThresh(self, new_thresh_json, userID, deviceID): # Change temperature threshold. Information coming from the TelegramBot.
 
-        threadLock.acquire()
-        catalog=self.read()
-
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        device["tempUpperThresh"]=float(new_thresh_json["upperThresh"])
-                        device["tempLowerThresh"]=float(new_thresh_json["lowerThresh"])
-                        self.save(catalog)
-                        threadLock.release()
-                        return json.dumps({"added":1})
-        threadLock.release()
-                    
+        state = self.begin()
+        device = state.findDevice(userID, deviceID)
+        if device != None:
+            device = dict(device)
+            device["tempUpperThresh"]=float(new_thresh_json["upperThresh"])
+            device["tempLowerThresh"]=float(new_thresh_json["lowerThresh"])
+            state.putDevice(userID, device)
+            self.commit(state)
+            return json.dumps({"added":1})
+        self.abort()
+
+    @modification
     def updateChannel(self, channel, userID, deviceID): # Update ThingSpeak Channel
-        
-        threadLock.acquire()
-        catalog = self.read()
-        
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        device['thingSpeakChannel'] = channel
-                        self.save(catalog)
-                        threadLock.release()
-                        return json.dumps({"added":1})
-        threadLock.release()
 
+        state = self.begin()
+        device = state.findDevice(userID, deviceID)
+        if device != None:
+            device = dict(device)
+            device['thingSpeakChannel'] = channel
+            state.putDevice(userID, device)
+            self.commit(state)
+            return json.dumps({"added":1})
+        self.abort()
+
+    @modification
     def updateHumThresh(self, new_thresh_json, userID, deviceID): # Change temperature threshold. Information coming from the TelegramBot.
 
-        threadLock.acquire()
-        catalog=self.read()
-
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        device["humUpperThresh"]=float(new_thresh_json["upperThresh"])
-                        device["humLowerThresh"]=float(new_thresh_json["lowerThresh"])
-                        self.save(catalog) 
-                        threadLock.release()
-                        return json.dumps({"added":1})
-        threadLock.release()
+        state = self.begin()
+        device = state.findDevice(userID, deviceID)
+        if device != None:
+            device = dict(device)
+            device["humUpperThresh"]=float(new_thresh_json["upperThresh"])
+            device["humLowerThresh"]=float(new_thresh_json["lowerThresh"])
+            state.putDevice(userID, device)
+            self.commit(state)
+            return json.dumps({"added":1})
+        self.abort()
 
+    @modification
     def deleteAlarm(self, userID, deviceID, slotNum, alarmNum): # Delete an alarm for a pill. Information coming from the TelegramBot.
-        
-        threadLock.acquire()
-        catalog=self.read()
-
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                            del device["slots"][slotNum]["schedule"][int(alarmNum)]
-                            self.save(catalog)
-                            threadLock.release()
-                            return json.dumps({"deleted":1}) 
-        threadLock.release()
 
+        state = self.begin()
+        device = state.findDevice(userID, deviceID)
+        if device != None:
+            self.checkIndex(device["slots"], slotNum, "slot")
+            schedule = list(device["slots"][slotNum]["schedule"])
+            self.checkIndex(schedule, int(alarmNum), "alarm")
+            del schedule[int(alarmNum)]
+            state.updateSlot(userID, device, slotNum, "schedule", schedule)
+            self.commit(state)
+            return json.dumps({"deleted":1})
+        self.abort()
+
+    @modification
     def deleteDevice(self, userID, deviceID): # Move a device from being associated, to the newDevice list. Information coming from the TelegramBot.
 
-        threadLock.acquire()
-        catalog=self.read()
-
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                            user["devices"].remove(device) # Remove from the user
-                            catalog["newDevices"].append(device) # Append to the newDevices 
-                            requests.delete(device["deviceURI"]+"/dissociate") # Tell also the device to remove the userID to whom it is associated 
-                            self.save(catalog)
-                            threadLock.release()
-                            return json.dumps({"deleted":1})
-        threadLock.release()
-
-    def newDevice(self): # New device just started for the first time. Add it to the newDevices list, with all the relevant information.
-
-        threadLock.acquire()
-        catalog=self.read() 
-        deviceID = self.maxDeviceID + 1 # Assign the device ID as the max deviceID in the catalog + 1
-        self.maxDeviceID += 1  # Update the max deviceID
-        IP = cherrypy.request.remote.ip # Store the URI of the device, because it will have to be addressed for other operations (ex. getPillCount)
-        body = json.loads(cherrypy.request.body.read())
+        state = self.begin()
+        device = state.findDevice(userID, deviceID)
+        if device != None:
+            state.removeDevice(userID, deviceID) # Remove from the user
+            state.putNewDevice(device) # Append to the newDevices
+            self.outbox.put("DELETE", device["deviceURI"]+"/dissociate") # Tell also the device to remove the userID to whom it is associated
+            self.commit(state)
+            return json.dumps({"deleted":1})
+        self.abort()
+
+    @modification
+    def newDevice(self, body, IP): # New device just started for the first time. Add it to the newDevices list, with all the relevant information. IP is the address the request came from
+
+        state = self.begin()
+        deviceID = state.newDeviceID() # Assign the device ID as the max deviceID in the catalog + 1
+        # Store the URI of the device, because it will have to be addressed for other operations (ex. getPillCount)
         port = body["port"]
         numSlots = body["numSlots"]
-        catalog["newDevices"].append({"deviceID":deviceID, "deviceURI": "http://" + str(IP)+ ":" + str(port), "numSlots":numSlots})
-        self.save(catalog)
-        threadLock.release()
+        state.putNewDevice({"deviceID":deviceID, "deviceURI": "http://" + str(IP)+ ":" + str(port), "numSlots":numSlots})
+        self.commit(state)
         return deviceID
 
+    @modification
     def addAssistant(self, assistant_json): # A new assistant just pressed /start on the assistantBot. Add him to the assistantList.
-        
-        threadLock.acquire()
-        catalog=self.read()
+
+        state = self.begin()
         assisted = []
-        userID = self.maxUserID + 1 # ID as max userID +1
-        self.maxUserID += 1 # Update the user ID 
-        catalog["assistantList"].append({"userID": int(userID), "userName":assistant_json["userName"], "chatID":assistant_json["chatID"], "last_update":time.ctime(), "assistedPatients":assisted})
-        self.save(catalog)
-        threadLock.release()
+        userID = state.newUserID() # ID as max userID +1
+        state.putAssistant({"userID": int(userID), "userName":assistant_json["userName"], "chatID":assistant_json["chatID"], "last_update":time.ctime(), "assistedPatients":assisted})
+        self.commit(state)
         return json.dumps({"added":1})
 
-    def getAssistantID(self, chatID): # Get the assistantID given the chat ID. Used by assistantTelegramBot to know who is writing on telegram. 
+    def getAssistantID(self, chatID): # Get the assistantID given the chat ID. Used by assistantTelegramBot to know who is writing on telegram.
 
-        chatID=int(chatID)
-        threadLock.acquire()
-        catalog=self.read()
-        found = False
-        for assistant in catalog["assistantList"]:
-            if assistant["chatID"]==chatID:
-                found = True
-                threadLock.release()
-                return json.dumps({"userID":int(assistant["userID"])})
-        if found == False:
-            threadLock.release()
-            return json.dumps({"userID":None})
-  
-    def assistUser(self, data_json): # An assistant just entered commands, username and password on telegram to start assisting a new user 
+        return json.dumps({"userID":self.state.assistantChats.get(int(chatID))})
 
-        threadLock.acquire()
-        catalog=self.read()
+    @modification
+    def assistUser(self, data_json): # An assistant just entered commands, username and password on telegram to start assisting a new user
+
+        state = self.begin()
         username = data_json["username"]
         password = data_json["password"]
         assistantID = int(data_json["assistantID"])
-        found = False
-        for user in catalog["patientList"]:
-            if user["userName"] == username and user["password"] == password:
-                found = True
-                if {"assistantID": assistantID} not in user["assistants"]: # Check if it is not already assiting
-                    user["assistants"].append({"assistantID": assistantID}) # Add the assistant to user assistant List 
-                    for assistant in catalog["assistantList"]: # Update also the "global" assistant List, containing all the assistants
-                        if int(assistant["userID"]) == assistantID:
-                            assistant["assistedPatients"].append({"patientID":int(user["userID"])}) 
-                            break
-                    self.save(catalog)
-                    threadLock.release()
-                    return json.dumps({"found":1})
-                else: 
-                    threadLock.release()
-                    return json.dumps({"found":-1}) # -1 means that the assistant is alredy assisting the user
-
-        threadLock.release()
-        if found == False:
+        user = state.patients.get(state.userNames.get(username)) # The username could also belong to an assistant: in that case it is not found among the patients
+        if user == None or user["password"] != password:
+            self.abort()
             return json.dumps({"found":0})
-
-    def getAssistantChatID(self,userID): # Get the assistants chatID, given userID. Used by assistantBot to know who to send notifications to. 
-        
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        found = False
-        for user in catalog["patientList"]:
-            if user["userID"] ==  int(userID):
-                found = True 
-                chatIDs= [] # There can be more than one assistants
-                # Now we have to return the chatID of each assistant 
-                for assistantObject in user["assistants"]: 
-                    assistantID = assistantObject["assistantID"] # Get every assistant following the patient
-                    for assistant in catalog["assistantList"]:
-                        if int(assistantID) == int(assistant["userID"]):
-                            chatIDs.append(assistant["chatID"])
-                            break
-                return json.dumps({"chatID":chatIDs}) 
-                    
-        if found == False: # For coherence, we return an empty list if the user was not found
+        if assistantID in state.patientAssistants.get(int(user["userID"]), ()): # Check if it is not already assiting
+            self.abort()
+            return json.dumps({"found":-1}) # -1 means that the assistant is alredy assisting the user
+        user = dict(user)
+        user["assistants"] = user["assistants"] + [{"assistantID": assistantID}] # Add the assistant to user assistant List
+        state.putPatient(user)
+        assistant = state.assistants.get(assistantID) # Update also the "global" assistant List, containing all the assistants
+        if assistant != None:
+            assistant = dict(assistant)
+            assistant["assistedPatients"] = assistant["assistedPatients"] + [{"patientID":int(user["userID"])}]
+            state.putAssistant(assistant)
+        self.commit(state)
+        return json.dumps({"found":1})
+
+    def getAssistantChatID(self,userID): # Get the assistants chatID, given userID. Used by assistantBot to know who to send notifications to.
+
+        state = self.state
+        user = state.patients.get(int(userID))
+        if user == None: # For coherence, we return an empty list if the user was not found
             return json.dumps({"chatID":[]})
+        chatIDs= [] # There can be more than one assistants
+        # Now we have to return the chatID of each assistant
+        for assistantObject in user["assistants"]:
+            assistant = state.assistants.get(int(assistantObject["assistantID"])) # Get every assistant following the patient
+            if assistant != None:
+                chatIDs.append(assistant["chatID"])
+        return json.dumps({"chatID":chatIDs})
 
     def getAssistedPatients(self, assistantID): # Return a list of assisted patients currently followed by assistant with assistantID. Used by assistantTelegramBot
-        
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        for assistant in catalog["assistantList"]:
-            if assistant["userID"] == int(assistantID):
-                patients = [] # An assistant can follow more than one patient 
-                for assistedPatientObject in assistant["assistedPatients"]:
-                    assistedPatientID = assistedPatientObject["patientID"] # Get every patient that is being followed 
-                    for patient in catalog["patientList"]:
-                        if int(patient["userID"]) == int(assistedPatientID):
-                            patients.append({"username":patient["userName"], "userID":int(patient["userID"])})
-                            break
-                return json.dumps({"assistedPatients":patients})
 
-    def getAssistants(self, patientID): # Similar to getAssistantChatID, but instead of chatIDs it returns the username and assistnatID of all assistants following patient with patientID
+        state = self.state
+        assistant = state.assistants.get(int(assistantID))
+        if assistant != None:
+            patients = [] # An assistant can follow more than one patient
+            for assistedPatientObject in assistant["assistedPatients"]:
+                patient = state.patients.get(int(assistedPatientObject["patientID"])) # Get every patient that is being followed
+                if patient != None:
+                    patients.append({"username":patient["userName"], "userID":int(patient["userID"])})
+            return json.dumps({"assistedPatients":patients})
 
-        threadLock.acquire()
-        catalog=self.read()
-        threadLock.release()
-        for patient in catalog["patientList"]:
-            if patient["userID"] == int(patientID):
-                assistantsToSend = []
-                for assistantObject in patient["assistants"]:
-                    assistantID = assistantObject["assistantID"]
-                    for assistant in catalog["assistantList"]:
-                        if int(assistant["userID"]) == int(assistantID):
-                            assistantsToSend.append({"username":assistant["userName"], "userID":int(assistant["userID"])})
-                            break
-                return json.dumps({"assistants":assistantsToSend})
+    def getAssistants(self, patientID): # Similar to getAssistantChatID, but instead of chatIDs it returns the username and assistnatID of all assistants following patient with patientID
 
+        state = self.state
+        patient = state.patients.get(int(patientID))
+        if patient != None:
+            assistantsToSend = []
+            for assistantObject in patient["assistants"]:
+                assistant = state.assistants.get(int(assistantObject["assistantID"]))
+                if assistant != None:
+                    assistantsToSend.append({"username":assistant["userName"], "userID":int(assistant["userID"])})
+            return json.dumps({"assistants":assistantsToSend})
+
+    @modification
     def dissociatePatient(self,assistantID, patientID): # Stop following a patient. Used by the assistantBot.
-        
-        threadLock.acquire()
-        catalog=self.read()
-        for assistant in catalog["assistantList"]:
-            if int(assistant["userID"]) == int(assistantID):
-                assistant["assistedPatients"].remove({"patientID": int(patientID)}) # Remove the patient for the assistants assistedPatients list
-        for patient in catalog["patientList"]:
-            if int(patient["userID"]) == int(patientID):
-                patient["assistants"].remove({"assistantID": int(assistantID)}) # Remove the assistant for the patients assistants list
-        self.save(catalog)
-        threadLock.release()
+
+        state = self.begin()
+        assistant = state.assistants.get(int(assistantID))
+        if int(patientID) in state.assistantPatients.get(int(assistantID), ()):
+            assistant = dict(assistant)
+            assistant["assistedPatients"] = [item for item in assistant["assistedPatients"] if int(item["patientID"]) != int(patientID)] # Remove the patient for the assistants assistedPatients list
+            state.putAssistant(assistant)
+        patient = state.patients.get(int(patientID))
+        if int(assistantID) in state.patientAssistants.get(int(patientID), ()):
+            patient = dict(patient)
+            patient["assistants"] = [item for item in patient["assistants"] if int(item["assistantID"]) != int(assistantID)] # Remove the assistant for the patients assistants list
+            state.putPatient(patient)
+        self.commit(state)
         return json.dumps({"deleted":1})
- 
+
+    @modification
     def changePassword(self, userID, json_data): # Change the password of a patient. Used by TelegramBot
-        
-        threadLock.acquire()
-        catalog = self.read()
-        newPassoword = json_data["password"]
-        for user in catalog["patientList"]:
-            if int(user["userID"]) == int(userID):
-                user["password"] = newPassoword
-                self.save(catalog)
-                threadLock.release()
-                return json.dumps({"added":1})
-        threadLock.release()
+
+        state = self.begin()
+        user = state.patients.get(int(userID))
+        if user != None:
+            user = dict(user)
+            user["password"] = json_data["password"]
+            state.putPatient(user)
+            self.commit(state)
+            return json.dumps({"added":1})
+        self.abort()
 
     def getThingSpeakChannel(self, userID, deviceID): # Return ThingSpeak channel. Used by Telegram to know where to find the correct charts
-                
-        threadLock.acquire()
-        catalog = self.read()
-        threadLock.release()
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        return json.dumps({"channel":device["thingSpeakChannel"]})
+
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            return json.dumps({"channel":device["thingSpeakChannel"]})
 
     def getConf(self): # Return the configuration of the whole system. Used by every microservice.
-        
-        threadLock.acquire()
-        catalog = self.read()
-        threadLock.release()
-        return json.dumps({"baseTopic":catalog["baseTopic"], "broker":catalog["broker"], "port": catalog["port"], "token": catalog["token"], "apiKeyWrite": catalog["apiKeyWrite"], "assistant-token": catalog["assistant-token"]})
 
-    def getNumSlots(self, userID, deviceID): # Return the number of slots 
+        catalog = self.state.data
+        return json.dumps({"baseTopic":catalog["baseTopic"], "broker":catalog["broker"], "port": catalog["port"], "token": catalog["token"], "apiKeyWrite": catalog["apiKeyWrite"], "assistant-token": catalog["assistant-token"], "presence": catalog.get("presence", presenceMode), "actuation": catalog.get("actuation", actuationMode)})
 
-        threadLock.acquire()
-        catalog = self.read()
-        threadLock.release()
-        for user in catalog["patientList"]:
-            if int(userID) == int(user["userID"]):
-                for device in user["devices"]:
-                    if deviceID == str(device["deviceID"]):
-                        return json.dumps({"numSlots":device["numSlots"]})
+    def getNumSlots(self, userID, deviceID): # Return the number of slots
 
-    def getAllThresholds(self): # Return all temperature and humidity thresholds for every device of the system. Used by the conservationControl, that retrieves this info continuously
+        device = self.state.findDevice(userID, deviceID)
+        if device != None:
+            return json.dumps({"numSlots":device["numSlots"]})
 
-        threadLock.acquire()
-        catalog = self.read()
-        threadLock.release()
-        result = []
+    def getAllThresholds(self): # Return all temperature and humidity thresholds for every device of the system. Used by the conservationControl, that retrieves this info continuously
 
-        for user in catalog["patientList"]:
-            for device in user["devices"]:
-                result.append({"deviceID":device["deviceID"], "tempUpperThresh":device["tempUpperThresh"], "tempLowerThresh":device["tempLowerThresh"], "humUpperThresh":device["humUpperThresh"], "humLowerThresh":device["humLowerThresh"]})
+        result = []
+        for device in self.state.devices.values():
+            result.append({"deviceID":device["deviceID"], "tempUpperThresh":device["tempUpperThresh"], "tempLowerThresh":device["tempLowerThresh"], "humUpperThresh":device["humUpperThresh"], "humLowerThresh":device["humLowerThresh"]})
 
         return {"thresholds": result}
 
     # Service catalog: every service pings continuously the catalog, to say it is alive, and retrieves the data it needs. Differen services have different answers to the ping message
     def servicePing(self, serviceName):
 
-        threadLock.acquire()
-        catalog = self.read()
-        # Find if the service exists already
-        for element in catalog["aliveServices"]:
-            if element["service"] == serviceName: # If it exists, just update it
-                element["lastSeen"] = time.time()
-                self.save(catalog)
-                threadLock.release()
-                # Return the required information to every service
-                if serviceName == "openingControl":
-                    return json.dumps({"times" : catalog["times"]})
-                elif serviceName == "conservationControl":
-                    return json.dumps(self.getAllThresholds())
-                elif serviceName == "pillDifference":
-                    return json.dumps({"pillCount" : catalog["pillCount"]})
-                else:
-                    return json.dumps({})
-        
-        # If the service is not in the aliveServices list, add it
-        catalog["aliveServices"].append({"service": serviceName, "lastSeen": time.time()})
-        self.save(catalog)
-        threadLock.release()
-        # Return the required information to every service
+        self.services.ping(serviceName) # Only the in-memory registry is updated: the catalog is not modified, so nothing is written on disk
+        catalog = self.state.data
+
+        # Return the required information to every service. The answer is the same for the first ping, that comes again after every restart of the catalog and every expiry of the service, since the registry is kept only in memory
         if serviceName == "openingControl":
-            return json.dumps(catalog["times"])
+            return json.dumps({"times" : catalog["times"]})
         elif serviceName == "conservationControl":
-            return json.dumps(self.getAllThresholds())
+            return self.cache.get("getAllThresholds", (), self.getETag(["patients"]), lambda: json.dumps(self.getAllThresholds()))
         elif serviceName == "pillDifference":
-            return json.dumps(catalog["pillCount"])
+            return json.dumps({"pillCount" : catalog["pillCount"]})
         else:
             return json.dumps({})
 
+    @modification
     def addOpeningTime(self, stats): # Add a record to the "times" list, recording an opening time for a device. Used by the openingControl, that is listening to the opening to every device
 
-        threadLock.acquire()
-        catalog = self.read()
-        catalog["times"].append(stats)
-        self.save(catalog)
-        threadLock.release()
+        state = self.begin()
+        state.setData("times", state.data["times"] + [stats])
+        self.commit(state)
         return json.dumps({"success":1})
 
-    def deleteOpeningTime(self, patientID, deviceID): # Remove the record of the opening time, since the device was closed. Used by the OpeningControl
+    @modification
+    def deleteOpeningTime(self, patientID, deviceID): # Remove the record of the opening time, since the device was closed. Used by the OpeningControl
 
-        threadLock.acquire()
-        catalog = self.read()
-        for item in catalog["times"]: 
-            if item["patientID/deviceID"]==(patientID+"/"+deviceID): 
-                catalog["times"].remove(item)
+        state = self.begin()
+        for item in state.data["times"]:
+            if item["patientID/deviceID"]==(patientID+"/"+deviceID):
+                times = list(state.data["times"])
+                times.remove(item)
+                state.setData("times", times)
                 break
-        self.save(catalog)
-        threadLock.release()
+        self.commit(state)
         return json.dumps({"success":1})
 
-    def addOpeningPills(self, stats): # Add to the pillCount list a record containing the number of pills in every slot when the device was opened. Used by the PillDifferenceCalculator
+    @modification
+    def addOpeningPills(self, stats): # Add to the pillCount list a record containing the number of pills in every slot when the device was opened. Used by the PillDifferenceCalculator
 
-        threadLock.acquire()
-        catalog = self.read()
-        catalog["pillCount"].append(stats)
-        self.save(catalog)
-        threadLock.release()
+        state = self.begin()
+        state.setData("pillCount", state.data["pillCount"] + [stats])
+        self.commit(state)
         return json.dumps({"success":1})
 
+    @modification
     def deleteOpeningPills(self, patientID, deviceID): # Return a record of the opening number of pills and delete it from the list. Used by pillDifferenceCalculator, to... well, to calculate the difference of pills.
 
-        threadLock.acquire()
-        catalog = self.read()
-        for item in catalog["pillCount"]: 
-            if item["patientID/deviceID"]==(patientID+"/"+deviceID): 
+        state = self.begin()
+        for item in state.data["pillCount"]:
+            if item["patientID/deviceID"]==(patientID+"/"+deviceID):
                 print("Deleted", item)
-                catalog["pillCount"].remove(item)
-                self.save(catalog)
-                threadLock.release()
+                pillCount = list(state.data["pillCount"])
+                pillCount.remove(item)
+                state.setData("pillCount", pillCount)
+                self.commit(state)
                 return json.dumps({"countOpened":item["countOpened"]})
+        self.abort()
+
+
+class CatalogReplica(Catalog): # Copy of the catalog kept by a worker process. The main process is the only writer: the worker reads the database and replays the modifications written by the main process
+
+    def __init__(self, store):
+        Catalog.__init__(self, store, None)
+
+    def start(self):
+
+        ReplicaThread(self).start()
+
+    def close(self):
+
+        self.store.close()
+
+    def begin(self):
+
+        raise RuntimeError("The worker processes never modify the catalog")
+
+    def refresh(self): # Replay the modifications committed by the main process since the last refresh. Cheap when there are none
+
+        if not self.store.modified():
+            return
+        threadLock.acquire()
+        modifications = self.store.poll(self.state.data.get("version", 0))
+        if modifications == None: # Too far behind: read again the whole catalog. The "changes" requests are answered with a reset
+            catalog, records = self.store.load()
+            state = CatalogState(catalog)
+            for modification in records:
+                state.apply(modification)
+            state.changed = {}
+            state.startVersion = state.data.get("version", 0)
+            self.publish(state)
+            self.changeLog.clear()
+            print("\n[", time.ctime(), "] - Worker", os.getpid(), "read again the whole catalog, at version", state.startVersion)
+        else:
+            for records in modifications:
+                state = self.state.copy()
+                state.apply(records)
+                state.markVersion()
+                self.publish(state)
         threadLock.release()
-        
+
+class ChangePublisher(): # Publish the modifications of the catalog on baseTopic/catalog/<table>/<key> (ex. smartCase/catalog/devices/5/8), so that the services can update their copy without polling. It also follows the presence topics of the services
+
+    def __init__(self, clientID, broker, port, baseTopic, services):
+        self.client = MyMQTT(clientID, broker, port, self)
+        self.baseTopic = baseTopic
+        self.services = services # ServiceRegistry updated with the presence of the services
+        self.offline = False # True while the events are not published, since the broker is not reachable
+
+    def start(self): # Connect in background: the catalog works also when the broker is not reachable, only without the events
+        self.client.startAsync()
+        self.client.mySubscribe(self.baseTopic + "/presence/+") # Retained: the status of every service is received as soon as the catalog connects. Subscribed again at every connection
+        print("\n[", time.ctime(), "] - Catalog modifications published on", self.baseTopic + "/catalog/#", "as soon as the broker is reachable")
+
+    def stop(self):
+        self.client.stop()
+
+    def notify(self, topic, payload): # Status of a service: {"status": "online"} when it connects, {"status": "offline"} when it stops or its connection is lost
+
+        if len(payload) == 0: # Retained status removed from the broker
+            return
+        self.services.setPresence(topic.split("/")[-1], json.loads(payload)["status"] == "online")
+
+    def publishChanges(self, version, changes): # One event for every modified entity: {"version": version of the modification, "value": new value, null if the entity was removed}
+
+        if not self.client.connected: # Not queued: the services read the modifications they missed from the "changes" request, when their connection to the broker is established again (RESYNC)
+            if not self.offline:
+                print("\n[", time.ctime(), "] - Broker not reachable: catalog modifications not published until it connects")
+            self.offline = True
+            return
+        if self.offline:
+            print("\n[", time.ctime(), "] - Broker reachable: catalog modifications published again on", self.baseTopic + "/catalog/#")
+            self.offline = False
+        for table in publishedTables:
+            for key, value in changes.get(table, {}).items():
+                self.client.myPublish(self.baseTopic + "/catalog/" + table + "/" + str(key), {"version": version, "value": value})
+
+class ResponseCache(object): # Answers already encoded, for every request and its arguments. An answer is valid as long as the ETag of the sections it is built from does not change, so nothing has to be invalidated explicitly
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = {} # (request, arguments): (ETag, encoded answer)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, request, arguments, etag, build): # Return the encoded answer, calling build() only if the cached one is older than etag. etag must be taken before the answer is built, so that the answer is never older than its ETag
+
+        self.lock.acquire()
+        entry = self.entries.get((request, arguments))
+        if entry != None and entry[0] == etag:
+            self.hits += 1
+            self.lock.release()
+            return entry[1]
+        self.misses += 1
+        self.lock.release()
+        answer = build().encode() # Built outside the lock, since it can take a while for the whole catalog
+        self.lock.acquire()
+        if len(self.entries) >= self.size and (request, arguments) not in self.entries: # Too many arguments were seen: start again
+            self.entries = {}
+        self.entries[(request, arguments)] = (etag, answer)
+        self.lock.release()
+        return answer
+
+    def stats(self):
+
+        self.lock.acquire()
+        stats = {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+        self.lock.release()
+        return stats
+
+class ServiceRegistry(object): # Services that pinged the catalog in the last timeout seconds. The deadlines are kept in a min-heap, so the expired services are found without scanning all of them
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.lastSeen = {} # service: time of the last ping
+        self.deadlines = [] # Heap of (deadline, service). A ping does not remove the old entry of the service: it is discarded when it reaches the top
+        self.version = 0 # Increased every time a service joins or leaves
+        self.present = set() # Services that published "online" on their presence topic. They do not expire: the broker publishes their "offline" Last Will if the connection is lost
+        self.lock = threading.Lock()
+
+    def ping(self, service): # Register a ping. Return True if the service was already alive
+
+        self.lock.acquire()
+        now = time.time()
+        found = service in self.lastSeen
+        if not found:
+            self.version += 1
+        self.lastSeen[service] = now
+        heapq.heappush(self.deadlines, (now + self.timeout, service))
+        self.lock.release()
+        return found
+
+    def expire(self): # Remove the services that did not ping in time. Return the seconds until the next deadline
+
+        self.lock.acquire()
+        now = time.time()
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            deadline, service = heapq.heappop(self.deadlines)
+            if service in self.lastSeen and service not in self.present and self.lastSeen[service] + self.timeout <= now: # Otherwise the service pinged after this entry was added
+                del self.lastSeen[service]
+                self.version += 1
+                print("\n[", time.ctime(), "] - Service", service, "is not reachable. Removed from active services.\n")
+        wait = self.deadlines[0][0] - now if len(self.deadlines) > 0 else self.timeout
+        self.lock.release()
+        return wait
+
+    def setPresence(self, service, online): # Status published by the service on its presence topic
+
+        self.lock.acquire()
+        if online:
+            if service not in self.lastSeen:
+                self.version += 1
+                print("\n[", time.ctime(), "] - Service", service, "is online.")
+            self.present.add(service)
+            self.lastSeen[service] = time.time()
+        else:
+            self.present.discard(service)
+            if service in self.lastSeen:
+                del self.lastSeen[service]
+                self.version += 1
+                print("\n[", time.ctime(), "] - Service", service, "is offline. Removed from active services.\n")
+        self.lock.release()
+
+    def alive(self): # List of the services that are alive, as in the "aliveServices" list of the catalog
+
+        self.lock.acquire()
+        services = [{"service": service, "lastSeen": lastSeen} for service, lastSeen in self.lastSeen.items()]
+        self.lock.release()
+        return services
+
+class RouteMetrics(object): # Number of requests and histogram of their latency, for every route
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.routes = {} # (method, route): {"buckets": requests for every bucket (the last one for the slower ones), "sum": total seconds, "count": requests, "errors": failed requests}
+        self.lock = threading.Lock()
+
+    def record(self, method, route, seconds, failed):
+
+        self.lock.acquire()
+        metrics = self.routes.get((method, route))
+        if metrics == None:
+            metrics = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0, "errors": 0}
+            self.routes[(method, route)] = metrics
+        metrics["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+        metrics["sum"] += seconds
+        metrics["count"] += 1
+        if failed:
+            metrics["errors"] += 1
+        self.lock.release()
+
+    def quantile(self, buckets, count, q): # Estimate a quantile from the histogram, interpolating inside the bucket that contains it
+
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(buckets):
+            if n > 0 and seen + n >= rank:
+                if i == len(self.buckets): # Slower than the last bucket: its bound is the best we know
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return 0.0
+
+    def export(self, catalog): # All the metrics, in the Prometheus text format
+
+        self.lock.acquire()
+        routes = [(key, {"buckets": list(metrics["buckets"]), "sum": metrics["sum"], "count": metrics["count"], "errors": metrics["errors"]}) for key, metrics in sorted(self.routes.items())]
+        self.lock.release()
+        lines = ["# HELP catalog_request_duration_seconds Time spent answering the requests of the catalog.", "# TYPE catalog_request_duration_seconds histogram"]
+        for (method, route), metrics in routes:
+            labels = 'method="' + method + '",route="' + route + '"'
+            total = 0
+            for bound, n in zip(self.buckets, metrics["buckets"]):
+                total += n
+                lines.append("catalog_request_duration_seconds_bucket{" + labels + ',le="' + str(bound) + '"} ' + str(total))
+            lines.append("catalog_request_duration_seconds_bucket{" + labels + ',le="+Inf"} ' + str(metrics["count"]))
+            lines.append("catalog_request_duration_seconds_sum{" + labels + "} " + repr(metrics["sum"]))
+            lines.append("catalog_request_duration_seconds_count{" + labels + "} " + str(metrics["count"]))
+        lines += ["# HELP catalog_request_duration_quantile_seconds Quantiles of the latency, estimated from the histogram.", "# TYPE catalog_request_duration_quantile_seconds gauge"]
+        for (method, route), metrics in routes:
+            for q in ["0.5", "0.95", "0.99"]:
+                lines.append('catalog_request_duration_quantile_seconds{method="' + method + '",route="' + route + '",quantile="' + q + '"} ' + repr(self.quantile(metrics["buckets"], metrics["count"], float(q))))
+        lines += ["# HELP catalog_request_errors_total Requests that raised an error.", "# TYPE catalog_request_errors_total counter"]
+        for (method, route), metrics in routes:
+            lines.append('catalog_request_errors_total{method="' + method + '",route="' + route + '"} ' + str(metrics["errors"]))
+        stats = catalog.cache.stats()
+        lines += ["# HELP catalog_cache_hits_total Answers served from the response cache.", "# TYPE catalog_cache_hits_total counter", "catalog_cache_hits_total " + str(stats["hits"])]
+        lines += ["# HELP catalog_cache_misses_total Answers built because they were not in the response cache.", "# TYPE catalog_cache_misses_total counter", "catalog_cache_misses_total " + str(stats["misses"])]
+        lines += ["# HELP catalog_version Version of the last modification of the catalog.", "# TYPE catalog_version gauge", "catalog_version " + str(catalog.state.data.get("version", 0))]
+        lines += ["# HELP catalog_alive_services Services that are alive.", "# TYPE catalog_alive_services gauge", "catalog_alive_services " + str(len(catalog.services.alive()))]
+        return "\n".join(lines) + "\n"
+
+class Request(object): # What the WebServer needs to know about a request, and what it sets on the answer. Filled by the HTTP front end (CherryPy or asyncio)
+
+    def __init__(self, params, headers, body, remote):
+        self.params = params # Parameters of the query string
+        self.headers = headers
+        self.body = body # Content of the request, as bytes
+        self.remote = remote # IP address of the client
+        self.status = 200 # Status of the answer
+        self.responseHeaders = {}
+
+class RequestError(Exception): # Request refused before being answered (or a modification aborted because of its arguments). The front end answers with the status and the message
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+# Requests of the REST interface: name -> (method of the WebServer that answers it, types of the arguments that follow the name in the URI). Requests with a different number of arguments, or with arguments of the wrong type, are refused before being answered
+routes = {
+    "GET": {
+        "getCatalog": ("getCatalog", []),
+        "cacheStats": ("cacheStats", []),
+        "metrics": ("metricsText", []),
+        "aliveServices": ("aliveServices", []),
+        "getLU": ("getLU", []),
+        "getSchedule": ("getSchedule", [int, int]),
+        "getSchedules": ("getSchedules", []),
+        "dueAlarms": ("dueAlarms", []),
+        "getDeviceURI": ("getDeviceURI", [int, int]),
+        "getTempThresh": ("getTempThresh", [int, int]),
+        "getHumThresh": ("getHumThresh", [int, int]),
+        "getSlotsNumber": ("getSlotsNumber", [int, int]),
+        "getSlotsName": ("getSlotsName", [int, int]),
+        "getChatID": ("getChatID", [int]),
+        "getDevices": ("getDevices", [int]),
+        "getUserID": ("getUserID", [int]),
+        "profileData": ("profileData", [int]),
+        "getAssistantID": ("getAssistantID", [int]),
+        "getAssistantChatID": ("getAssistantChatID", [int]),
+        "getAssistedPatients": ("getAssistedPatients", [int]),
+        "getAssistants": ("getAssistants", [int]),
+        "thingSpeakChannel": ("thingSpeakChannel", [int, int]),
+        "conf": ("conf", []),
+        "numSlots": ("numSlots", [int, int]),
+        "device": ("device", [int, int]),
+        "changes": ("changes", []),
+        "devices": ("devices", []),
+    },
+    "PUT": {
+        "addUser": ("addUser", []),
+        "addDevice": ("addDevice", [int]),
+        "updateTempThresh": ("updateTempThresh", [int, int]),
+        "updateHumThresh": ("updateHumThresh", [int, int]),
+        "addPill": ("addPill", [int, int, int]),
+        "addSchedule": ("addSchedule", [int, int, int]),
+        "newDevice": ("newDevice", []),
+        "addAssistant": ("addAssistant", []),
+        "assistUser": ("assistUser", []),
+        "changePassword": ("changePassword", [int]),
+        "addChannel": ("addChannel", [int, int]),
+        "ping": ("ping", []),
+        "addOpeningTime": ("addOpeningTime", []),
+        "addOpeningPills": ("addOpeningPills", []),
+    },
+    "DELETE": {
+        "rmvAlarm": ("rmvAlarm", [int, int, int, int]),
+        "rmvDevice": ("rmvDevice", [int, int]),
+        "dissociatePatient": ("dissociatePatient", [int, int]),
+        "rmvOpeningTime": ("rmvOpeningTime", [int, int]),
+        "rmvOpeningPills": ("rmvOpeningPills", [int, int]),
+    },
+}
 
 class WebServer(): # Create the WebServer class
     exposed=True
 
-    def __init__(self):
-        self.catalog = Catalog(filename) # Only propriety is the catalog, in order to access every generated method 
+    def __init__(self, catalog):
+        self.catalog = catalog # Only propriety is the catalog, in order to access every generated method 
+        self.metrics = RouteMetrics(latencyBuckets) # Latency of the requests, for the "metrics" request
+
+    def notModified(self, request, etag): # Add the ETag to the answer. Return True if the client already has this version: the answer is then "304 Not Modified", without body
+
+        request.responseHeaders["ETag"] = etag
+        match = request.headers.get("If-None-Match")
+        if match != None and (match.strip() == "*" or etag in [tag.strip().replace("W/", "") for tag in match.split(",")]):
+            request.status = 304
+            return True
+        return False
 
     def GET(self,*uri,**params):
-        
-        #get the entire catalog
-        if uri[0] == "getCatalog":
-            return (json.dumps(self.catalog.read(), indent = 10))
-        
-        elif uri[0] == "getLU":
 
-            return json.dumps({"LU":self.catalog.read()["lastUpdate"]})
+        return self.answer("GET", uri, params)
 
-        elif uri[0] == "getSchedule":
+    def PUT(self,*uri,**params):
 
-            userID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getSchedule(userID,deviceID)
-        
-        elif uri[0] == "getSchedules":
-            
-            return self.catalog.getSchedules()
+        return self.answer("PUT", uri, params)
 
-        elif uri[0] == "getDeviceURI":
+    def DELETE(self,*uri,**params):
 
-            userID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getDeviceURI(userID,deviceID)
-        
+        return self.answer("DELETE", uri, params)
 
-        elif uri[0] == "getTempThresh":
+    def answer(self, method, uri, params): # Answer a request received by CherryPy
 
-            userID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getTempThresh(userID, deviceID)
+        body = cherrypy.request.body.read() if method == "PUT" else b""
+        request = Request(params, cherrypy.request.headers, body, cherrypy.request.remote.ip)
+        try:
+            answer = self.dispatch(method, uri, request)
+        except RequestError as e:
+            raise cherrypy.HTTPError(e.status, e.message)
+        cherrypy.response.status = request.status
+        cherrypy.response.headers.update(request.responseHeaders)
+        return answer
 
-        elif uri[0] == "getHumThresh":
+    def dispatch(self, method, uri, request): # Find the request in the route table, check its arguments and answer it, measuring how long it takes. Used by both the CherryPy and the asyncio front end
 
-            userID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getHumThresh(userID, deviceID)
-        
-        elif uri[0] == "getSlotsNumber":
-            
-            userID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getSlotsNumber(userID, deviceID)
+        self.check(method, uri)
+        start = time.perf_counter()
+        failed = True
+        try:
+            self.catalog.refresh()
+            answer = getattr(self, routes[method][uri[0]][0])(request, *uri[1:])
+            if method != "GET":
+                self.catalog.sync()
+            failed = False
+            return answer
+        finally:
+            self.metrics.record(method, uri[0], time.perf_counter() - start, failed)
 
-        elif uri[0] == "getSlotsName":
-            
-            userID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getSlotsName(userID, deviceID)
+    def check(self, method, uri): # Raise RequestError if the request is not in the route table, or if its arguments are wrong
 
-        elif uri[0] == "getChatID":
+        if method not in routes or len(uri) == 0 or uri[0] not in routes[method]:
+            raise RequestError(404, "Unknown request")
+        types = routes[method][uri[0]][1]
+        args = uri[1:]
+        if len(args) != len(types):
+            raise RequestError(400, uri[0] + " needs " + str(len(types)) + " arguments")
+        for arg, argType in zip(args, types):
+            try:
+                argType(arg)
+            except ValueError:
+                raise RequestError(400, "Invalid argument " + arg + " for " + uri[0])
 
-            userID=uri[1]
-            return self.catalog.getChatID(userID)
+    # GET requests
 
-        elif uri[0]== "getDevices":
+    def getCatalog(self, request): # Get the entire catalog
 
-            userID=uri[1]
-            return self.catalog.getDevices(userID)
+        etag = self.catalog.getETag()
+        if self.notModified(request, etag):
+            return ""
+        return self.catalog.cache.get("getCatalog", (), etag, lambda: json.dumps(self.catalog.read(), indent = 10))
 
-        elif uri[0]=="getUserID":
+    def cacheStats(self, request): # Hits and misses of the response cache
 
-            chatID=uri[1]
-            return self.catalog.getUserID(chatID)
-        
-        elif uri[0] == "profileData":
+        return json.dumps(self.catalog.cache.stats())
 
-            userID = str(uri[1])
-            return self.catalog.getUserProfileData(userID)
+    def metricsText(self, request): # Number and latency of the requests, in the Prometheus text format
 
-        elif uri[0] == "getAssistantID":
+        request.responseHeaders["Content-Type"] = "text/plain; version=0.0.4"
+        return self.metrics.export(self.catalog)
 
-            chatID = uri[1]
-            return self.catalog.getAssistantID(chatID)
+    def aliveServices(self, request): # Services that pinged the catalog in the last minute
 
-        elif uri[0] == "getAssistantChatID":
+        return json.dumps(self.catalog.services.alive())
 
-            userID=uri[1]
-            return self.catalog.getAssistantChatID(userID)
+    def getLU(self, request): # Version of the last modification of users and devices. It always increases, so services only have to check if it is different
 
-        elif uri[0] == "getAssistedPatients":
+        return json.dumps({"LU":self.catalog.state.sectionVersion(["patients", "assistants", "newDevices"])})
 
-            assistantID = uri[1]
-            return self.catalog.getAssistedPatients(assistantID)
+    def getSchedule(self, request, userID, deviceID):
 
-        elif uri[0] == "getAssistants":
+        return self.catalog.getSchedule(userID,deviceID)
 
-            patientID = uri[1]
-            return self.catalog.getAssistants(patientID)
+    def getSchedules(self, request):
 
-        elif uri[0] == "thingSpeakChannel":
+        etag = self.catalog.getETag(["patients"])
+        if self.notModified(request, etag):
+            return ""
+        return self.catalog.cache.get("getSchedules", (), etag, self.catalog.getSchedules)
 
-            patientID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getThingSpeakChannel(patientID, deviceID)
+    def dueAlarms(self, request): # ex. dueAlarms?from=08:00:00&to=08:05:00. The window goes from "from" included to "to" excluded, and can cross midnight
 
-        elif uri[0] == "conf":
-            
-            return self.catalog.getConf()
+        try:
+            start = daySeconds(request.params["from"])
+            end = daySeconds(request.params["to"])
+        except (KeyError, ValueError):
+            raise RequestError(400, "dueAlarms needs from and to as HH:MM:SS")
+        etag = self.catalog.getETag(["patients"])
+        if self.notModified(request, etag):
+            return ""
+        return self.catalog.getDueAlarms(start, end)
 
-        elif uri[0] == "numSlots":
+    def getDeviceURI(self, request, userID, deviceID):
 
-            patientID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.getNumSlots(patientID, deviceID)
+        return self.catalog.getDeviceURI(userID,deviceID)
 
-    def PUT(self,*uri,**params):
-         
-        if uri[0] == "addUser":
-            
-            body = json.loads(cherrypy.request.body.read())  # Read body data
-            result = self.catalog.addUser(body)
-            self.catalog.updateLU()
-            return(result)
-
-        elif uri[0] == "addDevice":
-            
-            body = json.loads(cherrypy.request.body.read())  # Read body data
-            userID = uri[1]
-            ans = self.catalog.addDevice(body["deviceID"], userID)
-            self.catalog.updateLU()
-            return ans
-
-        elif uri[0] == "updateTempThresh":
-            
-            body = json.loads(cherrypy.request.body.read())
-            userID = uri[1]
-            deviceID = uri[2]
-            self.catalog.updateTempThresh(body, userID, deviceID)
-            self.catalog.updateLU()
-            return json.dumps({"added":1})
+    def getTempThresh(self, request, userID, deviceID):
 
-        elif uri[0] == "updateHumThresh":
-            
-            body = json.loads(cherrypy.request.body.read())
-            userID = uri[1]
-            deviceID = uri[2]
-            self.catalog.updateHumThresh(body, userID, deviceID)
-            self.catalog.updateLU()
-            return json.dumps({"added":1})
+        return self.catalog.getTempThresh(userID, deviceID)
 
-        elif uri[0] == "addPill":
-            
-            body = json.loads(cherrypy.request.body.read())
-            userID = uri[1]
-            deviceID = uri[2]
-            slotNumber = int(uri[3])
-            self.catalog.addPill(body, userID, deviceID, slotNumber)
-            self.catalog.updateLU()
-            return json.dumps({"added":1})
+    def getHumThresh(self, request, userID, deviceID):
 
-        elif uri[0] == "addSchedule":
+        return self.catalog.getHumThresh(userID, deviceID)
 
-            body = json.loads(cherrypy.request.body.read())
-            userID = uri[1]
-            deviceID = uri[2]
-            slotNumber = int(uri[3])
-            self.catalog.addSchedule(body, userID, deviceID, slotNumber)
-            self.catalog.updateLU()
-            return json.dumps({"added":1})
+    def getSlotsNumber(self, request, userID, deviceID):
 
-        elif uri[0] == "newDevice":
-            
-            deviceID = self.catalog.newDevice()
-            self.catalog.updateLU()
-            return(json.dumps({"deviceID":deviceID}))
-
-        elif uri[0] == "addAssistant":
-
-            body = json.loads(cherrypy.request.body.read())
-            return self.catalog.addAssistant(body)
-        
-        elif uri[0] == "assistUser":
-
-            body = json.loads(cherrypy.request.body.read())
-            return self.catalog.assistUser(body)
-
-        elif uri[0] == "changePassword":
-
-            body = json.loads(cherrypy.request.body.read())
-            userID = uri[1]
-            return self.catalog.changePassword(userID, body)
-        
-        elif uri[0] == "addChannel":
-
-            body = json.loads(cherrypy.request.body.read())
-            userID = uri[1]
-            deviceID = uri[2]
-            body = body['channel']
-            ret = self.catalog.updateChannel(body, userID, deviceID)
-            self.catalog.updateLU()
-            return ret        
-        
-        elif uri[0] == "ping":
-
-            service = json.loads(cherrypy.request.body.read())["service"]
-            return self.catalog.servicePing(service)
-
-        elif uri[0] == "addOpeningTime":
-
-            body = json.loads(cherrypy.request.body.read())
-            return self.catalog.addOpeningTime(body)    
-        
-        elif uri[0] == "addOpeningPills":
-
-            body = json.loads(cherrypy.request.body.read())
-            return self.catalog.addOpeningPills(body)    
-        
-    
-    def DELETE(self,*uri,**params):
-        
-        if uri[0] == "rmvAlarm":
+        return self.catalog.getSlotsNumber(userID, deviceID)
+
+    def getSlotsName(self, request, userID, deviceID):
+
+        return self.catalog.getSlotsName(userID, deviceID)
+
+    def getChatID(self, request, userID):
+
+        return self.catalog.getChatID(userID)
+
+    def getDevices(self, request, userID):
+
+        return self.catalog.getDevices(userID)
+
+    def getUserID(self, request, chatID):
+
+        return self.catalog.getUserID(chatID)
+
+    def profileData(self, request, userID):
+
+        return self.catalog.getUserProfileData(str(userID))
+
+    def getAssistantID(self, request, chatID):
+
+        return self.catalog.getAssistantID(chatID)
+
+    def getAssistantChatID(self, request, userID):
+
+        return self.catalog.getAssistantChatID(userID)
+
+    def getAssistedPatients(self, request, assistantID):
+
+        return self.catalog.getAssistedPatients(assistantID)
+
+    def getAssistants(self, request, patientID):
+
+        return self.catalog.getAssistants(patientID)
+
+    def thingSpeakChannel(self, request, patientID, deviceID):
+
+        return self.catalog.getThingSpeakChannel(patientID, deviceID)
+
+    def conf(self, request):
 
-            userID = uri[1]
-            deviceID = uri[2]
-            slotNum = int(uri[3])
-            alarmNum = int(uri[4])
-            self.catalog.deleteAlarm(userID, deviceID, slotNum, alarmNum)
-            self.catalog.updateLU()
+        return self.catalog.cache.get("conf", (), self.catalog.getETag(confKeys), self.catalog.getConf)
 
-        elif uri[0] == "rmvDevice":
+    def numSlots(self, request, patientID, deviceID):
 
-            userID = uri[1]
-            deviceID = uri[2]
-            self.catalog.deleteDevice(userID, deviceID)
+        return self.catalog.getNumSlots(patientID, deviceID)
 
-        elif uri[0] == "dissociatePatient":
+    def device(self, request, userID, deviceID): # ex. device/5/8?fields=chatID,slotsName. Without fields, all of them are returned
 
-            assistantID = uri[1]
-            patientID = uri[2]
-            self.catalog.dissociatePatient(assistantID, patientID)
-        
-        elif uri[0] == "rmvOpeningTime":
+        if "fields" in request.params:
+            return self.catalog.getDevice(userID, deviceID, request.params["fields"].split(","))
+        return self.catalog.getDevice(userID, deviceID)
 
-            patientID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.deleteOpeningTime(patientID, deviceID)
-        
-        elif uri[0] == "rmvOpeningPills":
+    def changes(self, request): # ex. changes?since=25&timeout=5&tables=devices. Without since, only the current version is returned
 
-            patientID = uri[1]
-            deviceID = uri[2]
-            return self.catalog.deleteOpeningPills(patientID, deviceID)
+        since, timeout, tables = self.changesParams(request)
+        return self.catalog.getChanges(since, timeout, tables)
+
+    def changesParams(self, request): # since (None if not given), timeout and tables (None for all of them) of a "changes" request. Used also by the asyncio front end, before waiting
+
+        try:
+            since = int(request.params["since"]) if "since" in request.params else None
+            timeout = float(request.params.get("timeout", 0))
+            if timeout != timeout: # NaN would never expire
+                raise ValueError
+        except ValueError:
+            raise RequestError(400, "changes needs since as an integer and timeout as a number of seconds")
+        tables = None
+        if "tables" in request.params:
+            tables = request.params["tables"].split(",")
+        return since, timeout, tables
+
+    def devices(self, request): # ex. devices?keys=5/8,7/9&fields=numSlots
+
+        keys = [key for key in request.params.get("keys", "").split(",") if key != ""]
+        if "fields" in request.params:
+            return self.catalog.getDeviceList(keys, request.params["fields"].split(","))
+        return self.catalog.getDeviceList(keys)
+
+    # PUT requests
+
+    def addUser(self, request):
+
+        body = json.loads(request.body)  # Read body data
+        result = self.catalog.addUser(body)
+        return(result)
+
+    def addDevice(self, request, userID):
+
+        body = json.loads(request.body)  # Read body data
+        ans = self.catalog.addDevice(body["deviceID"], userID)
+        return ans
+
+    def updateTempThresh(self, request, userID, deviceID):
+
+        body = json.loads(request.body)
+        self.catalog.updateTempThresh(body, userID, deviceID)
+        return json.dumps({"added":1})
+
+    def updateHumThresh(self, request, userID, deviceID):
+
+        body = json.loads(request.body)
+        self.catalog.updateHumThresh(body, userID, deviceID)
+        return json.dumps({"added":1})
+
+    def addPill(self, request, userID, deviceID, slotNumber):
+
+        body = json.loads(request.body)
+        self.catalog.addPill(body, userID, deviceID, int(slotNumber))
+        return json.dumps({"added":1})
+
+    def addSchedule(self, request, userID, deviceID, slotNumber):
+
+        body = json.loads(request.body)
+        self.catalog.addSchedule(body, userID, deviceID, int(slotNumber))
+        return json.dumps({"added":1})
+
+    def newDevice(self, request):
+
+        deviceID = self.catalog.newDevice(json.loads(request.body), request.remote)
+        return(json.dumps({"deviceID":deviceID}))
+
+    def addAssistant(self, request):
+
+        body = json.loads(request.body)
+        return self.catalog.addAssistant(body)
+
+    def assistUser(self, request):
+
+        body = json.loads(request.body)
+        return self.catalog.assistUser(body)
+
+    def changePassword(self, request, userID):
+
+        body = json.loads(request.body)
+        return self.catalog.changePassword(userID, body)
+
+    def addChannel(self, request, userID, deviceID):
+
+        body = json.loads(request.body)
+        body = body['channel']
+        ret = self.catalog.updateChannel(body, userID, deviceID)
+        return ret
+
+    def ping(self, request):
+
+        service = json.loads(request.body)["service"]
+        if service in pingSections:
+            etag = self.catalog.getETag(pingSections[service]) # Taken before the answer is built, so that the answer is never older than its ETag
+            answer = self.catalog.servicePing(service) # The ping is always registered, even if the answer is not sent
+            if self.notModified(request, etag):
+                return ""
+            return answer
+        return self.catalog.servicePing(service)
+
+    def addOpeningTime(self, request):
+
+        body = json.loads(request.body)
+        return self.catalog.addOpeningTime(body)
+
+    def addOpeningPills(self, request):
+
+        body = json.loads(request.body)
+        return self.catalog.addOpeningPills(body)
+
+    # DELETE requests
+
+    def rmvAlarm(self, request, userID, deviceID, slotNum, alarmNum):
+
+        self.catalog.deleteAlarm(userID, deviceID, int(slotNum), int(alarmNum))
+
+    def rmvDevice(self, request, userID, deviceID):
+
+        self.catalog.deleteDevice(userID, deviceID)
+
+    def dissociatePatient(self, request, assistantID, patientID):
+
+        self.catalog.dissociatePatient(assistantID, patientID)
+
+    def rmvOpeningTime(self, request, patientID, deviceID):
+
+        return self.catalog.deleteOpeningTime(patientID, deviceID)
+
+    def rmvOpeningPills(self, request, patientID, deviceID):
+
+        return self.catalog.deleteOpeningPills(patientID, deviceID)
 
 # Thread for the REST interface of the catalog, to run the WebServer
 class RESTCatalogThread(threading.Thread):
 
-    def __init__(self):
+    def __init__(self, catalog, port):
         threading.Thread.__init__(self)
+        self.catalog = catalog
+        self.port = port
     
     def run(self):
         conf={
@@ -908,33 +1673,197 @@ class RESTCatalogThread(threading.Thread):
                 'tool.session.on':True
             }
         }
-        cherrypy.config.update({'server.socket_port':8080})
-        cherrypy.quickstart(WebServer(),'/',conf)
+        cherrypy.config.update({'server.socket_port':self.port, 'server.thread_pool':30}) # More threads than the default, since the "changes" requests can wait for a while
+        cherrypy.engine.subscribe('stop', self.catalog.close) # Do not lose the last mutations when the server is stopped
+        cherrypy.quickstart(WebServer(self.catalog),'/',conf)
         cherrypy.engine.start()
         cherrypy.engine.block()  
 
+# asyncio front end of the catalog, used instead of RESTCatalogThread when "catalogServer" is "asyncio". Every connection costs a coroutine instead of a thread:
+# the requests are answered by a small pool of threads with the same WebServer, while the "changes" requests wait for a modification without holding any thread.
+# It is also the front end of the worker processes: they all listen on the same port (SO_REUSEPORT), and forward to the main process the requests that modify the catalog
+class AsyncCatalogServer(object):
+
+    def __init__(self, catalog, threads, port, host=None, primary=None):
+        self.catalog = catalog
+        self.webServer = WebServer(catalog)
+        self.threads = threads
+        self.port = port
+        self.host = host # None: all the interfaces
+        self.primary = primary # URL of the main process, for the worker processes. None in the main process
+        self.session = None # Connections to the main process, kept open between the forwarded requests
+
+    def run(self): # Serve the requests until the catalog is stopped
+
+        from aiohttp import web # Needed only by this front end
+        self.web = web
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self.changed = asyncio.Event() # Set (and replaced) at every modification of the catalog
+        self.catalog.changeListeners.append(lambda: self.loop.call_soon_threadsafe(self.wake))
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        self.loop.run_until_complete(web.TCPSite(runner, self.host, self.port, backlog=1024, reuse_port=self.primary != None).start())
+        self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+        print("\n[", time.ctime(), "] - Catalog served by the asyncio front end on port", self.port, "with", self.threads, "threads, process", os.getpid())
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.session != None:
+                self.loop.run_until_complete(self.session.close())
+            self.loop.run_until_complete(runner.cleanup())
+            self.executor.shutdown()
+            self.catalog.close() # Do not lose the last mutations when the server is stopped
+
+    def wake(self): # A modification was published: wake up the "changes" requests that are waiting. Runs in the event loop
+
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def handle(self, httpRequest):
+
+        uri = tuple([part for part in httpRequest.path.split("/") if part != ""]) # Same arguments CherryPy gives to the WebServer
+        request = Request(dict(httpRequest.query), httpRequest.headers, await httpRequest.read(), httpRequest.remote)
+        try:
+            self.webServer.check(httpRequest.method, uri)
+            if self.primary != None and (httpRequest.method != "GET" or uri[0] in primaryRoutes):
+                return await self.forward(httpRequest, request.body)
+            if httpRequest.method == "GET" and uri[0] == "changes":
+                await self.waitChanges(request)
+            answer = await self.loop.run_in_executor(self.executor, self.webServer.dispatch, httpRequest.method, uri, request)
+        except RequestError as e:
+            return self.web.Response(status=e.status, text=e.message)
+        headers = {"Content-Type": "text/html;charset=utf-8"} # Same default of CherryPy
+        headers.update(request.responseHeaders)
+        if answer == None:
+            answer = b""
+        elif isinstance(answer, str):
+            answer = answer.encode()
+        return self.web.Response(status=request.status, body=answer, headers=headers)
+
+    async def forward(self, httpRequest, body): # Let the main process answer the request. A modification is answered once it is on disk, and this worker replays it before answering, so the client sees it in its next request
+
+        if self.session == None:
+            from aiohttp import ClientSession, ClientTimeout
+            self.session = ClientSession(timeout=ClientTimeout(total=maxLongPoll + 30))
+        headers = dict([(key, value) for key, value in httpRequest.headers.items() if key in ["Content-Type", "If-None-Match"]])
+        try:
+            async with self.session.request(httpRequest.method, self.primary + httpRequest.path_qs, data=body, headers=headers) as response:
+                answer = await response.read()
+                status = response.status
+                headers = dict([(key, value) for key, value in response.headers.items() if key in ["Content-Type", "ETag"]])
+        except Exception as e:
+            print("\n[", time.ctime(), "] - Main process not reachable:", e.__class__.__name__)
+            return self.web.Response(status=503, text="Catalog not available")
+        if httpRequest.method != "GET":
+            await self.loop.run_in_executor(self.executor, self.catalog.refresh)
+        return self.web.Response(status=status, body=answer, headers=headers)
+
+    async def waitChanges(self, request): # Wait until the "changes" request can be answered, then let the WebServer answer it without waiting
+
+        since, timeout, tables = self.webServer.changesParams(request) # A wrong argument is refused before waiting
+        if since == None:
+            return
+        deadline = self.loop.time() + min(timeout, maxLongPoll)
+        while True:
+            changed = self.changed # Taken before checking, so a modification published in the meantime is not missed
+            remaining = deadline - self.loop.time()
+            if self.catalog.hasChanges(since, tables) or remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        request.params = dict(request.params, timeout=0)
+
+# Thread of a worker process that follows the modifications written by the main process, so that the "changes" requests are woken up even if no other request arrives.
+# The worker stops when the main process is not running any more
+class ReplicaThread(threading.Thread):
+
+    def __init__(self, catalog):
+        threading.Thread.__init__(self)
+        self.catalog = catalog
+        self.daemon = True
+        self.parent = os.getppid()
+
+    def run(self):
+        while os.getppid() == self.parent:
+            self.catalog.refresh()
+            time.sleep(replicaPoll)
+        print("\n[", time.ctime(), "] - Main process stopped, worker", os.getpid(), "stops too")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+# Thread of the main process that starts the worker processes, and starts them again if they stop
+class WorkerSupervisor(threading.Thread):
+
+    def __init__(self, count):
+        threading.Thread.__init__(self)
+        self.count = count
+        self.workers = []
+        self.daemon = True # The workers stop by themselves when the main process stops
+
+    def spawn(self):
+
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker"])
+
+    def run(self):
+        self.workers = [self.spawn() for i in range(self.count)]
+        while True:
+            time.sleep(1)
+            for i, worker in enumerate(self.workers):
+                if worker.poll() != None:
+                    print("\n[", time.ctime(), "] - Worker", worker.pid, "stopped with code", worker.returncode, "- starting it again")
+                    self.workers[i] = self.spawn()
+
 # Thread for the service "cleaner", that removes services that didn't ping for too much time
 class ServiceCatalogCheck(threading.Thread):
 
-    def __init__(self):
+    def __init__(self, catalog):
         threading.Thread.__init__(self)
+        self.catalog = catalog
     
     def run(self):
         while True:
-            threadLock.acquire()
-            cat = json.load(open(filename))
-            for service in cat["aliveServices"]:
-                if time.time() - service["lastSeen"] > 60: # If the service wasn't seen for a minute
-                    cat["aliveServices"].remove(service)
-                    print("\n[", time.ctime(), "] - Service", service["service"], "is not reachable. Removed from active services.\n")
-                    json.dump(cat, open(filename, "w"), indent = 6)
-            threadLock.release()
-            time.sleep(30) # Check every 30 secs
+            wait = self.catalog.services.expire()
+            time.sleep(max(wait, 0.1)) # Sleep until the next deadline. A ping can only move a deadline later, so none is missed
 
 
 if __name__ == "__main__":
     
-    RESTThread = RESTCatalogThread()
-    ServiceCatalogThread = ServiceCatalogCheck()
-    RESTThread.start()
-    ServiceCatalogThread.start()
\ No newline at end of file
+    settings = json.load(open(confFile))
+    workers = settings.get("catalogWorkers", workerCount)
+    if workers > 0 and settings.get("catalogStore", storeType) != "sqlite":
+        raise SystemExit("The worker processes need \"catalogStore\": \"sqlite\"")
+    if sys.argv[1:] == ["worker"]: # Worker process started by the main process: it answers the requests on catalogPort together with the other workers
+        catalog = CatalogReplica(SQLiteReplica(settings.get("catalogDB", dbFilename)))
+        catalog.start()
+        AsyncCatalogServer(catalog, settings.get("asyncThreads", asyncThreads), catalogPort, primary="http://127.0.0.1:" + str(settings.get("primaryPort", primaryPort))).run()
+        sys.exit()
+    if settings.get("catalogStore", storeType) == "sqlite":
+        store = SQLiteStore(settings.get("catalogDB", dbFilename), filename, settings.get("flushInterval", flushInterval))
+    else:
+        store = JournalStore(filename, settings.get("flushInterval", flushInterval), settings.get("compactionSize", compactionSize), settings.get("streamingLoad", streamingLoad))
+    catalog = Catalog(store, DeviceOutbox(settings.get("outboxFile", outboxFilename)))
+    catalog.start()
+    conf = catalog.state.data
+    catalog.publisher = ChangePublisher("appPills-Catalog", conf["broker"], conf["port"], conf["baseTopic"], catalog.services)
+    catalog.publisher.start()
+    ServiceCatalogThread = ServiceCatalogCheck(catalog)
+    ServiceCatalogThread.start()
+    port = catalogPort
+    host = None
+    if workers > 0: # The workers answer on catalogPort, the main process only answers the requests they forward
+        catalog.shared = True
+        port = settings.get("primaryPort", primaryPort)
+        host = "127.0.0.1"
+        WorkerSupervisor(workers).start()
+    if settings.get("catalogServer", serverType) == "asyncio":
+        AsyncCatalogServer(catalog, settings.get("asyncThreads", asyncThreads), port, host).run()
+    else:
+        RESTThread = RESTCatalogThread(catalog, port)
+        RESTThread.start()
\ No newline at end of file
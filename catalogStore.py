@@ -0,0 +1,606 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import sqlite3
+import threading
+try:
+    import fcntl # Lock file of the catalog. Not available on Windows, where the lock is not taken
+except ImportError:
+    fcntl = None
+
+retryInterval = 1 # Seconds between two attempts to write the modifications on disk, after a write failed (ex. disk full)
+
+'''
+Storage engines of the catalog. The catalog lives in memory (see catalog3.py); this module only makes its
+modifications durable. Every modification of the catalog is described by a list of records
+[table, key, value], where value is the whole new value of the entity (None if it was removed).
+A background thread writes all the modifications received in the meantime at once (group commit), keeping only the last value
+of every entity modified more than once. A file is never modified in place: it is written on a temporary file that replaces it
+only once it is complete on disk, so a crash never leaves a half written catalog. Only one process at a time can use a catalog.
+Two engines are available, selected with the "catalogStore" key of the conf.json file:
+- "json": the records are appended on a journal ("mycat.journal"), one line per modification. When the journal becomes
+  too big, it is rolled into the snapshot ("mycat.json"), that keeps the same structure of the old catalog file, preceded
+  by a header with the ID counters ("ids"). Every entity is on its own line, so the snapshot can also be read one line at a time (see streamCatalog).
+  At startup the snapshot is loaded and the journal is replayed on top of it. Since every record contains the whole
+  value of the entity, replaying a record twice gives the same result.
+- "sqlite": the records are written in a SQLite database ("mycat.db") in WAL mode, with one table for every kind of entity.
+  The first time the database is used, it is filled with the content of "mycat.json". Like the journal, it is read whole at
+  startup: the catalog is then served from memory, so this engine does not reduce the memory used by the catalog.
+  The records of the last modifications are also kept in the "replication" table, so that the worker processes of the
+  catalog (see SQLiteReplica) can follow the modifications made by the main process while reading the database.
+'''
+
+class CatalogStore(object): # Interface of the storage engines. The subclasses implement load() and write()
+
+    def __init__(self, flushInterval):
+        self.flushInterval = flushInterval # Seconds between two group commits
+        self.pending = [] # Modifications waiting to be written on disk
+        self.pendingState = None # Version of the catalog obtained applying all the pending modifications
+        self.writtenState = None # Version of the catalog obtained applying all the modifications written on disk
+        self.condition = threading.Condition() # Wakes up the writer when there are pending modifications
+        self.written = threading.Condition() # Wakes up the requests waiting for their modification to be on disk
+        self.writeLock = threading.Lock() # The writer thread and the shutdown must not write at the same time
+        self.lockFile = None # Locked while the catalog is used (see lock())
+
+    def load(self): # Return the catalog, with the same structure of the catalog file, and the modifications that must be applied to it
+        raise NotImplementedError
+
+    def lock(self, filename): # Make sure that no other process is using the same catalog: two writers would overwrite each other's modifications
+
+        self.lockFile = open(filename + ".lock", "w") # Kept open until close()
+        if fcntl == None:
+            return
+        try:
+            fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise SystemExit("The catalog " + filename + " is already used by another process")
+
+    def merge(self, modifications): # Records of a batch of modifications, with only the last value of every entity. A burst of modifications of the same entity (ex. the opening records) is written once
+
+        merged = {}
+        for records in modifications:
+            for table, key, value in records:
+                merged[(table, key)] = value
+        return [[table, key, value] for (table, key), value in merged.items()]
+
+    def write(self, modifications): # Write a batch of modifications on disk
+        raise NotImplementedError
+
+    def start(self, state): # Start the thread that writes the modifications. state is the version of the catalog after load()
+
+        self.pendingState = state
+        self.writtenState = state
+        StoreWriterThread(self).start()
+
+    def commit(self, state, records): # Queue the records of a modification. Called by the writer of the catalog, so the modifications are queued in the same order of the versions
+
+        self.condition.acquire()
+        self.pending.append(records)
+        self.pendingState = state
+        self.condition.notify()
+        self.condition.release()
+
+    def writePending(self, wait=True): # Write all the pending modifications at once
+
+        self.condition.acquire()
+        while wait and len(self.pending) == 0:
+            self.condition.wait()
+        modifications = self.pending
+        state = self.pendingState
+        self.pending = []
+        self.condition.release()
+        if len(modifications) == 0:
+            return
+        self.writeLock.acquire()
+        try:
+            self.write(modifications)
+            self.written.acquire() # Before releasing writeLock: a compaction must never see a writtenState older than the journal it rolls into the snapshot
+            self.writtenState = state
+            self.written.notify_all()
+            self.written.release()
+        except BaseException:
+            self.condition.acquire()
+            self.pending = modifications + self.pending # Not on disk: written again at the next attempt, before the modifications queued in the meantime
+            self.condition.release()
+            raise
+        finally:
+            self.writeLock.release()
+
+    def waitWritten(self, version): # Wait until the modifications up to the given version are on disk
+
+        self.written.acquire()
+        while self.writtenState.data.get("version", 0) < version:
+            self.written.wait()
+        self.written.release()
+
+    def unlock(self): # Let another process, or another store of this process, use the catalog. Called at the end of close()
+
+        if self.lockFile != None:
+            self.lockFile.close() # Closing the file releases the flock
+            self.lockFile = None
+
+    def close(self): # Write everything on disk. Called at shutdown
+
+        self.writePending(wait=False)
+        self.unlock()
+
+class JournalStore(CatalogStore):
+
+    def __init__(self, filename, flushInterval, compactionSize, streaming=False):
+        CatalogStore.__init__(self, flushInterval)
+        self.filename = filename # Snapshot of the catalog
+        self.streaming = streaming # True to read the snapshot one line at a time, with streamCatalog
+        self.journalFile = os.path.splitext(filename)[0] + ".journal" # Modifications received after the snapshot
+        self.oldJournalFile = self.journalFile + ".old" # Journal that is being rolled into the snapshot
+        self.compactionSize = compactionSize # Size in bytes of the journal after which it is rolled into the snapshot
+        self.compactionLock = threading.Lock() # The periodic compaction and the one at shutdown must not run at the same time
+        self.journal = None
+
+    def read(self): # Return the catalog in the snapshot and the records of the journal that must be applied to it, without opening the journal
+
+        if self.streaming: # The snapshot is read while the catalog is built
+            catalog = streamCatalog(self.filename)
+        else:
+            with open(self.filename) as fp:
+                catalog = json.load(fp)
+        records = self.readJournal(self.oldJournalFile) + self.readJournal(self.journalFile)
+        return catalog, records
+
+    def load(self):
+
+        self.lock(self.filename)
+        catalog, records = self.read()
+        self.journal = open(self.journalFile, "ab")
+        syncDirectory(self.journalFile)
+        self.journalSize = self.journal.tell()
+        print("\n[", time.ctime(), "] - Catalog loaded from", self.filename, "and", len(records), "modifications of the journal")
+        return catalog, records
+
+    def readJournal(self, name):
+
+        records = []
+        if not os.path.isfile(name):
+            return records
+        with open(name, "rb") as fp:
+            end = 0 # Position after the last complete line
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError: # The last line can be incomplete if the catalog crashed while writing it
+                    break
+                end += len(line)
+        if end < os.path.getsize(name): # Cut the incomplete line, otherwise the next lines would be appended to it
+            print("\n[", time.ctime(), "] - Discarded an incomplete modification at the end of", name)
+            with open(name, "r+b") as fp:
+                fp.truncate(end)
+        return records
+
+    def start(self, state): # Start the threads that write the journal and compact it. state is the version of the catalog after the replay of the journal
+
+        CatalogStore.start(self, state)
+        CompactionThread(self).start()
+
+    def write(self, modifications): # Append one line with all the modifications to the journal, with a single fsync. A line cut by a crash is discarded at the next startup, so the batch is written completely or not at all
+
+        data = (json.dumps(self.merge(modifications), separators=(",", ":")) + "\n").encode()
+        end = self.journal.tell() # End of the last complete line
+        try:
+            self.journal.write(data)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        except OSError:
+            self.rewind(end)
+            raise
+        self.journalSize += len(data)
+
+    def rewind(self, end): # Cut what a failed write left after the last complete line, so that the batch is written again on a line of its own. The journal is opened again, since its buffer may still hold part of the batch
+
+        try:
+            self.journal.close()
+        except OSError: # Flushing the rest of the batch failed again: the file is closed anyway
+            pass
+        try:
+            with open(self.journalFile, "r+b") as fp:
+                fp.truncate(end)
+        finally:
+            self.journal = open(self.journalFile, "ab")
+
+    def compact(self): # Roll the journal into a new snapshot
+
+        self.compactionLock.acquire()
+        self.writeLock.acquire()
+        if self.journalSize == 0:
+            self.writeLock.release()
+            self.compactionLock.release()
+            return
+        state = self.writtenState # The new snapshot contains exactly the lines written up to now
+        self.journal.close()
+        if os.path.isfile(self.oldJournalFile): # A previous compaction was interrupted: keep all the lines that are not yet in the snapshot
+            with open(self.oldJournalFile, "ab") as old, open(self.journalFile, "rb") as new:
+                old.write(new.read())
+                old.flush()
+                os.fsync(old.fileno())
+            os.remove(self.journalFile)
+        else:
+            os.replace(self.journalFile, self.oldJournalFile)
+        self.journal = open(self.journalFile, "ab")
+        syncDirectory(self.journalFile)
+        self.journalSize = 0
+        self.writeLock.release()
+
+        # The new lines go in the new journal while the snapshot is written. The old snapshot is replaced only when the new one is complete on disk
+        temp = self.filename + ".tmp"
+        with open(temp, "w") as fp:
+            writeSnapshot(fp, state.snapshot())
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp, self.filename)
+        syncDirectory(self.filename) # The old journal can be removed only once the new snapshot is sure to be found after a crash
+        os.remove(self.oldJournalFile)
+        self.compactionLock.release()
+        print("\n[", time.ctime(), "] - Journal rolled into", self.filename)
+
+    def close(self):
+
+        self.writePending(wait=False)
+        self.compact()
+        self.writeLock.acquire()
+        self.journal.close()
+        self.writeLock.release()
+        self.unlock()
+
+def syncDirectory(filename): # Make durable the creation, replacement or removal of a file, writing its directory on disk. Not possible on Windows
+
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+entityLists = ["patientList", "assistantList", "newDevices"] # Keys of the catalog file that contain one entity for every item
+
+def writeSnapshot(fp, catalog): # Write the catalog with one line for every key of the configuration and for every entity. It is the same json structure, that can also be read one line at a time (see streamCatalog). The lists of entities can be iterators
+
+    fp.write("{")
+    for i, (key, value) in enumerate(catalog.items()):
+        fp.write(("\n" if i == 0 else ",\n") + json.dumps(key) + ": ")
+        if key in entityLists:
+            fp.write("[")
+            for j, item in enumerate(value):
+                fp.write(("\n" if j == 0 else ",\n") + json.dumps(item))
+            fp.write("\n]")
+        else:
+            fp.write(json.dumps(value))
+    fp.write("\n}\n")
+
+def streamCatalog(filename): # Yield the (key, value) pairs of a catalog file written by writeSnapshot, decoding one line at a time: the text of the file is never kept in memory as a whole. The lists of entities are yielded as iterators, that must be consumed before the next pair. A file with another layout is read at once
+
+    with open(filename) as fp:
+        first = fp.readline()
+        second = fp.readline()
+        if first != "{\n" or not second.startswith('"ids": '): # Not written by writeSnapshot (ex. the original catalog file)
+            fp.seek(0)
+            for pair in json.load(fp).items():
+                yield pair
+            return
+        line = second
+        while line != "" and line != "}\n":
+            line = line.rstrip("\n")
+            if line.endswith(": ["):
+                yield json.loads(line[:-3]), streamEntities(fp)
+            else:
+                yield json.loads("{" + line.rstrip(",") + "}").popitem()
+            line = fp.readline()
+
+def streamEntities(fp, batch=1000): # Entities of one of the lists of a catalog file, one for every line. They are decoded a batch at a time, so that the entities of a batch share the strings of their keys as with json.load
+
+    lines = []
+    for line in fp:
+        if line.startswith("]"):
+            break
+        lines.append(line.rstrip(",\n"))
+        if len(lines) == batch:
+            for entity in json.loads("[" + ",".join(lines) + "]"):
+                yield entity
+            lines = []
+    for entity in json.loads("[" + ",".join(lines) + "]"):
+        yield entity
+
+class SQLiteStore(CatalogStore):
+
+    listKeys = ["patientList", "assistantList", "newDevices", "aliveServices", "times", "pillCount"] # Keys of the catalog file whose content is kept in its own table
+    deviceFields = ["deviceURI", "thingSpeakChannel", "tempUpperThresh", "tempLowerThresh", "humUpperThresh", "humLowerThresh", "numSlots"]
+    schema = """
+        CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS patients (userID INTEGER PRIMARY KEY, userName TEXT, password TEXT, usage TEXT, chatID INTEGER, last_update TEXT);
+        CREATE INDEX IF NOT EXISTS patientsChatID ON patients (chatID);
+        CREATE INDEX IF NOT EXISTS patientsUserName ON patients (userName);
+        CREATE TABLE IF NOT EXISTS assistants (userID INTEGER PRIMARY KEY, userName TEXT, chatID INTEGER, last_update TEXT);
+        CREATE INDEX IF NOT EXISTS assistantsChatID ON assistants (chatID);
+        CREATE INDEX IF NOT EXISTS assistantsUserName ON assistants (userName);
+        CREATE TABLE IF NOT EXISTS patientAssistants (patientID INTEGER, position INTEGER, assistantID INTEGER, PRIMARY KEY (patientID, position));
+        CREATE INDEX IF NOT EXISTS patientAssistantsAssistantID ON patientAssistants (assistantID);
+        CREATE TABLE IF NOT EXISTS assistedPatients (assistantID INTEGER, position INTEGER, patientID INTEGER, PRIMARY KEY (assistantID, position));
+        CREATE INDEX IF NOT EXISTS assistedPatientsPatientID ON assistedPatients (patientID);
+        CREATE TABLE IF NOT EXISTS devices (deviceID INTEGER PRIMARY KEY, userID INTEGER, position INTEGER, deviceURI TEXT, thingSpeakChannel TEXT, tempUpperThresh REAL, tempLowerThresh REAL, humUpperThresh REAL, humLowerThresh REAL, numSlots INTEGER);
+        CREATE INDEX IF NOT EXISTS devicesUserID ON devices (userID, position);
+        CREATE TABLE IF NOT EXISTS slots (deviceID INTEGER, slotNum INTEGER, pillName TEXT, PRIMARY KEY (deviceID, slotNum));
+        CREATE TABLE IF NOT EXISTS schedules (deviceID INTEGER, slotNum INTEGER, position INTEGER, time TEXT, numPill INTEGER, alarm INTEGER, PRIMARY KEY (deviceID, slotNum, position));
+        CREATE INDEX IF NOT EXISTS schedulesTime ON schedules (time);
+        CREATE TABLE IF NOT EXISTS newDevices (deviceID INTEGER PRIMARY KEY, deviceURI TEXT, numSlots INTEGER, device TEXT);
+        CREATE TABLE IF NOT EXISTS aliveServices (service TEXT, lastSeen REAL);
+        CREATE TABLE IF NOT EXISTS openingTimes (patientDevice TEXT, record TEXT);
+        CREATE INDEX IF NOT EXISTS openingTimesPatientDevice ON openingTimes (patientDevice);
+        CREATE TABLE IF NOT EXISTS openingPills (patientDevice TEXT, record TEXT);
+        CREATE INDEX IF NOT EXISTS openingPillsPatientDevice ON openingPills (patientDevice);
+        CREATE TABLE IF NOT EXISTS replication (version INTEGER PRIMARY KEY, records TEXT);
+    """
+    replicationSize = 10000 # Number of modifications kept in the replication table. A worker that is further behind reads again the whole catalog
+
+    def __init__(self, dbFile, filename, flushInterval):
+        CatalogStore.__init__(self, flushInterval)
+        self.dbFile = dbFile # SQLite database
+        self.filename = filename # Catalog file, read only to fill the database the first time
+        self.migrate = False # True if the database must be filled with the catalog read from the catalog file
+        self.db = None
+
+    def load(self):
+
+        self.lock(self.dbFile)
+        self.db = sqlite3.connect(self.dbFile, check_same_thread=False) # Used by the writer thread, and at shutdown by the REST thread. The writeLock makes sure that only one of them uses it
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(self.schema)
+        if self.db.execute("SELECT COUNT(*) FROM config").fetchone()[0] == 0: # Empty database: take the catalog from the catalog file, including its journal
+            catalog, records = JournalStore(self.filename, self.flushInterval, 0).read()
+            self.migrate = True
+            print("\n[", time.ctime(), "] - Catalog migrated from", self.filename, "to", self.dbFile)
+            return catalog, records
+        catalog, records = self.readAll()
+        print("\n[", time.ctime(), "] - Catalog loaded from", self.dbFile)
+        return catalog, records
+
+    def start(self, state):
+
+        if self.migrate: # Write the whole catalog in a single transaction, before accepting any modification
+            with self.db:
+                self.writeCatalog(state)
+            self.migrate = False
+        CatalogStore.start(self, state)
+
+    def readAll(self): # Return the catalog and the record of the ID counters, as load()
+
+        catalog = self.readCatalog()
+        records = []
+        counters = dict(self.db.execute("SELECT name, value FROM counters").fetchall())
+        if len(counters) > 0:
+            records.append([["ids", None, [counters["maxUserID"], counters["maxDeviceID"]]]])
+        return catalog, records
+
+    def readCatalog(self): # Build the catalog, with the same structure of the catalog file
+
+        catalog = {}
+        for key, value in self.db.execute("SELECT key, value FROM config ORDER BY rowid"):
+            if key in self.listKeys:
+                catalog[key] = []
+            else:
+                catalog[key] = json.loads(value)
+
+        patients = {}
+        for userID, userName, password, usage, chatID, last_update in self.db.execute("SELECT userID, userName, password, usage, chatID, last_update FROM patients ORDER BY userID"):
+            patients[userID] = {"userID": userID, "userName": userName, "password": password, "usage": usage, "chatID": chatID, "last_update": last_update, "devices": [], "assistants": []}
+        for patientID, assistantID in self.db.execute("SELECT patientID, assistantID FROM patientAssistants ORDER BY patientID, position"):
+            patients[patientID]["assistants"].append({"assistantID": assistantID})
+        devices = {}
+        for row in self.db.execute("SELECT userID, deviceID, " + ", ".join(self.deviceFields) + " FROM devices ORDER BY userID, position"):
+            device = {"deviceID": row[1]}
+            device.update(zip(self.deviceFields, row[2:]))
+            device["slots"] = []
+            patients[row[0]]["devices"].append(device)
+            devices[row[1]] = device
+        for deviceID, slotNum, pillName in self.db.execute("SELECT deviceID, slotNum, pillName FROM slots ORDER BY deviceID, slotNum"):
+            devices[deviceID]["slots"].append({"pillName": pillName, "schedule": []})
+        for deviceID, slotNum, alarm, numPill, alarmTime in self.db.execute("SELECT deviceID, slotNum, alarm, numPill, time FROM schedules ORDER BY deviceID, slotNum, position"):
+            devices[deviceID]["slots"][slotNum]["schedule"].append({"alarm": alarm, "numPill": numPill, "time": alarmTime})
+        catalog["patientList"] = list(patients.values())
+
+        assistants = {}
+        for userID, userName, chatID, last_update in self.db.execute("SELECT userID, userName, chatID, last_update FROM assistants ORDER BY userID"):
+            assistants[userID] = {"userID": userID, "userName": userName, "chatID": chatID, "last_update": last_update, "assistedPatients": []}
+        for assistantID, patientID in self.db.execute("SELECT assistantID, patientID FROM assistedPatients ORDER BY assistantID, position"):
+            assistants[assistantID]["assistedPatients"].append({"patientID": patientID})
+        catalog["assistantList"] = list(assistants.values())
+
+        for deviceID, deviceURI, numSlots, device in self.db.execute("SELECT deviceID, deviceURI, numSlots, device FROM newDevices ORDER BY deviceID"):
+            if device != None: # Device that was removed by a user, with all its configuration
+                catalog["newDevices"].append(json.loads(device))
+            else:
+                catalog["newDevices"].append({"deviceID": deviceID, "deviceURI": deviceURI, "numSlots": numSlots})
+        catalog["aliveServices"] = [{"service": service, "lastSeen": lastSeen} for service, lastSeen in self.db.execute("SELECT service, lastSeen FROM aliveServices ORDER BY rowid")]
+        catalog["times"] = [json.loads(record) for (record,) in self.db.execute("SELECT record FROM openingTimes ORDER BY rowid")]
+        catalog["pillCount"] = [json.loads(record) for (record,) in self.db.execute("SELECT record FROM openingPills ORDER BY rowid")]
+        return catalog
+
+    def writeCatalog(self, state): # Write the whole catalog in the database
+
+        for key, value in state.export().items():
+            if key not in ["patientList", "assistantList", "newDevices"]:
+                self.writeData(key, value)
+            else:
+                self.writeData(key, [])
+        for patient in state.patients.values():
+            self.writePatient(patient["userID"], patient)
+        for assistant in state.assistants.values():
+            self.writeAssistant(assistant["userID"], assistant)
+        for deviceID, device in state.newDevices.items():
+            self.writeNewDevice(deviceID, device)
+        self.writeCounters(state.maxUserID, state.maxDeviceID)
+
+    def write(self, modifications): # Write all the modifications in a single transaction. The replication table keeps every version, the other tables only the last value of every entity
+
+        with self.db:
+            for records in modifications:
+                version = [value for table, key, value in records if table == "data" and key == "version"][0]
+                self.db.execute("INSERT OR REPLACE INTO replication (version, records) VALUES (?, ?)", (version, json.dumps(records, separators=(",", ":"))))
+            for table, key, value in self.merge(modifications):
+                if table == "patients":
+                    self.writePatient(key, value)
+                elif table == "assistants":
+                    self.writeAssistant(key, value)
+                elif table == "newDevices":
+                    self.writeNewDevice(key, value)
+                elif table == "data":
+                    self.writeData(key, value)
+                elif table == "ids":
+                    self.writeCounters(value[0], value[1])
+            self.db.execute("DELETE FROM replication WHERE version <= ?", (version - self.replicationSize,))
+
+    def writePatient(self, userID, patient): # Replace all the rows of a patient, with its devices. patient is None if it was removed
+
+        self.db.execute("DELETE FROM schedules WHERE deviceID IN (SELECT deviceID FROM devices WHERE userID = ?)", (userID,))
+        self.db.execute("DELETE FROM slots WHERE deviceID IN (SELECT deviceID FROM devices WHERE userID = ?)", (userID,))
+        self.db.execute("DELETE FROM devices WHERE userID = ?", (userID,))
+        self.db.execute("DELETE FROM patientAssistants WHERE patientID = ?", (userID,))
+        self.db.execute("DELETE FROM patients WHERE userID = ?", (userID,))
+        if patient == None:
+            return
+        self.db.execute("INSERT INTO patients (userID, userName, password, usage, chatID, last_update) VALUES (?, ?, ?, ?, ?, ?)", (userID, patient["userName"], patient["password"], patient["usage"], patient["chatID"], patient["last_update"]))
+        self.db.executemany("INSERT INTO patientAssistants (patientID, position, assistantID) VALUES (?, ?, ?)", [(userID, position, item["assistantID"]) for position, item in enumerate(patient["assistants"])])
+        for position, device in enumerate(patient["devices"]):
+            deviceID = device["deviceID"]
+            self.db.execute("DELETE FROM schedules WHERE deviceID = ?", (deviceID,))
+            self.db.execute("DELETE FROM slots WHERE deviceID = ?", (deviceID,))
+            self.db.execute("INSERT OR REPLACE INTO devices (deviceID, userID, position, " + ", ".join(self.deviceFields) + ") VALUES (?, ?, ?" + ", ?" * len(self.deviceFields) + ")", [deviceID, userID, position] + [device[field] for field in self.deviceFields])
+            self.db.executemany("INSERT INTO slots (deviceID, slotNum, pillName) VALUES (?, ?, ?)", [(deviceID, slotNum, slot["pillName"]) for slotNum, slot in enumerate(device["slots"])])
+            self.db.executemany("INSERT INTO schedules (deviceID, slotNum, position, time, numPill, alarm) VALUES (?, ?, ?, ?, ?, ?)", [(deviceID, slotNum, num, alarm["time"], alarm["numPill"], alarm["alarm"]) for slotNum, slot in enumerate(device["slots"]) for num, alarm in enumerate(slot["schedule"])])
+
+    def writeAssistant(self, userID, assistant):
+
+        self.db.execute("DELETE FROM assistedPatients WHERE assistantID = ?", (userID,))
+        self.db.execute("DELETE FROM assistants WHERE userID = ?", (userID,))
+        if assistant == None:
+            return
+        self.db.execute("INSERT INTO assistants (userID, userName, chatID, last_update) VALUES (?, ?, ?, ?)", (userID, assistant["userName"], assistant["chatID"], assistant["last_update"]))
+        self.db.executemany("INSERT INTO assistedPatients (assistantID, position, patientID) VALUES (?, ?, ?)", [(userID, position, item["patientID"]) for position, item in enumerate(assistant["assistedPatients"])])
+
+    def writeNewDevice(self, deviceID, device):
+
+        self.db.execute("DELETE FROM newDevices WHERE deviceID = ?", (deviceID,))
+        if device == None:
+            return
+        if set(device.keys()) == set(["deviceID", "deviceURI", "numSlots"]): # Device that was never registered
+            details = None
+        else: # Device removed by a user: keep also its slots and thresholds
+            details = json.dumps(device)
+        self.db.execute("INSERT INTO newDevices (deviceID, deviceURI, numSlots, device) VALUES (?, ?, ?, ?)", (deviceID, device["deviceURI"], device["numSlots"], details))
+
+    def writeData(self, key, value): # Configuration, services and opening records
+
+        if key == "aliveServices":
+            self.db.execute("DELETE FROM aliveServices")
+            self.db.executemany("INSERT INTO aliveServices (service, lastSeen) VALUES (?, ?)", [(service["service"], service["lastSeen"]) for service in value])
+        elif key == "times" or key == "pillCount":
+            table = "openingTimes" if key == "times" else "openingPills"
+            self.db.execute("DELETE FROM " + table)
+            self.db.executemany("INSERT INTO " + table + " (patientDevice, record) VALUES (?, ?)", [(record["patientID/deviceID"], json.dumps(record)) for record in value])
+        if key in self.listKeys: # Only the position of the key is kept in the config table
+            value = None
+        else:
+            value = json.dumps(value)
+        self.db.execute("INSERT INTO config (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, value)) # Keeps the position of the key in the catalog
+
+    def writeCounters(self, maxUserID, maxDeviceID):
+
+        self.db.executemany("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", [("maxUserID", maxUserID), ("maxDeviceID", maxDeviceID)])
+
+    def close(self):
+
+        self.writePending(wait=False)
+        self.writeLock.acquire()
+        self.db.close()
+        self.writeLock.release()
+        self.unlock()
+
+class SQLiteReplica(SQLiteStore): # Read only view of the database written by the main process, used by the worker processes of the catalog. It never writes anything
+
+    def __init__(self, dbFile):
+        SQLiteStore.__init__(self, dbFile, None, 0)
+        self.dataVersion = None # Value of "PRAGMA data_version" when the database was last read. It changes when another process commits
+        self.connectionLock = threading.Lock() # The connection is shared by the threads that answer the requests and the one that follows the database
+
+    def load(self): # Also used to read again the whole catalog, when poll() returned None
+
+        self.connectionLock.acquire()
+        if self.db == None:
+            self.db = sqlite3.connect(self.dbFile, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA query_only=1")
+        self.db.execute("BEGIN") # All the tables are read from the same snapshot of the database
+        self.dataVersion = self.db.execute("PRAGMA data_version").fetchone()[0]
+        catalog, records = self.readAll()
+        self.db.execute("COMMIT")
+        self.connectionLock.release()
+        return catalog, records
+
+    def start(self, state):
+        pass
+
+    def commit(self, state, records):
+        raise RuntimeError("The worker processes never modify the catalog")
+
+    def modified(self): # True if another process committed something since the last read
+
+        self.connectionLock.acquire()
+        dataVersion = self.db.execute("PRAGMA data_version").fetchone()[0]
+        self.connectionLock.release()
+        return dataVersion != self.dataVersion
+
+    def poll(self, since): # Return the records of the modifications after version since, in order. None if some of them are not in the replication table any more
+
+        self.connectionLock.acquire()
+        self.dataVersion = self.db.execute("PRAGMA data_version").fetchone()[0] # Taken before reading, so a modification committed in the meantime is read at the next poll
+        rows = self.db.execute("SELECT version, records FROM replication WHERE version > ? ORDER BY version", (since,)).fetchall()
+        self.connectionLock.release()
+        if len(rows) > 0 and rows[0][0] != since + 1:
+            return None
+        return [json.loads(records) for version, records in rows]
+
+    def close(self):
+
+        self.connectionLock.acquire()
+        self.db.close()
+        self.connectionLock.release()
+
+# Thread that writes the modifications of the catalog. All the modifications received in flushInterval seconds are written at once
+class StoreWriterThread(threading.Thread):
+
+    def __init__(self, store):
+        threading.Thread.__init__(self)
+        self.store = store
+        self.daemon = True # At shutdown the pending modifications are written by close()
+
+    def run(self):
+        while True:
+            try:
+                self.store.writePending()
+            except Exception as e: # The modifications are still pending: they are written at the next attempt, and the requests waiting for them are answered only then
+                print("\n[", time.ctime(), "] - Modifications not written on disk, retrying in", retryInterval, "seconds:", repr(e))
+                time.sleep(retryInterval)
+            time.sleep(self.store.flushInterval)
+
+# Thread that rolls the journal into the snapshot when it becomes too big
+class CompactionThread(threading.Thread):
+
+    def __init__(self, store):
+        threading.Thread.__init__(self)
+        self.store = store
+        self.daemon = True
+
+    def run(self):
+        while True:
+            time.sleep(10) # Check every 10 secs
+            if self.store.journalSize > self.store.compactionSize:
+                self.store.compact()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+'''
+Tests of the REST interface of the catalog. Every test runs the catalog in this process (no HTTP server, no MQTT broker), on a copy
+of "mycat.json" in a temporary folder, and sends the requests through the WebServer, as the CherryPy and asyncio front ends do.
+Usage: python catalogTest.py
+'''
+
+source = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, source)
+import catalog3
+import catalogStore
+from catalogStore import JournalStore
+from deviceOutbox import DeviceOutbox
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        shutil.copy(os.path.join(source, "mycat.json"), self.folder)
+        self.catalog = None
+        self.startCatalog()
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.folder)
+
+    def startCatalog(self): # Start the catalog from the files in the folder, as at startup. The previous one is stopped first
+        if self.catalog != None:
+            self.catalog.close()
+        store = JournalStore(os.path.join(self.folder, "mycat.json"), 0.01, catalog3.compactionSize)
+        self.catalog = catalog3.Catalog(store, DeviceOutbox(os.path.join(self.folder, "outbox.json")))
+        self.catalog.start()
+        self.webServer = catalog3.WebServer(self.catalog)
+
+    def request(self, method, uri, params={}, body=None): # Answer of the catalog, decoded
+        request = catalog3.Request(params, {}, json.dumps(body).encode() if body != None else b"", "127.0.0.1")
+        return json.loads(self.webServer.dispatch(method, uri.split("/"), request))
+
+    def assertRefused(self, method, uri, params={}, status=400): # The request must be refused with the given status
+        request = catalog3.Request(params, {}, b"", "127.0.0.1")
+        with self.assertRaises(catalog3.RequestError) as refused:
+            self.webServer.dispatch(method, uri.split("/"), request)
+        self.assertEqual(refused.exception.status, status)
+
+    def testPingAfterRestart(self): # The services that are alive are kept only in memory: after a restart every service pings for the first time again, and must get the same answer
+        self.request("PUT", "addOpeningTime", body={"patientID/deviceID": "5/8", "timeOpened": 1})
+        self.request("PUT", "addOpeningPills", body={"patientID/deviceID": "5/8", "pillCount": [1, 2]})
+        for restart in range(2):
+            for ping in range(2):
+                times = self.request("PUT", "ping", body={"service": "openingControl"})
+                self.assertEqual(times["times"], [{"patientID/deviceID": "5/8", "timeOpened": 1}])
+                pillCount = self.request("PUT", "ping", body={"service": "pillDifference"})
+                self.assertEqual(pillCount["pillCount"], [{"patientID/deviceID": "5/8", "pillCount": [1, 2]}])
+                self.assertIn("thresholds", self.request("PUT", "ping", body={"service": "conservationControl"}))
+            self.startCatalog()
+
+    def testDevicesKeys(self): # Every key of a "devices" request must be userID/deviceID
+        for keys in ["abc", "a/b/c", "5/8/9", "5", "5/", "a/8", "5,7/9"]:
+            self.assertRefused("GET", "devices", {"keys": keys})
+        devices = self.request("GET", "devices", {"keys": "5/8,1000000/1", "fields": "numSlots"})["devices"]
+        self.assertEqual(devices["1000000/1"], {"found": 0})
+        self.assertEqual(set(devices.keys()), set(["5/8", "1000000/1"]))
+
+    def testWriteFailure(self): # A write that fails (ex. disk full) is tried again: the modification is not lost, and the compaction is not blocked
+        fsync = os.fsync
+        failures = [3]
+        def failingFsync(fd):
+            if failures[0] > 0:
+                failures[0] -= 1
+                raise OSError(28, "No space left on device")
+            fsync(fd)
+        with unittest.mock.patch("os.fsync", failingFsync), unittest.mock.patch("catalogStore.retryInterval", 0.01):
+            self.request("PUT", "addOpeningTime", body={"patientID/deviceID": "5/8", "timeOpened": 1})
+            version = self.catalog.state.data["version"]
+            deadline = time.time() + 10
+            while self.catalog.store.writtenState.data.get("version", 0) < version and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(failures[0], 0)
+            self.assertEqual(self.catalog.store.writtenState.data.get("version", 0), version)
+            self.request("PUT", "addOpeningTime", body={"patientID/deviceID": "5/9", "timeOpened": 2})
+            self.catalog.store.compact()
+        self.startCatalog()
+        times = self.request("PUT", "ping", body={"service": "openingControl"})["times"]
+        self.assertEqual([item["patientID/deviceID"] for item in times], ["5/8", "5/9"])
+
+    def testFailureAfterCommit(self): # A modification that fails after commit() must not release the lock of the next writer
+        started = threading.Event()
+        finish = threading.Event()
+        def otherWriter():
+            self.catalog.begin()
+            started.set()
+            finish.wait()
+            self.catalog.abort()
+        other = threading.Thread(target=otherWriter)
+        @catalog3.modification
+        def failAfterCommit(catalog):
+            catalog.commit(catalog.begin())
+            other.start()
+            started.wait()
+            raise ValueError("failed after commit")
+        self.assertRaises(ValueError, failAfterCommit, self.catalog)
+        self.assertTrue(catalog3.threadLock.locked()) # Still held by the other writer
+        finish.set()
+        other.join()
+        self.assertFalse(catalog3.threadLock.locked())
+
+if __name__ == "__main__":
+    unittest.main()
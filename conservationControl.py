@@ -2,6 +2,7 @@ import json
 import time
 import requests
 import paho.mqtt.client as PahoMQTT
+from MyMQTT import presenceWill, presenceOnline, presenceOffline
 
 confFile = "conf.json"
 
@@ -13,7 +14,11 @@ class ConservationControl:
         self.clientID=clientID
         self.baseTopic=baseTopic
         self.subTopic=baseTopic+"/+/+/temperatureHumidity"
+        self.catalogTopic=baseTopic+"/catalog/devices/#" # Modifications of the devices, published by the catalog
+        self.presenceTopic=baseTopic+"/presence/conservationControl" # Retained status of the service, followed by the catalog
+        self.resync=True # True when the thresholds must be read again from the catalog, since some modifications may have been lost
         self._paho_mqtt=PahoMQTT.Client(clientID, True)
+        presenceWill(self._paho_mqtt, self.presenceTopic)
         self.catalogURI=catalogURI
         self._paho_mqtt.on_connect=self.myOnConnect
         self._paho_mqtt.on_message=self.myOnMessageReceived
@@ -21,6 +26,10 @@ class ConservationControl:
 
     def myOnConnect (self, paho_mqtt, userdata, flags, rc):
         print("\n[",time.ctime(),"] - Conservation Control connected to", self.broker, "with result code", rc)
+        self.subscribe(self.subTopic) # The subscriptions are lost with the connection (clean session): subscribe again at every (re)connection
+        self.subscribe(self.catalogTopic)
+        presenceOnline(self._paho_mqtt, self.presenceTopic)
+        self.resync=True # The modifications published while we were disconnected were not received
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
         self.notify(msg.topic, msg.payload)
@@ -58,12 +67,13 @@ class ConservationControl:
         self._paho_mqtt.connect(self.broker, self.port)
         self._paho_mqtt.loop_start()
         print("\n[",time.ctime(),"] - Conservation control", self.clientID, "started")
-        self.subscribe(self.subTopic)
 
     def unsubscribe(self):
         self._paho_mqtt.unsubscribe(self.subTopic)
+        self._paho_mqtt.unsubscribe(self.catalogTopic)
     
     def stop(self):
+        presenceOffline(self._paho_mqtt, self.presenceTopic)
         self.unsubscribe()
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -71,6 +81,9 @@ class ConservationControl:
 
     def notify(self, topic, msg):
         payload=json.loads(msg)
+        if topic.startswith(self.baseTopic+"/catalog/"): # A device was modified on the catalog: update its thresholds immediately
+            self.updateDevice(topic.split("/")[-1], payload["value"])
+            return
         patientID=str(topic.split("/")[1])
         deviceID=str(topic.split("/")[2])
         
@@ -106,13 +119,25 @@ class ConservationControl:
     def updateThresholds(self, threshList): # Update the ConservationControl thresholds, coming from the catalog
         self.threshs = threshList
 
+    def updateDevice(self, deviceID, device): # Update the thresholds of a single device, published by the catalog. device is None if it was removed
+        threshs = [item for item in self.threshs if int(item["deviceID"]) != int(deviceID)]
+        if device != None:
+            threshs.append({"deviceID":device["deviceID"], "tempUpperThresh":device["tempUpperThresh"], "tempLowerThresh":device["tempLowerThresh"], "humUpperThresh":device["humUpperThresh"], "humLowerThresh":device["humLowerThresh"]})
+        self.threshs = threshs # Replaced at once, so notify() never sees a partial list
+
 if __name__=="__main__":
     catalogURI=json.load(open(confFile))["catalogURI"] 
     conf = requests.get(catalogURI+"conf").json() # Get the system configuration from the catalog 
     controller=ConservationControl(conf["broker"], conf["port"], conf["baseTopic"], "appPills-ConservationControl", catalogURI)
     controller.start()
+    presence = conf.get("presence", "http") # "mqtt": the catalog knows we are alive from the presence topic, so the thresholds are read only after a (re)connection
+    thresholdsETag = "" # Version of the thresholds we have. The catalog sends them again only when they change
     while True:
-        # Ping cotinuously the server to say I'm alive and get the latest thresholds 
-        thresholds = requests.put(catalogURI+"ping", data=json.dumps({"service": "conservationControl"})).json()["thresholds"]
-        controller.updateThresholds(thresholds)
+        if presence != "mqtt" or controller.resync:
+            controller.resync = False
+            # Ping cotinuously the server to say I'm alive and get the latest thresholds 
+            response = requests.put(catalogURI+"ping", data=json.dumps({"service": "conservationControl"}), headers={"If-None-Match": thresholdsETag})
+            if response.status_code != 304: # 304: the thresholds did not change
+                controller.updateThresholds(response.json()["thresholds"])
+                thresholdsETag = response.headers.get("ETag", "")
         time.sleep(5) # Ping every 5 seconds 
\ No newline at end of file
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+
+'''
+Fault injection test of the journal of the catalog (JournalStore). A "writer" process adds opening records to the catalog one
+after the other, and prints the number of every record once it is on disk (acknowledged), while another thread rolls the journal
+into the snapshot as often as it can. The writer is killed (SIGKILL) at a random instant, chosen among:
+- "random": killed by this process after a random delay
+- "fsync": right after the journal was written on disk, before the modification is acknowledged
+- "rename": during a compaction, after the new snapshot was written on disk and before it replaces the old one
+- "remove": during a compaction, after the new snapshot replaced the old one and before the old journal is removed
+- "compaction": after every acknowledged record, with no compaction halfway, the files are read as a crash at that instant would
+  leave them: the process is killed as soon as the record is not there, otherwise after 20 * count records. A record lost by a
+  compaction is found even if it would be written again by the next one, a few milliseconds later
+After every kill the catalog is loaded again from the files, as at startup, and every acknowledged record must be there.
+The next writer starts from the catalog left by the previous one, so the recovery of a recovery is tested too.
+Usage: python crashTest.py [number of kills] [seed]   (default: 50 and a random seed). The exit code is 1 if a record was lost
+'''
+
+kills = 50
+points = ["random", "fsync", "rename", "remove", "compaction"]
+
+def writer(folder, point, count, first): # Write records until killed. count is the number of calls to the injection point after which the process kills itself
+
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+    import catalog3
+    from catalogStore import JournalStore
+    calls = [0]
+    def inject(function, match): # Wrap a function of the os module, so that the process is killed before (or after, for fsync) the count-th call that matches
+        def injected(*args):
+            if match(*args):
+                calls[0] += 1
+                if calls[0] == count and point != "fsync":
+                    os.kill(os.getpid(), signal.SIGKILL)
+            result = function(*args)
+            if point == "fsync" and calls[0] == count:
+                os.kill(os.getpid(), signal.SIGKILL)
+            return result
+        return injected
+    if point == "fsync":
+        os.fsync = inject(os.fsync, lambda fd: True)
+    elif point == "rename":
+        os.replace = inject(os.replace, lambda src, dst: dst == "mycat.json")
+    elif point == "remove":
+        os.remove = inject(os.remove, lambda name: name.endswith(".journal.old"))
+    sys.setswitchinterval(1e-6) # Switch between the writer and the compaction as often as possible, so that even short windows between two steps are hit
+    store = JournalStore("mycat.json", 0, 0)
+    catalog = catalog3.Catalog(store, None)
+    store.start(catalog.state) # Only the journal is needed: no compaction thread and no outbox
+    def compact():
+        while True:
+            store.compact()
+    threading.Thread(target=compact, daemon=True).start()
+    n = first
+    while True:
+        catalog.addOpeningTime({"patientID/deviceID": "crash/" + str(n), "time": time.time()})
+        store.waitWritten(catalog.state.data["version"])
+        sys.stdout.write("ack " + str(n) + "\n") # The catalog prints its messages on stdout too
+        sys.stdout.flush()
+        if point == "compaction":
+            store.compactionLock.acquire()
+            if n not in reload(folder):
+                os.kill(os.getpid(), signal.SIGKILL)
+            store.compactionLock.release()
+            calls[0] += 1
+            if calls[0] == 20 * count:
+                os.kill(os.getpid(), signal.SIGKILL)
+        n += 1
+
+def reload(folder): # Records in the catalog loaded from the files, as at startup
+
+    sys.path.insert(0, folder)
+    import catalog3
+    from catalogStore import JournalStore
+    catalog, records = JournalStore(os.path.join(folder, "mycat.json"), 0, 0).read()
+    state = catalog3.CatalogState(catalog)
+    for modification in records:
+        state.apply(modification)
+    return set([int(item["patientID/deviceID"].split("/")[1]) for item in state.data["times"] if item["patientID/deviceID"].startswith("crash/")])
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] == ["writer"]:
+        writer(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+        sys.exit()
+    if len(sys.argv) > 1:
+        kills = int(sys.argv[1])
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else random.randrange(1000000)
+    random.seed(seed)
+    source = os.path.dirname(os.path.abspath(__file__))
+    folder = tempfile.mkdtemp()
+    for name in ["catalog3.py", "catalogStore.py", "deviceOutbox.py", "MyMQTT.py", "mycat.json"]:
+        shutil.copy(os.path.join(source, name), folder)
+    print("Seed", seed, "- files in", folder)
+    acknowledged = set()
+    failed = 0
+    for i in range(kills):
+        point = random.choice(points)
+        count = random.randint(1, 200)
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "writer", folder, point, str(count), str(max(acknowledged | set([0])) + 1)], stdout=subprocess.PIPE, text=True)
+        timer = threading.Timer(random.uniform(0.5, 2) if point == "random" else 10, process.kill) # Also if the injection point is not reached
+        timer.start()
+        for line in process.stdout:
+            if line.startswith("ack "):
+                acknowledged.add(int(line[4:]))
+        process.wait()
+        timer.cancel()
+        found = reload(folder)
+        lost = sorted(acknowledged - found)
+        print("%4d %8s %6d %10d acknowledged %10s" % (i + 1, point, count, len(acknowledged), "OK" if len(lost) == 0 else "LOST " + str(lost[:10])))
+        if len(lost) > 0:
+            failed += 1
+            acknowledged -= set(lost) # Counted once
+    if failed == 0:
+        shutil.rmtree(folder)
+    print("Acknowledged records lost after", failed, "kills out of", kills)
+    sys.exit(1 if failed > 0 else 0)
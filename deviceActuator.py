@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import requests
+import threading
+import collections
+from MyMQTT import MyMQTT
+
+'''
+Requests that TimeShift sends to the smart cases to switch on and off the alarm and the leds ("PUT <deviceURI>/alarm",
+"PUT <deviceURI>/led"). The scheduling thread and the MQTT callbacks only queue the request, so an alarm is never late
+because the devices of the alarms before it are slow to answer.
+A pool of "workers" threads sends the queued requests. Every thread keeps its own session, so the connection to a device
+is opened once and kept alive for the next requests. The requests for the same device are sent one at a time, in the same
+order in which they were queued (ex. the led is never switched off before it is switched on), and by the same thread, so
+the "alarm" and the "led" of an alarm share the connection. A request that fails (connection error, timeout or 5xx answer)
+is sent again up to "retries" times, after a delay that doubles at every attempt: the alarms are not kept if they cannot be
+delivered, since they would be useless later.
+For every request it measures the latency from the instant the alarm was due (or the message was received) to the answer
+of the device: when all the queued requests have been sent, a summary is printed, and stats() returns the percentiles of
+the last requests.
+With "actuation": "mqtt" in the catalog, the same requests are sent by the CommandPublisher as MQTT messages on the command
+topics of the devices, instead of HTTP requests.
+'''
+
+class DeviceActuator(object):
+
+    def __init__(self, workers=16, timeout=5, retries=2, retryBase=0.5, history=1000):
+        self.workers = workers # Requests sent at the same time, to different devices
+        self.timeout = timeout # Seconds waited for the answer of a device
+        self.retries = retries # Attempts after the first one
+        self.retryBase = retryBase # Seconds waited before the first retry
+        self.pending = {} # Device -> requests still to be sent to the device: (path, body, epoch since which the latency is measured)
+        self.ready = collections.deque() # Devices with requests, not being served by a worker
+        self.busy = set() # Devices being served by a worker. Their new requests wait until it finishes
+        self.condition = threading.Condition() # Protects the queues and wakes up the workers when a request is queued
+        self.latencies = collections.deque(maxlen=history) # Seconds from the alarm to the answer, for the last requests
+        self.burst = {"sent": 0, "failed": 0, "total": 0.0, "max": 0.0} # Requests since the queue was last empty
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+
+        for i in range(self.workers):
+            ActuatorThread(self).start()
+
+    def put(self, device, deviceURI, path, body, since=None): # Queue a request for the device "userID/deviceID", reachable at deviceURI. since is the instant from which the latency is measured (now if not given)
+
+        self.condition.acquire()
+        if deviceURI not in self.pending:
+            self.pending[deviceURI] = []
+            if deviceURI not in self.busy:
+                self.ready.append(deviceURI)
+                self.condition.notify()
+        self.pending[deviceURI].append((path, body, since if since != None else time.time()))
+        self.condition.release()
+
+    def process(self, session): # Wait for a device with requests, and send them all
+
+        self.condition.acquire()
+        while len(self.ready) == 0:
+            self.condition.wait()
+        deviceURI = self.ready.popleft()
+        messages = self.pending.pop(deviceURI)
+        self.busy.add(deviceURI)
+        self.condition.release()
+        results = []
+        for path, body, since in messages:
+            delivered = self.send(session, deviceURI + path, body)
+            results.append((delivered, time.time() - since))
+        self.condition.acquire()
+        self.busy.discard(deviceURI)
+        if deviceURI in self.pending: # Queued while we were sending
+            self.ready.append(deviceURI)
+            self.condition.notify()
+        for delivered, latency in results:
+            self.record(delivered, latency)
+        if len(self.pending) == 0 and len(self.busy) == 0: # Everything sent
+            self.report()
+        self.condition.release()
+
+    def send(self, session, uri, body): # Send a request to a device, retrying if it fails. Return False if it was not delivered
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.retryBase * 2 ** (attempt - 1))
+            try:
+                response = session.put(uri, data=body, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                print("[", time.ctime(), "] - Request PUT", uri, "failed (attempt", str(attempt + 1) + "):", e.__class__.__name__)
+                continue
+            if response.status_code < 500:
+                return True
+            print("[", time.ctime(), "] - Request PUT", uri, "failed (attempt", str(attempt + 1) + "): status", response.status_code)
+        return False
+
+    def record(self, delivered, latency): # Count a request that was delivered (with its latency) or not. Called with condition acquired
+
+        if delivered:
+            self.sent += 1
+            self.burst["sent"] += 1
+            self.burst["total"] += latency
+            self.burst["max"] = max(self.burst["max"], latency)
+            self.latencies.append(latency)
+        else:
+            self.failed += 1
+            self.burst["failed"] += 1
+
+    def report(self): # Print the latency of the requests since the last report. Called with condition acquired, when nothing is left to send
+
+        burst = self.burst
+        self.burst = {"sent": 0, "failed": 0, "total": 0.0, "max": 0.0}
+        if burst["sent"] > 0:
+            print("[", time.ctime(), "] -", burst["sent"], "requests to the devices, latency from the alarm: avg %.0f ms, max %.0f ms," % (burst["total"] / burst["sent"] * 1000, burst["max"] * 1000), burst["failed"], "failed")
+        elif burst["failed"] > 0:
+            print("[", time.ctime(), "] -", burst["failed"], "requests to the devices failed")
+
+    def stats(self): # Number of requests sent and failed, and percentiles of the latency of the last ones (seconds)
+
+        self.condition.acquire()
+        latencies = sorted(self.latencies)
+        stats = {"sent": self.sent, "failed": self.failed, "pending": sum([len(messages) for messages in self.pending.values()])}
+        self.condition.release()
+        if len(latencies) > 0:
+            for name, q in [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]:
+                stats[name] = latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+            stats["max"] = latencies[-1]
+        return stats
+
+# Thread of the pool that sends the requests queued in the actuator
+class ActuatorThread(threading.Thread):
+
+    def __init__(self, actuator):
+        threading.Thread.__init__(self)
+        self.actuator = actuator
+        self.daemon = True # The requests still queued at shutdown are useless anyway
+        self.session = requests.Session() # Connections kept alive to the devices served by this thread
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=1))
+
+    def run(self):
+        while True:
+            self.actuator.process(self.session)
+
+class CommandPublisher(DeviceActuator):
+    '''
+    Same requests as DeviceActuator, published on the command topics of the devices, that are subscribed to them:
+    - baseTopic/<userID>/<deviceID>/cmd/alarm: {"bn": ..., "on": 0 or 1}
+    - baseTopic/<userID>/<deviceID>/cmd/led: {"bn": ..., "leds": [{"slotID": slot, "on": 0 or 1}, ...]}
+    The requests queued for the same device within "linger" seconds (ex. the leds of all the slots of the same dose) are sent
+    as a single message, keeping only the last value of every slot. A single publish reaches the device through the broker,
+    so no deviceURI or connection to the device is needed.
+    With acks, every message also has an "id" and "ack": 1, and the device answers {"id": id} on baseTopic/<userID>/<deviceID>/cmd/ack:
+    the latency is measured until the answer, and a message that is not answered within timeout seconds is published
+    again, up to retries times. Without acks, the latency is measured until the message is handed to the client
+    '''
+
+    def __init__(self, clientID, broker, port, baseTopic, acks=False, linger=0.02, timeout=5, retries=2, history=1000):
+        DeviceActuator.__init__(self, 1, timeout, retries, 0, history)
+        self.client = MyMQTT(clientID, broker, port, self)
+        self.baseTopic = baseTopic
+        self.acks = acks
+        self.linger = linger # Seconds waited after the first request, for the other requests of the same alarm
+        self.waiting = {} # id -> [topic, message, epoch since which the latency is measured, deadline, attempts], for the messages not answered yet
+        self.nextID = 1
+
+    def start(self):
+
+        self.client.start()
+        if self.acks:
+            self.client.mySubscribe(self.baseTopic + "/+/+/cmd/ack")
+        ActuatorThread(self).start()
+
+    def stop(self):
+
+        self.client.stop()
+
+    def put(self, device, deviceURI, path, body, since=None): # The deviceURI is not needed: the device is reached through its topics
+
+        self.condition.acquire()
+        if len(self.pending) == 0:
+            self.condition.notify()
+        self.pending.setdefault(device, []).append((path, body, since if since != None else time.time()))
+        self.condition.release()
+
+    def process(self, session): # Wait for requests, and publish one message for every device and command. The session is not used
+
+        self.condition.acquire()
+        wait = self.expire()
+        if len(self.pending) == 0:
+            self.condition.wait(wait)
+            self.condition.release()
+            return
+        self.condition.release()
+        time.sleep(self.linger) # The other requests of the same alarm are queued in the meantime
+        self.condition.acquire()
+        pending = self.pending
+        self.pending = {}
+        for device, messages in pending.items():
+            alarm = None
+            leds = {} # slotID -> last value. The order of the slots is kept
+            since = min([message[2] for message in messages])
+            for path, body, received in messages:
+                body = json.loads(body)
+                if path == "/alarm":
+                    alarm = body
+                else:
+                    leds[int(body["slotID"])] = int(body["on"])
+                    bn = body.get("bn")
+            if alarm != None:
+                self.publish(self.baseTopic + "/" + device + "/cmd/alarm", {"bn": alarm.get("bn"), "on": alarm["on"]}, since)
+            if len(leds) > 0:
+                self.publish(self.baseTopic + "/" + device + "/cmd/led", {"bn": bn, "leds": [{"slotID": slot, "on": on} for slot, on in leds.items()]}, since)
+        if len(self.waiting) == 0:
+            self.report()
+        self.condition.release()
+
+    def publish(self, topic, message, since): # Called with condition acquired
+
+        if self.acks:
+            message["id"] = self.nextID
+            message["ack"] = 1
+            self.waiting[self.nextID] = [topic, message, since, time.time() + self.timeout, 0]
+            self.nextID += 1
+        self.client.myPublish(topic, message, 1) # A command can be received twice without harm
+        if not self.acks:
+            self.record(True, time.time() - since)
+
+    def expire(self): # Publish again the messages not answered in time. Return the seconds until the next deadline (None if there is none). Called with condition acquired
+
+        now = time.time()
+        wait = None
+        for id, entry in list(self.waiting.items()):
+            topic, message, since, deadline, attempts = entry
+            if deadline <= now:
+                if attempts < self.retries:
+                    print("[", time.ctime(), "] - Command", topic, "not acknowledged (attempt", str(attempts + 1) + ")")
+                    entry[3] = now + self.timeout
+                    entry[4] += 1
+                    self.client.myPublish(topic, message, 1)
+                else:
+                    print("[", time.ctime(), "] - Command", topic, "failed: not acknowledged")
+                    del self.waiting[id]
+                    self.record(False, 0)
+                    if len(self.waiting) == 0 and len(self.pending) == 0:
+                        self.report()
+                    continue
+            if wait == None or entry[3] - now < wait:
+                wait = entry[3] - now
+        return wait
+
+    def notify(self, topic, payload): # Acknowledgement of a command from a device
+
+        id = json.loads(payload).get("id")
+        self.condition.acquire()
+        entry = self.waiting.pop(id, None)
+        if entry != None:
+            self.record(True, time.time() - entry[2])
+            if len(self.waiting) == 0 and len(self.pending) == 0:
+                self.report()
+        self.condition.release()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import requests
+import threading
+from catalogStore import syncDirectory
+
+'''
+Outbox of the requests that the catalog sends to the smart cases (ex. "PUT <deviceURI>/userID" when a device is registered,
+"DELETE <deviceURI>/dissociate" when it is removed). The catalog only queues the request while it modifies its content,
+so a slow or unreachable device never blocks the other requests of the catalog.
+A pool of "workers" threads sends the queued requests, each one to a different device, so an unreachable device only delays its
+own requests. A request that fails (connection error, timeout or 5xx answer) is sent again after a delay that doubles at every
+attempt, up to retryMax seconds. The requests for the same device are sent one at a time, by one worker at a time, in the same
+order in which they were queued, so a device never receives a "dissociate" before the "userID" that preceded it.
+The queue is saved in the outbox file ("outbox.json") every time it changes, so the requests not yet delivered are sent
+again after a restart of the catalog.
+'''
+
+class DeviceOutbox(object):
+
+    def __init__(self, filename, timeout=5, retryBase=1, retryMax=300, workers=8):
+        self.filename = filename # Requests not yet delivered
+        self.workers = workers # Requests sent at the same time, to different devices
+        self.timeout = timeout # Seconds waited for the answer of a device
+        self.retryBase = retryBase # Seconds waited before the first retry
+        self.retryMax = retryMax # Maximum number of seconds between two attempts
+        self.messages = [] # Queued requests, in the order in which they must be sent
+        self.busy = set() # Devices to which a worker is sending a request. Their next requests wait until it finishes
+        self.nextID = 1
+        self.dirty = False # True if the queue changed after it was saved
+        self.condition = threading.Condition() # Protects the queue and wakes up the sender when a request is queued
+        self.saveLock = threading.Lock() # The sender and the shutdown must not write the file at the same time
+
+    def load(self): # Read the requests that were not delivered before the last shutdown
+
+        if os.path.isfile(self.filename):
+            with open(self.filename) as fp:
+                self.messages = json.load(fp)
+            if len(self.messages) > 0:
+                self.nextID = max([message["id"] for message in self.messages]) + 1
+                print("\n[", time.ctime(), "] -", len(self.messages), "requests to the devices still to be delivered")
+
+    def start(self):
+
+        self.load()
+        for i in range(self.workers):
+            OutboxThread(self).start()
+
+    def put(self, method, uri, body=None): # Queue a request for a device. It only works in memory, so it can be called while the catalog is being modified
+
+        self.condition.acquire()
+        self.messages.append({"id": self.nextID, "method": method, "uri": uri, "body": body, "attempts": 0, "due": 0})
+        self.nextID += 1
+        self.dirty = True
+        self.condition.notify()
+        self.condition.release()
+
+    def device(self, message): # Address of the device a request is for
+
+        return message["uri"].rsplit("/", 1)[0]
+
+    def ready(self): # Return the oldest request that can be sent now (None if there is none), and the seconds until the next one can be sent (None if there are none). Called with condition acquired
+
+        now = time.time()
+        wait = None
+        devices = set() # Only the oldest request of every device can be sent, and only if no worker is sending to the device
+        for message in self.messages:
+            device = self.device(message)
+            if device in devices:
+                continue
+            devices.add(device)
+            if device in self.busy:
+                continue
+            if message["due"] <= now:
+                return message, wait
+            if wait == None or message["due"] - now < wait:
+                wait = message["due"] - now
+        return None, wait
+
+    def process(self): # Wait for a request to send, and send it. Called by every worker
+
+        self.condition.acquire()
+        message, wait = self.ready()
+        if message == None and not self.dirty:
+            self.condition.wait(wait)
+            message, wait = self.ready()
+        if message != None:
+            self.busy.add(self.device(message))
+        self.condition.release()
+        self.save() # The request is on disk before it is sent
+        if message == None:
+            return
+        delivered = self.send(message)
+        self.condition.acquire()
+        self.busy.discard(self.device(message))
+        if delivered:
+            self.messages.remove(message)
+        else:
+            message["attempts"] += 1
+            message["due"] = time.time() + min(self.retryMax, self.retryBase * 2 ** (message["attempts"] - 1))
+        self.dirty = True
+        self.condition.notify() # The next request of the device can be sent by a worker that is waiting
+        self.condition.release()
+        self.save()
+
+    def send(self, message): # Send a request to a device. Return False if it must be sent again
+
+        try:
+            response = requests.request(message["method"], message["uri"], data=message["body"], timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            print("\n[", time.ctime(), "] - Request", message["method"], message["uri"], "failed (attempt", str(message["attempts"] + 1) + "):", e.__class__.__name__)
+            return False
+        if response.status_code >= 500:
+            print("\n[", time.ctime(), "] - Request", message["method"], message["uri"], "failed (attempt", str(message["attempts"] + 1) + "): status", response.status_code)
+            return False
+        return True
+
+    def save(self): # Write the queue on the outbox file, if it changed. The file is replaced at once, so it is never found half written
+
+        self.saveLock.acquire()
+        self.condition.acquire()
+        if not self.dirty:
+            self.condition.release()
+            self.saveLock.release()
+            return
+        data = json.dumps(self.messages)
+        self.dirty = False
+        self.condition.release()
+        tmpFile = self.filename + ".tmp"
+        with open(tmpFile, "w") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpFile, self.filename)
+        syncDirectory(self.filename)
+        self.saveLock.release()
+
+    def close(self): # Save the requests not yet delivered. Called at shutdown
+
+        self.save()
+
+# Thread of the pool that sends the requests queued in the outbox
+class OutboxThread(threading.Thread):
+
+    def __init__(self, outbox):
+        threading.Thread.__init__(self)
+        self.outbox = outbox
+        self.daemon = True # At shutdown the queue is saved by close()
+
+    def run(self):
+        while True:
+            self.outbox.process()
@@ -2,6 +2,7 @@ import json
 import time
 import requests
 import paho.mqtt.client as PahoMQTT
+from MyMQTT import presenceWill, presenceOnline, presenceOffline
 
 confFile = "conf.json"
 
@@ -13,7 +14,11 @@ class OpeningControl:
         self.clientID=clientID
         self.baseTopic=baseTopic
         self.sub_topic_external=baseTopic+"/+/+/lid"
+        self.presenceTopic=baseTopic+"/presence/openingControl" # Retained status of the service, followed by the catalog
+        self.resync=True # True when the opening times must be read again from the catalog, since some lid messages may have been lost
+        self.openingTimes=[] # Devices currently opened, as in the "times" list of the catalog
         self._paho_mqtt= PahoMQTT.Client(clientID,True)
+        presenceWill(self._paho_mqtt, self.presenceTopic)
         self.catalogURI=catalogURI 
         self._paho_mqtt.on_connect=self.myOnConnect
         self._paho_mqtt.on_message=self.myOnMessageReceived
@@ -27,6 +32,8 @@ class OpeningControl:
     
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
         print("\n[",time.ctime(),"] - Opening Control connected to", self.broker, "with result code", rc)
+        presenceOnline(self._paho_mqtt, self.presenceTopic)
+        self.resync=True
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
         self.notify(msg.topic, msg.payload)
@@ -52,6 +59,7 @@ class OpeningControl:
         self._paho_mqtt.unsubscribe(self.sub_topic_external)
         
     def stop(self):
+        presenceOffline(self._paho_mqtt, self.presenceTopic)
         self.unsubscribe()
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -67,11 +75,13 @@ class OpeningControl:
                 "timeOpened": payload["e"]["timestamp"]
             }
             requests.put(self.catalogURI+"addOpeningTime", data = json.dumps(stats)) # Save the opening time on the catalog
+            self.openingTimes = self.openingTimes + [stats] # Keep also our copy up to date, so the catalog does not have to be asked again
             print("\n[",time.ctime(),"] - Device", deviceID, "of patient", patientID, "was opened.")
         
         elif payload["e"]["open"]==0: # If the case has just been closed
 
             requests.delete(self.catalogURI+"rmvOpeningTime/"+ patientID + "/" + deviceID) # Delete the record of the opening time from the catalog. No notification is needed.
+            self.openingTimes = [item for item in self.openingTimes if item["patientID/deviceID"] != patientID+"/"+deviceID]
             print("\n[",time.ctime(),"] - Device", deviceID, "of patient", patientID, "was closed.")
 
 if __name__=="__main__":
@@ -84,11 +94,18 @@ if __name__=="__main__":
     controller=OpeningControl(conf['broker'], conf["port"], conf["baseTopic"], "appPills-OpeningControl", catalogURI)
     baseTopic = conf["baseTopic"]
     controller.start()
+    presence = conf.get("presence", "http") # "mqtt": the catalog knows we are alive from the presence topic, so the opening times are read only after a (re)connection, and then kept up to date from the lid messages
+    timesETag = "" # Version of the opening times we have. The catalog sends them again only when they change
     while True:
-        # Ping every 5 seconds and get the latest opening times 
-        openingTimes = requests.put(catalogURI+"ping", data=json.dumps({"service": "openingControl"})).json()["times"]
+        if presence != "mqtt" or controller.resync:
+            controller.resync = False
+            # Ping every 5 seconds and get the latest opening times 
+            response = requests.put(catalogURI+"ping", data=json.dumps({"service": "openingControl"}), headers={"If-None-Match": timesETag})
+            if response.status_code != 304: # 304: the opening times did not change
+                controller.openingTimes = response.json()["times"]
+                timesETag = response.headers.get("ETag", "")
         now=time.time()
-        for item in openingTimes: # Check if there is a device opened for too much time 
+        for item in controller.openingTimes: # Check if there is a device opened for too much time 
             if float(now)-float(item["timeOpened"])>=float(timeThresh): # If the case was opened for more than the threshold
                 if item["patientID/deviceID"] in lastWarnings.keys(): # If we already sent a warning
                     if float(now)-float(lastWarnings[item["patientID/deviceID"]])>=float(timeThresh): # More than timeThresh minutes ago
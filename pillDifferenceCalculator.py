@@ -2,6 +2,7 @@ import json
 import time
 import requests
 import paho.mqtt.client as PahoMQTT
+from MyMQTT import presenceWill, presenceOnline, presenceOffline
 
 confFile = "conf.json"
 
@@ -13,7 +14,9 @@ class DifferenceCalculator:
         self.clientID=clientID
         self.baseTopic=baseTopic
         self.sub_topic_external=baseTopic+"/+/+/lid"
+        self.presenceTopic=baseTopic+"/presence/differenceCalculator" # Retained status of the service, followed by the catalog
         self._paho_mqtt= PahoMQTT.Client(clientID,True)
+        presenceWill(self._paho_mqtt, self.presenceTopic)
         self.catalogURI=catalogURI 
         self._paho_mqtt.on_connect=self.myOnConnect
         self._paho_mqtt.on_message=self.myOnMessageReceived
@@ -27,6 +30,7 @@ class DifferenceCalculator:
     
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
         print("\n[",time.ctime(),"] - Pill Difference Calculator connected to", self.broker, "with result code", rc)
+        presenceOnline(self._paho_mqtt, self.presenceTopic)
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
         self.notify(msg.topic, msg.payload)
@@ -52,6 +56,7 @@ class DifferenceCalculator:
         self._paho_mqtt.unsubscribe(self.sub_topic_external)
         
     def stop(self):
+        presenceOffline(self._paho_mqtt, self.presenceTopic)
         self.unsubscribe()
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -62,7 +67,7 @@ class DifferenceCalculator:
         payload=json.loads(msg)
         patientID=str(topic.split("/")[1])
         deviceID=str(topic.split("/")[2])
-        deviceURI=requests.get(self.catalogURI+"getDeviceURI"+"/"+patientID+"/"+deviceID).json()["deviceURI"] # Request the deviceURI, needed to retrieve the number of pills in each slot
+        deviceURI=requests.get(self.catalogURI+"device"+"/"+patientID+"/"+deviceID, params={"fields": "deviceURI"}).json().get("deviceURI") # Request the deviceURI, needed to retrieve the number of pills in each slot
         if deviceURI != None:
             if payload["e"]["open"]==1: # If the case was opened
                 
@@ -98,7 +103,9 @@ if __name__=="__main__":
     conf = requests.get(catalogURI+"conf").json() # Get the system configuration 
     controller=DifferenceCalculator(conf['broker'], conf["port"], conf["baseTopic"], "appPills-pillDifferenceCalculator", catalogURI)
     controller.start()
+    presence = conf.get("presence", "http") # "mqtt": the catalog knows we are alive from the presence topic, so no ping is needed
     while True:
         # Ping every 5 seconds
-        requests.put(catalogURI+"ping", data=json.dumps({"service": "differenceCalculator"}))
+        if presence != "mqtt":
+            requests.put(catalogURI+"ping", data=json.dumps({"service": "differenceCalculator"}))
         time.sleep(5) 
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+'''
+Benchmark of the requests about the relations between patients and assistants. For every size it generates a synthetic
+catalog (no devices) where one nurse follows "degree" patients, and measures the average time of:
+- getAssistantChatID, getAssistants: for a patient followed by the nurse
+- getAssistedPatients: for the nurse
+- assistUser + dissociatePatient: a new assistant starts and stops following a patient of the nurse
+The time of every request should grow with the number of relations involved, and not with the size of the catalog.
+Usage: python relationBenchmark.py [patients:degree ...]   (default: 10000:50 10000:500 100000:500 100000:5000)
+'''
+
+sizes = [(10000, 50), (10000, 500), (100000, 500), (100000, 5000)]
+repeat = 200 # Requests measured for every kind
+
+def makeCatalog(name, patients, degree): # Write a catalog where the nurse (the first assistant) follows the first degree patients
+
+    from catalogStore import writeSnapshot
+    catalog = {"ids": [patients + 2, 0]}
+    catalog.update(json.load(open(name))) # Copy of the real catalog file, for the configuration
+    nurse = patients + 1
+    catalog["patientList"] = ({"userID": userID, "userName": "patient" + str(userID), "password": "0000", "usage": "personal", "chatID": 100000000 + userID, "last_update": time.ctime(), "devices": [], "assistants": [{"assistantID": nurse}] if userID <= degree else []} for userID in range(1, patients + 1))
+    catalog["assistantList"] = [{"userID": nurse, "userName": "nurse", "chatID": 200000000, "last_update": time.ctime(), "assistedPatients": [{"patientID": userID} for userID in range(1, degree + 1)]},
+                                {"userID": nurse + 1, "userName": "doctor", "chatID": 200000001, "last_update": time.ctime(), "assistedPatients": []}]
+    catalog["newDevices"] = []
+    catalog["times"] = []
+    catalog["pillCount"] = []
+    with open(name, "w") as fp:
+        writeSnapshot(fp, catalog)
+    return nurse
+
+def measure(function, *args): # Average seconds of a request
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        function(*args)
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        sizes = [tuple([int(value) for value in arg.split(":")]) for arg in sys.argv[1:]]
+    source = os.path.dirname(os.path.abspath(__file__))
+    folder = tempfile.mkdtemp()
+    for name in ["catalog3.py", "catalogStore.py", "deviceOutbox.py", "MyMQTT.py", "mycat.json"]:
+        shutil.copy(os.path.join(source, name), folder)
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+    import catalog3
+    from catalogStore import JournalStore
+    template = open("mycat.json").read()
+    print("%10s %8s %20s %16s %20s %24s" % ("patients", "degree", "getAssistantChatID", "getAssistants", "getAssistedPatients", "assistUser+dissociate"))
+    for patients, degree in sizes:
+        open("mycat.json", "w").write(template)
+        nurse = makeCatalog("mycat.json", patients, degree)
+        catalog = catalog3.Catalog(JournalStore("mycat.json", catalog3.flushInterval, catalog3.compactionSize), None) # The modifications are only queued: nothing is written
+        catalog.getAssistantChatID(1) # Build the indexes before measuring
+        catalog.dissociatePatient(nurse + 1, 1)
+        doctor = {"username": "patient1", "password": "0000", "assistantID": nurse + 1}
+        def associate():
+            catalog.assistUser(doctor)
+            catalog.dissociatePatient(nurse + 1, 1)
+        times = [measure(catalog.getAssistantChatID, 1), measure(catalog.getAssistants, 1), measure(catalog.getAssistedPatients, nurse), measure(associate)]
+        print("%10d %8d %18.1fus %14.1fus %18.1fus %22.1fus" % tuple([patients, degree] + [seconds * 1e6 for seconds in times]))
+        catalog.store.lockFile.close()
+    shutil.rmtree(folder)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import random
+import resource
+from datetime import datetime
+
+'''
+Benchmark of the queue of the alarms of timeShift. For every size it queues that number of alarms, at random times of the
+day, plus "due" alarms that ring in the next "window" seconds, and then waits for them as the scheduling thread does
+(timeShift.nextEvent). It measures:
+- the time to queue all the alarms
+- how late every due alarm is returned (jitter), average and maximum
+- the CPU time used by the process while it waits, which should not depend on the number of alarms
+Usage: python schedulerBenchmark.py [number of alarms ...]   (default: 1000 100000)
+'''
+
+sizes = [1000, 100000]
+due = 20 # Alarms that ring during the measure
+window = 20 # Seconds of the measure
+
+def cpuTime():
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    import timeShift
+    print("%10s %10s %16s %16s %14s" % ("alarms", "load (s)", "avg late (ms)", "max late (ms)", "cpu (ms/s)"))
+    for size in sizes:
+        random.seed(size)
+        timeShift.lock.acquire()
+        for code in list(timeShift.MY_SCHED):
+            timeShift.removeAlarm(code)
+        start = time.perf_counter()
+        for i in range(size):
+            timeShift.setAlarm("%d/%d/slot%d/0/0+http://127.0.0.1:8090" % (i // 2 + 1, i + 1, i % 3), "%02d:%02d:%02d" % (random.randrange(24), random.randrange(60), random.randrange(60)))
+        loaded = time.perf_counter() - start
+        now = time.time()
+        for i in range(due): # One alarm every second, in the next whole seconds (the times of the day have no fractions)
+            timeShift.setAlarm("due/%d/slot0/0/0+http://127.0.0.1:8090" % i, datetime.fromtimestamp(int(now) + 2 + i * window // due).strftime('%H:%M:%S'))
+        timeShift.lock.release()
+        late = []
+        cpu = cpuTime()
+        start = time.time()
+        while len(late) < due:
+            when, kind, code = timeShift.nextEvent()
+            if code.startswith("due/"):
+                late.append(time.time() - when)
+        cpu = (cpuTime() - cpu) / (time.time() - start)
+        print("%10d %10.2f %16.2f %16.2f %14.2f" % (size, loaded, sum(late) / len(late) * 1000, max(late) * 1000, cpu * 1000))
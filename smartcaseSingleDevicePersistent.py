@@ -55,6 +55,31 @@ class SmartCase: # Class for stateful information of the case (pills in every sl
         self.assigned = savedData["assigned"]
         self.lidOpened = savedData["lidOpened"]
 
+    def updateAlarm(self, on): # Switch the alarm on (1) or off (0). From the REST interface or from the command topic
+        
+        self.alarmOn = on # Set the alarm to what is written in the payload
+        if on == 1:
+            self.alarmStartTime = time.time()
+            print("The alarm was turned on!")
+        else:
+            print("The alarm was turned off!")
+        threadLock.acquire()
+        self.save()
+        threadLock.release()
+
+    def updateLEDs(self, leds): # Switch on (1) or off (0) the leds of some slots: [{"slotID": slot, "on": 0 or 1}, ...]. The state is saved once for all of them
+        
+        for LED_info in leds:
+            slot = int(LED_info["slotID"])
+            self.ledOn[slot] = int(LED_info["on"])
+            if LED_info["on"] == 1:
+                print("The led of slot", slot, "was turned on!")
+            else:
+                print("The led of slot", slot, "was turned off!")
+        threadLock.acquire()
+        self.save()
+        threadLock.release()
+
     def save(self): # Method to save the statful information in the json file 
         json.dump({
             "numSlots": self.numSlots,
@@ -136,31 +161,45 @@ class SmartCaseRESTInterface(): # Class that implements the REST WebServer inter
     
     def update_alarm(self, alarm_info):
          
-        self.smartCase.alarmOn = alarm_info['on'] # Set the alarm to what is written in the payload
-        if alarm_info["on"] == 1:
-            self.smartCase.alarmStartTime = time.time()
-            print("The alarm was turned on!")
-        else:
-            print("The alarm was turned off!")
-        threadLock.acquire()
-        self.smartCase.save()
-        threadLock.release()
+        self.smartCase.updateAlarm(alarm_info['on'])
         return 1
         
     def update_LED(self, LED_info):
     
-        slot = int(LED_info["slotID"])
-        self.smartCase.ledOn[slot] = int(LED_info["on"])
-        if LED_info["on"] == 1:
-            print("The led of slot", slot, "was turned on!")
-        else:
-            print("The led of slot", slot, "was turned off!")
-        threadLock.acquire()
-        self.smartCase.save()
-        threadLock.release()
+        self.smartCase.updateLEDs([LED_info])
         return 1
 
 
+class CommandSubscriber(): # MQTT client that receives the commands for the alarm and the leds, as an alternative to the REST interface ("actuation": "mqtt" in the catalog)
+
+    def __init__(self, clientID, basetopic, broker, port, smartCase):
+        self.basetopic = basetopic
+        self.smartCase = smartCase
+        self.client = MyMQTT(clientID, broker, port, self)
+
+    def start(self):
+        self.client.start()
+        # The userID is not fixed in the topic, since the case may change user over time: the commands for a previous user are ignored
+        self.client.mySubscribe(self.basetopic + "/+/" + str(self.smartCase.deviceID) + "/cmd/+")
+
+    def stop(self):
+        self.client.stop()
+
+    def notify(self, topic, payload):
+        # basetopic/<userID>/<deviceID>/cmd/alarm: {"on": 0 or 1}
+        # basetopic/<userID>/<deviceID>/cmd/led: {"leds": [{"slotID": slot, "on": 0 or 1}, ...]} (or a single {"slotID": slot, "on": 0 or 1})
+        # If the command has "ack": 1, its "id" is sent back on basetopic/<userID>/<deviceID>/cmd/ack
+        userID, deviceID, command = topic.split("/")[-4], topic.split("/")[-3], topic.split("/")[-1]
+        if command not in ["alarm", "led"] or not self.smartCase.assigned or str(self.smartCase.userID) != userID:
+            return
+        body = json.loads(payload)
+        if command == "alarm":
+            self.smartCase.updateAlarm(body["on"])
+        else:
+            self.smartCase.updateLEDs(body.get("leds", [body]))
+        if body.get("ack") == 1:
+            self.client.myPublish(self.basetopic + "/" + userID + "/" + deviceID + "/cmd/ack", {"bn": "smartCase", "id": body.get("id"), "success": 1}, 1)
+
 class OpeningSimulator(): # MQTT client that simulates the publishing of the opening of the case 
     
     def __init__(self,clientID,topic,broker,port):
@@ -327,6 +366,8 @@ if __name__ == "__main__":
         print("\n[*] Device was registered to user with ID", smartcase.userID, "\n")
     Open_simul = OpeningSimulator(clientID,basetopic,broker,port)
     Open_simul.client.start()
+    commands = CommandSubscriber(clientID + "-cmd-" + str(smartcase.deviceID), basetopic, broker, port, smartcase) # Alarm and leds can also be switched on and off through MQTT
+    commands.start()
     thread3 = EnvironmentSimulatorThread("EnvironmentSimul",smartcase,broker,port)
     thread3.start()
 
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import subprocess
+
+'''
+Cold-start benchmark of the catalog. For every size (number of registered devices) it generates a synthetic catalog file,
+with the same structure of "mycat.json" (two devices for every patient, one assistant every ten patients), and then
+measures in a new process how long the catalog takes to be loaded, and the peak memory of the process, with:
+- "json": the catalog file read at once (json.load)
+- "stream": the catalog file read one line at a time while the catalog is built ("streamingLoad")
+- "sqlite": the SQLite database, filled from the catalog file before the measure
+It also measures the first request that needs the indexes by chatID, which are built the first time they are used.
+Usage: python startupBenchmark.py [number of devices ...]   (default: 10000 100000 1000000)
+'''
+
+sizes = [10000, 100000, 1000000]
+modes = ["json", "stream", "sqlite"]
+
+def writeCatalog(name, devices): # Write a synthetic catalog with the given number of registered devices, in the layout of the snapshots. The patients are generated while they are written, so even the biggest catalog is never in memory
+
+    from catalogStore import writeSnapshot
+    random.seed(devices)
+    catalog = {"ids": [devices // 2 + devices // 20, devices]}
+    catalog.update(json.load(open(name))) # Copy of the real catalog file, for the configuration
+    patients = devices // 2
+    catalog["patientList"] = (makePatient(userID) for userID in range(1, patients + 1))
+    catalog["assistantList"] = ({"userID": userID, "userName": "assistant" + str(userID), "chatID": 200000000 + userID, "last_update": time.ctime(), "assistedPatients": [{"patientID": userID - patients}]} for userID in range(patients + 1, patients + patients // 10 + 1))
+    catalog["newDevices"] = []
+    catalog["times"] = []
+    catalog["pillCount"] = []
+    with open(name, "w") as fp:
+        writeSnapshot(fp, catalog)
+
+def makePatient(userID): # Patient with two devices
+
+    patient = {"userID": userID, "userName": "patient" + str(userID), "password": "0000", "usage": "personal", "chatID": 100000000 + userID, "last_update": time.ctime(), "devices": [], "assistants": []}
+    for deviceID in [2 * userID - 1, 2 * userID]:
+        slots = [{"pillName": "pill" + str(slotNum), "schedule": [{"alarm": 0, "numPill": 1, "time": "%02d:%02d:00" % (random.randrange(24), random.randrange(60))} for i in range(2)]} for slotNum in range(3)]
+        patient["devices"].append({"deviceID": deviceID, "deviceURI": "http://127.0.0.1:8090", "thingSpeakChannel": "", "tempUpperThresh": 30.0, "tempLowerThresh": 10.0, "humUpperThresh": 60.0, "humLowerThresh": 40.0, "numSlots": 3, "slots": slots})
+    return patient
+
+def measure(mode, folder): # Load the catalog in this process, and print the times and the peak memory
+
+    os.chdir(folder)
+    sys.path.insert(0, folder)
+    import catalog3
+    from catalogStore import JournalStore, SQLiteStore
+    start = time.perf_counter()
+    if mode == "sqlite":
+        store = SQLiteStore("mycat.db", "mycat.json", catalog3.flushInterval)
+    else:
+        store = JournalStore("mycat.json", catalog3.flushInterval, catalog3.compactionSize, mode == "stream")
+    catalog = catalog3.Catalog(store, None)
+    loaded = time.perf_counter() - start
+    start = time.perf_counter()
+    catalog.getUserID(100000001)
+    lookup = time.perf_counter() - start
+    if mode == "sqlite" and store.migrate: # First use of the database: write it, so that the next process finds it filled
+        store.start(catalog.state)
+        store.close()
+    print(json.dumps({"load": loaded, "lookup": lookup, "memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+def run(mode, folder):
+
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "measure", mode, folder], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] == ["measure"]:
+        measure(sys.argv[2], sys.argv[3])
+        sys.exit()
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    source = os.path.dirname(os.path.abspath(__file__))
+    print("%10s %8s %10s %12s %12s" % ("devices", "mode", "load (s)", "lookup (ms)", "memory (MB)"))
+    for size in sizes:
+        folder = tempfile.mkdtemp()
+        for name in ["catalog3.py", "catalogStore.py", "deviceOutbox.py", "MyMQTT.py", "mycat.json"]:
+            shutil.copy(os.path.join(source, name), folder)
+        writeCatalog(os.path.join(folder, "mycat.json"), size)
+        run("sqlite", folder) # Fill the database
+        for mode in modes:
+            result = run(mode, folder)
+            print("%10d %8s %10.2f %12.2f %12.1f" % (size, mode, result["load"], result["lookup"] * 1000, result["memory"]))
+        shutil.rmtree(folder)
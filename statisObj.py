@@ -92,14 +92,14 @@ class Statistics:
 class ListStat(Statistics):
     def __init__(self):
         self.listData = []
+        self.devices = {} # "patientID/deviceID" -> its Statistics in listData, so that a device is found without scanning the list
         print("list created")
         
     def isPresent(self, patientID, deviceID):
         x =0 
         # check if the couple patient-device is already present in the list 
-        for item in self.listData:
-            if item.getIDs() == str(patientID)+"/"+ str(deviceID):
-                x = 1
+        if str(patientID)+"/"+ str(deviceID) in self.devices:
+            x = 1
         # if it returns 0 it is not present, if return 1, it already exists
         return x 
         
@@ -108,16 +108,23 @@ class ListStat(Statistics):
         if self.isPresent(patientID, deviceID) == 0: 
             newDev = Statistics(patientID, deviceID, num)
             self.listData.append(newDev)
+            self.devices[newDev.getIDs()] = newDev
         else: 
             print("The device is already registered in the list")
+            
+    def removeDev(self, patientID, deviceID):
+        # the device is followed by another instance of TimeShift, that will send its statistics
+        item = self.devices.pop(str(patientID)+"/"+ str(deviceID), None)
+        if item != None:
+            self.listData.remove(item)
 
     def updateVal(self, patientID, deviceID, slot, value):          
         # given the patient and device ids,update value
-        for item in self.listData:
-            if item.getIDs() == str(patientID)+"/"+ str(deviceID):
-                print("value updated")
-                item.updateValue(slot, value)
-        if self.isPresent(patientID, deviceID) == 0: 
+        item = self.devices.get(str(patientID)+"/"+ str(deviceID))
+        if item != None:
+            print("value updated")
+            item.updateValue(slot, value)
+        else: 
             print("Device not present in the list")
             
     def resetVal(self):
@@ -143,9 +150,9 @@ class ListStat(Statistics):
     
     def isPillTaken(self, patientID, deviceID,slot):
         if self.isPresent(patientID, deviceID) == 1:
-           for item in self.listData:
-            if item.getIDs() == str(patientID)+"/"+ str(deviceID):
-                return item.pillTaken(slot)
+            item = self.devices[str(patientID)+"/"+ str(deviceID)]
+            item.resetTime() # a pill taken more than 1 hour ago does not count: checked now, instead of resetting all the devices periodically
+            return item.pillTaken(slot)
         else:
             print("patient and device not in the list")
     
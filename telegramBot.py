@@ -4,6 +4,7 @@ from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 import json
 import time
 import paho.mqtt.client as PahoMQTT
+from MyMQTT import presenceWill, presenceOnline, presenceOffline
 import requests
 import os
 import imgkit 
@@ -33,7 +34,7 @@ def representsInt(s):
 
 class TelegramBot:
 
-    def __init__(self, token, clientID, broker, port, baseTopic, catalogURI, chatStatesFilename):
+    def __init__(self, token, clientID, broker, port, baseTopic, catalogURI, chatStatesFilename, actuation="http"):
 
         self.tokenBot=token
         self.bot=telepot.Bot(self.tokenBot)
@@ -41,11 +42,15 @@ class TelegramBot:
         self.broker=broker
         self.port=port
         self.catalogURI=catalogURI
+        self.baseTopic=baseTopic
+        self.actuation=actuation # "mqtt": the devices are rung through their command topics, instead of a PUT to their deviceURI
         self.timeShiftTopic=baseTopic+"/+/+/timeShift"
         self.conservControlTopic=baseTopic+"/+/+/conservationControl"
         self.openingControlTopic=baseTopic+"/+/+/openingControl"
+        self.presenceTopic=baseTopic+"/presence/telegramBot" # Retained status of the service, followed by the catalog
         self.pillDifferenceTopic=baseTopic+"/+/+/pillDifference"
         self._paho_mqtt=PahoMQTT.Client(self.clientID, True)
+        presenceWill(self._paho_mqtt, self.presenceTopic)
         self._paho_mqtt.on_connect=self.myOnConnect
         self._paho_mqtt.on_message=self.myOnMessageReceived
         MessageLoop(self.bot, {"chat" : self.on_chat_message, 'callback_query':self.on_callback_query}).run_as_thread()
@@ -59,6 +64,7 @@ class TelegramBot:
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
 
         print("\n[",time.ctime(),"] - TelegramBot connected to", self.broker, "with result code", rc)
+        presenceOnline(self._paho_mqtt, self.presenceTopic)
     
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
 
@@ -85,6 +91,7 @@ class TelegramBot:
 
     def stop(self):
 
+        presenceOffline(self._paho_mqtt, self.presenceTopic)
         self.unsubscribe(self.conservControlTopic)
         self.unsubscribe(self.timeShiftTopic)
         self.unsubscribe(self.openingControlTopic)
@@ -100,7 +107,8 @@ class TelegramBot:
         deviceID=str(topic.split("/")[2])
         sender=str(topic.split("/")[3]) # Microservice ClientID
         # Notifications come from MQTT messages from the microservices. These messages have the userID in the topic, therefore in order to send messages we need to find the correspondent chatID
-        chatID = requests.get(self.catalogURI+ "getChatID/" + patientID).json()["chatID"] 
+        device = requests.get(self.catalogURI+ "device/" + patientID + "/" + deviceID, params={"fields": "chatID,slotsName"}).json() # Everything needed for the notification, with a single request
+        chatID = device.get("chatID") 
         
         if chatID!=None:
 
@@ -110,7 +118,7 @@ class TelegramBot:
 
             if sender == "pillDifference": # Informs of pills being filled or taken
         
-                slotNames = requests.get(self.catalogURI+"getSlotsName/"+str(patientID)+"/"+str(deviceID)).json()["slots"] # Slot names, for better understanding
+                slotNames = device["slotsName"] # Slot names, for better understanding
                 difference = payload["e"]["difference"]
                 
                 for i,diff in enumerate(difference):
@@ -151,7 +159,7 @@ class TelegramBot:
             elif sender == "timeShift": # Informs of an alarm ringing, reminds to take the pill or informs that too much time has passed for taking the scheduled pill
 
                 slot = int(payload["e"]["slot"]) 
-                slotNames = requests.get(self.catalogURI+"getSlotsName/"+str(patientID)+"/"+str(deviceID)).json()["slots"]
+                slotNames = device["slotsName"]
                 
                 pillName = slotNames[slot] # Get the pill name for the slot of interest
 
@@ -165,6 +173,17 @@ class TelegramBot:
                 elif payload["e"]["message"] == 2: # Message 2 is the pill hasn't been taken for an hour, so it will be considered as not taken
                     self.bot.sendMessage(chatID, text="\U000026A0 Pill " + pillName + " from slot " + str(slot) + " of device " + str(deviceID) + " was not taken. No more notifications will be sent.")
 
+    def setAlarm(self, userID, deviceID, on): # Switch on (1) or off (0) the alarm of a device. Return False if the device was not found
+
+        if self.actuation == "mqtt": # The device is reached through the broker, and ignores the commands for the devices of other users
+            self._paho_mqtt.publish(self.baseTopic+"/"+str(userID)+"/"+str(deviceID)+"/cmd/alarm", json.dumps({"bn":self.clientID, "on":on}), 1)
+            return True
+        deviceURI=requests.get(self.catalogURI+"getDeviceURI/"+str(userID)+"/"+str(deviceID)).json()["deviceURI"] # We need to address the device directly
+        if deviceURI == None:
+            return False
+        requests.put(deviceURI+"/alarm", json.dumps({"on":on}))
+        return True
+
     def on_callback_query(self, msg): # Dealing with the callback queries, that are the button presses on Telegram
 
         query_ID, chat_ID, query_data = telepot.glance(msg, flavor='callback_query')
@@ -274,9 +293,7 @@ class TelegramBot:
 
         elif str(query_data).startswith("ring."): # User clicked on the ring device button 
             deviceID=query_data.split(".")[-1]
-            deviceURI=requests.get(self.catalogURI+"getDeviceURI/"+str(userID)+"/"+str(deviceID)).json()["deviceURI"] # We need to address the device directly
-            if deviceURI != None: # Error check
-                requests.put(deviceURI+"/alarm", json.dumps({"on":1})) # Start the alarm 
+            if self.setAlarm(userID, deviceID, 1): # Start the alarm. Error check
                 buttons=[]
                 buttons.append([InlineKeyboardButton(text= "Stop ringing", callback_data="stopRing.device."+str(deviceID))])
                 keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -286,9 +303,7 @@ class TelegramBot:
         
         elif str(query_data).startswith("stopRing."): # User clicked on the stop alarm 
             deviceID=query_data.split(".")[-1]
-            deviceURI=requests.get(self.catalogURI+"getDeviceURI/"+str(userID)+"/"+str(deviceID)).json()["deviceURI"]
-            if deviceURI != None:
-                requests.put(deviceURI+"/alarm", json.dumps({"on":0}))
+            if self.setAlarm(userID, deviceID, 0):
                 self.bot.sendMessage(chat_ID, text='Alarm was stopped')
             else:
                 self.bot.sendMessage(chat_ID, text='Error in finding the device')
@@ -601,11 +616,12 @@ if __name__=="__main__":
     catalogURI=json.load(open(confFile))["catalogURI"]
     conf = requests.get(catalogURI+"conf").json() # Get system configuration from the catalog
     token=conf["token"] # Get bot token
-    bot=TelegramBot(token, "SmartCase-telegramBot", conf["broker"], conf["port"], conf["baseTopic"], catalogURI, "chatStates.json")
+    bot=TelegramBot(token, "SmartCase-telegramBot", conf["broker"], conf["port"], conf["baseTopic"], catalogURI, "chatStates.json", conf.get("actuation", "http"))
     bot.start()
     lastPing = 0
+    presence = conf.get("presence", "http") # "mqtt": the catalog knows we are alive from the presence topic, so no ping is needed
     while True:
         time.sleep(0.1) # Need high reactivity for messages
-        if time.time() - lastPing > 5: # But lower frequency for pings (5 seconds)
+        if presence != "mqtt" and time.time() - lastPing > 5: # But lower frequency for pings (5 seconds)
             requests.put(catalogURI+"ping", data=json.dumps({"service": "telegramBot"}))
             lastPing = time.time()
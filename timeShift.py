@@ -2,13 +2,35 @@ import json
 import time
 import requests
 import paho.mqtt.client as PahoMQTT 
+from MyMQTT import presenceWill, presenceOnline, presenceOffline
+import sys
+import heapq
+import bisect
+import hashlib
+import functools
+import itertools
 import threading
 from datetime import datetime, timedelta
 from statisObj import ListStat
+from deviceActuator import DeviceActuator, CommandPublisher
 
 DAILY_LIST = [] 
 MY_SCHED = {}
-lock = threading.Lock()
+DEVICE_VERSIONS = {} # "patientID/deviceID" -> catalog version of the schedules in MY_SCHED for that device
+DEVICE_ALARMS = {} # "patientID/deviceID" -> (schedules of its slots as read from the catalog, code -> time of its alarms in MY_SCHED)
+RESYNC = threading.Event() # Set when the connection to the broker is (re)established: the modifications published in the meantime are lost, so all the schedules must be read again
+QUEUE = [] # Min-heap of the next instants at which the scheduling thread has something to do: (epoch, sequence number, kind, code)
+ENTRIES = {} # (kind, code) -> sequence number of its current entry in QUEUE: the older entries of the same code are skipped when they come out
+SEQUENCE = itertools.count()
+RESET_TIME = '23:59:50' # Time of the day at which the daily statistics are sent
+lock = threading.Condition() # Protects MY_SCHED, DEVICE_VERSIONS and QUEUE. The scheduling thread waits on it until the next instant, and it is woken up when an earlier one is added
+maxWait = 60 # Maximum seconds waited by the scheduling thread without looking at the clock again (ex. if the clock of the system is adjusted)
+batchSize = 500 # Devices asked to the catalog with a single "devices" request
+catalogTimeout = 10 # Seconds waited for an answer of the catalog when the schedules are read again
+SERVICE = "timeShift" # Name of this instance in the catalog. With more instances, each one is started with its own name (python timeShift.py <shard> -> "timeShift-<shard>")
+LAST_SEEN = {} # Instance of TimeShift -> last time it was seen alive in the catalog
+ACTUATOR = DeviceActuator() # Sends the requests to the devices with a pool of threads, so that the scheduling thread and the MQTT callbacks never wait for a device. With "actuation": "mqtt" in the catalog, a CommandPublisher publishes them on the command topics of the devices
+commandAcks = False # With "actuation": "mqtt", ask the devices to acknowledge every command: the latency is measured until the answer, and a command not answered is published again
 confFile = "conf.json"
 
 '''
@@ -17,18 +39,201 @@ from the catalog, it reads for each pair patient-device all the pills scheduled
 it creates a list in which it associates the time with patient-device ID, slot, numbers of pills 
 and alarm. When the catalog is updated, the list will be created again in order to not lose
 any new update.
-Every 5 seconds, it checks if any user has a pill scheduled, if that is the case, it will first check 
-whether the pill was taken in the previous hour, if it is not the case, it will send a message 
-to telegram to remind to take the pill.
+Every alarm is kept in a queue ordered by the next instant at which it rings, and the scheduling thread
+sleeps until the first one: when an alarm rings, it will first check whether the pill was taken in the 
+previous hour, if it is not the case, it will send a message to telegram to remind to take the pill. The
+alarm is then queued again for the same time of the next day.
 It will remind the user every 10 minutes to take the pill, after 1 hour it will consider it as not-taken.
 Moreover, it keeps track of the total number of pills taken by each pair patient-device and at the end 
 of the day, it will send the statistics to thingspeak.  
+More instances of TimeShift can run together (on the same or on different hosts), each one started with
+its own name: the pairs patient-device are shared among the instances alive in the catalog by consistent
+hashing, and each instance rings the alarms, reminds and sends the statistics only of its own devices.
+When an instance joins or leaves (its ping lapses, or its Last Will is published) the others read again
+the catalog and take or give away only the devices that move.
 '''
 
 
 def ch():
     MY_SCHED = {}
 
+@functools.lru_cache(maxsize=None)
+def parseTime(text): # "HH:MM:SS" -> time of the day. The same times are used by many alarms, so they are parsed only once
+    return datetime.strptime(text, '%H:%M:%S').time()
+
+def nextFire(text, after):
+    # epoch of the first instant after "after" (epoch) at which the clock shows the time of the day "HH:MM:SS"
+    # it is computed on the local date, so it is right also across midnight and when the clock changes for daylight saving time
+    day = datetime.fromtimestamp(after).date()
+    due = datetime.combine(day, parseTime(text)).timestamp()
+    if due <= after:
+        due = datetime.combine(day + timedelta(days=1), parseTime(text)).timestamp()
+    return due
+
+def schedule(kind, code, due):
+    # queue the next instant of an alarm ("alarm"), of a reminder ("remind") or of the statistics ("stat"), replacing the one it had. Called with lock acquired
+    seq = next(SEQUENCE)
+    ENTRIES[(kind, code)] = seq
+    if len(QUEUE) == 0 or due < QUEUE[0][0]: # The scheduling thread is waiting for a later instant
+        lock.notify()
+    heapq.heappush(QUEUE, (due, seq, kind, code))
+    if len(QUEUE) > 2 * len(ENTRIES) + 1000: # Too many entries that were replaced: remove them
+        QUEUE[:] = [entry for entry in QUEUE if ENTRIES.get((entry[2], entry[3])) == entry[1]]
+        heapq.heapify(QUEUE)
+
+def unschedule(kind, code): # Called with lock acquired. The entry stays in QUEUE, and it is skipped when it comes out
+    ENTRIES.pop((kind, code), None)
+
+def setAlarm(code, text, since=None): # Add or replace an alarm, ringing every day at "HH:MM:SS". If since is given, it rings immediately if it was due after since. Called with lock acquired
+    MY_SCHED[code] = text
+    schedule("alarm", code, nextFire(text, since if since != None else time.time()))
+
+def removeAlarm(code): # Called with lock acquired
+    del MY_SCHED[code]
+    unschedule("alarm", code)
+
+def nextEvent():
+    # wait for the first instant in the queue, and return (epoch, kind, code) when it comes. The alarms and the statistics
+    # are queued again for the next day. Nothing runs between two instants, however many alarms there are
+    lock.acquire()
+    while True:
+        now = time.time()
+        if len(QUEUE) == 0 or QUEUE[0][0] > now:
+            lock.wait(min(QUEUE[0][0] - now, maxWait) if len(QUEUE) > 0 else maxWait)
+            continue
+        due, seq, kind, code = heapq.heappop(QUEUE)
+        if ENTRIES.get((kind, code)) != seq: # Replaced or removed
+            continue
+        del ENTRIES[(kind, code)]
+        if kind == "alarm":
+            schedule(kind, code, nextFire(MY_SCHED[code], now))
+        elif kind == "stat":
+            schedule(kind, code, nextFire(RESET_TIME, now))
+        lock.release()
+        return due, kind, code
+
+def updateDevice(key, device, version, catchUp=None):
+    # replace the alarms of the device "patientID/deviceID" with the ones published by the catalog (device is None if it was removed).
+    # events and full reads can arrive out of order, so a version older than the one we have is ignored. Called with lock acquired
+    if version < DEVICE_VERSIONS.get(key, 0):
+        return
+    DEVICE_VERSIONS[key] = version
+    if device == None or not SHARDS.owns(key): # Removed, or its alarms are rung by another instance
+        if key in DEVICE_ALARMS and not SHARDS.owns(key): # Given to another instance, that will also send its statistics
+            DAILY_LIST.removeDev(key.split('/')[0], key.split('/')[1])
+        setDeviceAlarms(key, None, None)
+        return
+    if key not in DEVICE_ALARMS:
+        DAILY_LIST.addDev(key.split('/')[0], key.split('/')[1], device["numSlots"])
+    setDeviceAlarms(key, [slot["schedule"] for slot in device["slots"]], device["deviceURI"], catchUp)
+
+def setDeviceAlarms(key, schedule, deviceURI, catchUp=None):
+    # replace the alarms of the device "patientID/deviceID" with the ones in schedule (the list of the schedules of its slots, None if the device was removed).
+    # the code of an alarm is patient/device/slot/alarm/rep+deviceURI: only the codes added, removed or moved to another time are queued again,
+    # so the other alarms keep their place in the queue, and the reminders already running are not touched. Called with lock acquired
+    # catchUp (epoch) is given for a device taken from an instance that left: its alarms due after catchUp, when nobody was ringing them, ring immediately
+    old = DEVICE_ALARMS.pop(key, (None, {}))[1]
+    alarms = {}
+    if schedule != None:
+        for i, slot in enumerate(schedule):
+            temp2 = key + '/slot' + str(i)
+            rep = 0 
+            for sch in slot:
+                # add if alarm is on or off with 1 and 0 
+                code = temp2 + '/' + str(sch['alarm']) + '/' + str(rep) + '+' + deviceURI
+                rep = rep + 1
+                alarms[code] = str(sch['time'])
+        DEVICE_ALARMS[key] = (schedule, alarms)
+    for code in old:
+        if code not in alarms:
+            removeAlarm(code)
+    for code in alarms:
+        if old.get(code) != alarms[code]:
+            setAlarm(code, alarms[code], catchUp if len(old) == 0 else None)
+
+def fetchSchedules(catalogURI, since):
+    # read from the catalog what is needed to bring the alarms up to date. Called without the lock, so the scheduling thread keeps ringing
+    # the alarms while the catalog answers: the answer is applied afterwards by applySchedules, with the lock acquired.
+    # since is the last version of the catalog read without gaps (None to compare all the schedules): the devices modified after it are read from
+    # the "changes" of the catalog. If the catalog does not have them any more, all the schedules are read and compared with the ones we have,
+    # and the deviceURI and the number of slots are asked, with a few requests, only for the devices that are new or were modified
+    if since != None:
+        answer = requests.get(catalogURI+'changes', params={"since": since, "tables": "devices"}, timeout=catalogTimeout).json()
+        if "reset" not in answer:
+            return {"since": since, "version": answer["version"], "changes": answer["changes"].get("devices", {})}
+    catalogVersion = requests.get(catalogURI+'changes', timeout=catalogTimeout).json()["version"] # Version of the catalog we have: read before the schedules, so that no modification is lost
+    cat = requests.get(catalogURI+'getSchedules', timeout=catalogTimeout).json()
+    changed = [key for key in cat if SHARDS.owns(key) and DEVICE_ALARMS.get(key, (None,))[0] != cat[key]] # Read without the lock: a device modified in the meantime is fixed by applySchedules or by its event
+    devices = {}
+    for i in range(0, len(changed), batchSize):
+        devices.update(requests.get(catalogURI+'devices', params={"keys": ",".join(changed[i:i + batchSize]), "fields": "deviceURI,numSlots"}, timeout=catalogTimeout).json()["devices"])
+    return {"version": catalogVersion, "schedules": cat, "devices": devices, "changed": len(changed)}
+
+def applySchedules(answer, catchUp=None):
+    # apply an answer of fetchSchedules, and return the version of the catalog read. Called with lock acquired.
+    # the modifications received from the catalog while it was being read are newer, so they are kept (see updateDevice)
+    catalogVersion = answer["version"]
+    if "changes" in answer:
+        for key, device in answer["changes"].items():
+            updateDevice(key, device, catalogVersion)
+        print("[",time.ctime(),"] -", len(answer["changes"]), "devices modified since version", answer["since"])
+        return catalogVersion
+    cat = answer["schedules"]
+    devices = answer["devices"]
+    for key in [key for key in DEVICE_ALARMS if key not in cat or not SHARDS.owns(key)]: # Removed, or given to another instance
+        updateDevice(key, None, catalogVersion)
+    for key in cat:
+        if key in devices and devices[key]["found"] == 1:
+            updateDevice(key, {"numSlots": devices[key]["numSlots"], "deviceURI": devices[key]["deviceURI"], "slots": [{"schedule": schedule} for schedule in cat[key]]}, catalogVersion, catchUp)
+        elif key in DEVICE_ALARMS:
+            DEVICE_VERSIONS[key] = max(DEVICE_VERSIONS.get(key, 0), catalogVersion)
+    print("[",time.ctime(),"] - Schedules of", len(cat), "devices read,", answer["changed"], "of them new or modified")
+    return catalogVersion
+
+class ShardRing(object): 
+    # consistent hashing of the pairs patient-device among the instances of TimeShift that are alive. Every instance has "replicas" points
+    # on the ring, and a device belongs to the instance of the first point after the hash of "patientID/deviceID": when an instance joins
+    # or leaves, only the devices next to its points move, and all the instances agree on the owner of every device without talking to each other
+    
+    def __init__(self, name, replicas=100):
+        self.name = name # This instance
+        self.replicas = replicas
+        self.members = []
+        self.ring = ([], []) # Sorted points, and the instance of every point. Replaced at once, so it can be read without the lock
+        self.setMembers([])
+        
+    def hash(self, text):
+        return int(hashlib.md5(text.encode()).hexdigest()[:16], 16)
+    
+    def setMembers(self, members): # Instances alive (this one is always among them). Return True if they changed
+        members = sorted(set(members) | set([self.name]))
+        if members == self.members:
+            return False
+        points = sorted([(self.hash(member + "#" + str(i)), member) for member in members for i in range(self.replicas)])
+        self.ring = ([point for point, member in points], [member for point, member in points])
+        self.members = members
+        return True
+    
+    def owns(self, key): # True if the device "patientID/deviceID" belongs to this instance
+        points, owners = self.ring
+        return owners[bisect.bisect(points, self.hash(key)) % len(points)] == self.name
+
+SHARDS = ShardRing(SERVICE) # Instances of TimeShift that share the devices. Protected by lock
+
+def updateShards(alive):
+    # update SHARDS with the instances of TimeShift in the services alive in the catalog. Return None if they did not change, otherwise
+    # the time since which the devices taken from the instances that left were not rung (the last time they were seen alive). Called with lock acquired
+    members = dict([(service["service"], service["lastSeen"]) for service in alive if service["service"].split("-")[0] == "timeShift"])
+    left = [member for member in SHARDS.members if member not in members and member != SERVICE]
+    since = min([LAST_SEEN.get(member, time.time()) for member in left] + [time.time()])
+    for member in left:
+        LAST_SEEN.pop(member, None)
+    LAST_SEEN.update(members)
+    if not SHARDS.setMembers(list(members)):
+        return None
+    print("[",time.ctime(),"] - Instances of TimeShift:", ", ".join(SHARDS.members))
+    return since
+
 class TimeShift:
     
     def __init__(self, broker, port, baseTopic, clientID, catalogURI):
@@ -37,8 +242,11 @@ class TimeShift:
         self.clientID = clientID 
         self.baseTopic = baseTopic
         self.subTopic_opCon = baseTopic + "/+/+/pillDifference"
+        self.subTopic_catalog = baseTopic + "/catalog/devices/#" # Modifications of the devices, published by the catalog
+        self.presenceTopic = baseTopic + "/presence/" + SERVICE # Retained status of the service, followed by the catalog
         self.catalogURI = catalogURI
-        self._paho_mqtt = PahoMQTT.Client(clientID, True)
+        self._paho_mqtt = PahoMQTT.Client(clientID + SERVICE[len("timeShift"):], True) # Every instance needs its own client ID. The messages keep clientID as "bn"
+        presenceWill(self._paho_mqtt, self.presenceTopic)
         self._paho_mqtt.on_connect = self.myOnConnect
         self._paho_mqtt.on_message = self.myOnMessageReceived 
         self.__msg = {
@@ -51,7 +259,11 @@ class TimeShift:
         }
            
     def myOnConnect(self, paho_mqtt, userdata, flags, rc):
-        pass
+        # the subscriptions are lost with the connection (clean session): subscribe again at every (re)connection, before reading the catalog again
+        self.subscribe(self.subTopic_opCon)
+        self.subscribe(self.subTopic_catalog)
+        RESYNC.set() # Nothing published before now was received
+        presenceOnline(self._paho_mqtt, self.presenceTopic)
         #print("[",time.ctime(),"] - Time shift connected to", self.broker, "with result code", rc)
 
     def myOnMessageReceived(self, paho_mqtt, userdata, msg):
@@ -83,12 +295,13 @@ class TimeShift:
         self._paho_mqtt.connect(self.broker, self.port)
         self._paho_mqtt.loop_start()
         print("[",time.ctime(),"] - Time Shift", self.clientID, "started")
-        self.subscribe(self.subTopic_opCon)
         
     def unsubscribe(self):
         self._paho_mqtt.unsubscribe(self.subTopic_opCon)
+        self._paho_mqtt.unsubscribe(self.subTopic_catalog)
         
     def stop(self):
+        presenceOffline(self._paho_mqtt, self.presenceTopic)
         self.unsubscribe()
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
@@ -97,12 +310,21 @@ class TimeShift:
     def notify(self,topic,msg):
         payload = json.loads(msg)
                 #payload = json.loads(payload1)
+        if topic.startswith(self.baseTopic + "/catalog/"): # the schedules of a device changed: update them immediately
+            lock.acquire()
+            updateDevice("/".join(topic.split("/")[-2:]), payload["value"], payload["version"])
+            lock.release()
+            return
         patientID = str(topic.split("/")[1])
         deviceID = str(topic.split("/")[2])
+        if not SHARDS.owns(patientID + "/" + deviceID): # the pills of this device are counted by another instance
+            return
         # print("ricevuto")
         # for the particular "patientID/deviceID" update the daily statistics 
-        num = requests.get(self.catalogURI+"getSlotsNumber/"+patientID +'/'+deviceID).json()
-        num = int(num["slots"])
+        device = requests.get(self.catalogURI+"device/"+patientID +'/'+deviceID, params={"fields": "numSlots,deviceURI"}).json()
+        if device["found"] == 0:
+            return
+        num = int(device["numSlots"])
         
         slots = []
         for s in range(num):
@@ -112,14 +334,14 @@ class TimeShift:
             if payload["e"]["difference"][j]<0:
                 DAILY_LIST.updateVal(patientID, deviceID, slot, payload["e"]["difference"][j])
                 # Switch off the led
-                deviceURI = requests.get(self.catalogURI+"getDeviceURI/"+patientID+"/"+deviceID).json()["deviceURI"]
+                deviceURI = device["deviceURI"]
                 led_msg= {
                                 "bn":"appPills-TimeShift",
                                 'slotID':int(slot[-1]),
                                 'on':0 
                                 }
                 # send a post to turn off the led. We don't need to know if it was scheduled or not, since if the led was off, this request won't do anything
-                requests.put(url =deviceURI+"/led", data = json.dumps(led_msg))
+                ACTUATOR.put(patientID + "/" + deviceID, deviceURI, "/led", json.dumps(led_msg))
                 '''
                 alarm_msg= {
                                 "bn": "appPills-TimeShift",
@@ -130,8 +352,8 @@ class TimeShift:
               
         
 class SchedulingThread(threading.Thread):
-    """Scheduling thread to call strategy. In this thread the timeshift runs 
-    and the scheduled is checked every 5 sec"""
+    """Scheduling thread to call strategy. In this thread the timeshift runs: 
+    it sleeps until the next alarm, reminder or daily statistics in the queue"""
 
     def __init__(self, ThreadID, name, catalogURI):
         """Initialise thread."""
@@ -148,224 +370,168 @@ class SchedulingThread(threading.Thread):
         # create TimeShift 
         timeShift = TimeShift(conf["broker"], conf["port"], conf["baseTopic"], "appPills-TimeShift", self.catalogURI)
         timeShift.start() 
-        reset_time = '23:59:50'
         
-        # generates all time interval where actions need to be executed 
-        delta = timedelta(seconds=5) # minimum time 
-        delta1 = timedelta(hours=1,seconds=6) # max time in which patient can take the pill before it is counted as lost 
-        delta2 = timedelta(minutes=10) # every ten min remind a pill has to be taken
-        delta3 = timedelta(minutes=1) 
-        reminder = {}
+        delta1 = 3606 # max seconds in which patient can take the pill before it is counted as lost 
+        delta2 = 600 # every ten min remind a pill has to be taken
+        reminder = {} # code of the alarm -> epoch at which it rang, for the pills not taken yet
+        
+        lock.acquire()
+        schedule("stat", "", nextFire(RESET_TIME, time.time()))
+        lock.release()
         
-        #loop that runs every 5 sec that check the schedule and update the value inside DAILY_LIST
+        #loop that waits for the next instant in the queue and does what is due
         while(True):
-            #print('**')
-            lock.acquire()
-            DAILY_LIST.resetTime() 
-            lock.release()
-            now_time = datetime.now().strftime('%H:%M:%S') #REMEMBER, TIME IN TIME SHIFT IS HOUR:MIN:SEC  
+            due, kind, code = nextEvent()
             
             # SEND BEFORE THE MIDNIGNT ALL STATISTICS OF THE DAY 
-            # check if it's 11:59:00 to send the statistics to thinkspeak and reset the values
-            res_delta = datetime.strptime(now_time, '%H:%M:%S') - datetime.strptime(reset_time, '%H:%M:%S')
-          
-            if res_delta.days < 0: # check if midnight has passed
-                res_delta = timedelta(
-                    days=0,
-                    seconds=res_delta.seconds,
-                    microseconds=res_delta.microseconds
-                )
-            # if the difference between time in the schedule and current time is smaller than 5sec, send stat and reset value
-            if(res_delta)<delta: 
+            if kind == "stat": 
                 print("SEND ALL STATISTICS")
                 # send statistics about daily activity
                 data = DAILY_LIST.sendStatistics()
                 timeShift.pub_stat(data)
                 DAILY_LIST.resetVal()
+                continue
             
+            patID = code.split('/')[0]
+            devID = code.split('/')[1]
+            slot = code.split('/')[2]
+            deviceURI = code.split('+')[1]
             
-            # create a copy of MY_SCHED 
-            copyMY_SCHED = MY_SCHED.copy()
-           
-            # CHECK FOR ALL ELEMENTS IN SCHEDULA IF IT'S TIME TO TAKE PILL
+            # IT'S TIME TO TAKE THE PILL
             # before sending the message check if it was already taken in the previous hour 
-            for item in copyMY_SCHED:
-                #print(MY_SCHED[item])
-                tdelta = datetime.strptime(now_time, '%H:%M:%S') - datetime.strptime(MY_SCHED[item], '%H:%M:%S')
-                #print(tdelta)
-                if tdelta.days < 0: # check if midnight has passed
-                    tdelta = timedelta(
-                        days=0,
-                        seconds=tdelta.seconds,
-                        microseconds=tdelta.microseconds
-                    )
-    
-                # if the difference between time in the schedule and current time is smaller than 5sec, pill has to be taken
-                if(tdelta)<delta:  
-                    # check if it is already taken in the previous hour
-                    patID = item.split('/')[0]
-                    devID = item.split('/')[1]
-                    slot = item.split('/')[2]
-                    deviceURI = item.split('+')[1]
-                    
-                    if DAILY_LIST.isPillTaken(patID, devID, slot)==False:
-                        print("take the pill")
-                        # send a message to telegram bot to remind to take the pill 
-                        topic = patID +"/"+devID+"/timeShift"
-                        timeShift.publish(topic, 0, slot[-1])
-                        # check if the alarm is set on or off
-                        # if alarm is 0, do not send the message, if it is equal to 1 activate it
-                        #if item.split('/')[3][-1] == '1': 
-                        alarm_msg= {
-                            "bn": "appPills-TimeShift",
-                            "on": 1
-                            }
-                        requests.put(url =deviceURI+"/alarm", data = json.dumps(alarm_msg))
-                        led_msg= {
-                            "bn":"appPills-TimeShift",
-                            'slotID':int(slot[-1]),
-                            'on':1
-                            }
-                        print("TAKE THE PILL NOW!!!")
-                       
-                        requests.put(url =deviceURI+"/led", data = json.dumps(led_msg))
-                        reminder[item] = MY_SCHED[item]  # insert it in the reminder list 
-                    
+            if kind == "alarm":
+                if time.time() - due > delta1: # the service was not running (ex. the computer was suspended): the pill is already lost
+                    print("[",time.ctime(),"] - Alarm", code.split('+')[0], "skipped, it was due at", time.ctime(due))
+                    continue
+                if DAILY_LIST.isPillTaken(patID, devID, slot)==False:
+                    print("take the pill")
+                    # send a message to telegram bot to remind to take the pill 
+                    topic = patID +"/"+devID+"/timeShift"
+                    timeShift.publish(topic, 0, slot[-1])
+                    # check if the alarm is set on or off
+                    # if alarm is 0, do not send the message, if it is equal to 1 activate it
+                    #if code.split('/')[3][-1] == '1': 
+                    alarm_msg= {
+                        "bn": "appPills-TimeShift",
+                        "on": 1
+                        }
+                    ACTUATOR.put(patID + "/" + devID, deviceURI, "/alarm", json.dumps(alarm_msg), due)
+                    led_msg= {
+                        "bn":"appPills-TimeShift",
+                        'slotID':int(slot[-1]),
+                        'on':1
+                        }
+                    print("TAKE THE PILL NOW!!!")
+                   
+                    ACTUATOR.put(patID + "/" + devID, deviceURI, "/led", json.dumps(led_msg), due)
+                    reminder[code] = due  # insert it in the reminder list 
+                    lock.acquire()
+                    schedule("remind", code, due + delta2)
+                    lock.release()
+                continue
             
-            if len(reminder)>0:
-                '''
-                Inside reminder there are stored all the pills that have to be taken. Every ten min it sends to the user 
-                a reminder to take the pill, after 1 hour the pill is considered as not taken and a message is sent to 
-                thinkspeak. Every 10 sec it checks if the pill is taken so in that case it deletes the element from the list 
-                and turn off the led for that particular slot
-                '''
-                copy_reminder = reminder.copy()
-              
-                #print("REMINDER ACTIVE")
-                for item in copy_reminder:
-                    patID = item.split('/')[0]
-                    devID = item.split('/')[1]
-                    slot = item.split('/')[2]
-                    deviceURI = item.split('+')[1]
-                    if DAILY_LIST.isPillTaken(patID, devID, slot)==True:
-                        reminder.pop(item)
-                        led_msg= {
-                            "bn":"appPills-TimeShift",
-                            'slotID':int(slot[-1]),
-                            'on':0 
-                            }
-                        r1 = requests.put(url =deviceURI+"/led", data = json.dumps(led_msg))
-                    else:
-                        tdelta1 = datetime.strptime(now_time, '%H:%M:%S') - datetime.strptime(reminder[item], '%H:%M:%S')
-                        if tdelta.days < 0: # check if midnight has passed
-                            tdelta = timedelta(
-                                days=0,
-                                seconds=tdelta.seconds,
-                                microseconds=tdelta.microseconds
-                            )
-                        if (tdelta1> delta1):  # if 1 hour has passed consider pill as not taken and send a message to thinkspeak
-                            reminder.pop(item)
-                            #deviceURI=requests.get(catalogURI+patID+"/"+devID)
-                            led_msg= {
-                                "bn":"appPills-TimeShift",
-                                'slotID':int(slot[-1]),
-                                'on':0 
-                                }
-                            # send a put to turn off the led
-                            requests.put(url =deviceURI+"/led", data = json.dumps(led_msg))
-                            topic = patID +"/"+devID+"/timeShift"
-                            timeShift.publish(topic, 2, slot[-1]) # send to thinkspeak that pill is not taken 
-                        # every 10 min check and remind to take the pill
-                        if (tdelta1>delta3 and tdelta1 % delta2 < delta):  #add if tdelta>1min  # time % 10min < 5 sec
-                            topic = patID +"/"+devID+"/timeShift"
-                            timeShift.publish(topic, 1,slot[-1])
-                            print('remind to take the pill')
-                        
-            time.sleep(5)
+            '''
+            Inside reminder there are stored all the pills that have to be taken. Every ten min it sends to the user 
+            a reminder to take the pill, after 1 hour the pill is considered as not taken and a message is sent to 
+            thinkspeak. If the pill was taken in the meantime, it deletes the element from the list 
+            and turn off the led for that particular slot
+            '''
+            elapsed = due - reminder[code]
+            if DAILY_LIST.isPillTaken(patID, devID, slot)==True:
+                reminder.pop(code)
+                led_msg= {
+                    "bn":"appPills-TimeShift",
+                    'slotID':int(slot[-1]),
+                    'on':0 
+                    }
+                ACTUATOR.put(patID + "/" + devID, deviceURI, "/led", json.dumps(led_msg), due)
+            elif elapsed >= delta1:  # if 1 hour has passed consider pill as not taken and send a message to thinkspeak
+                reminder.pop(code)
+                led_msg= {
+                    "bn":"appPills-TimeShift",
+                    'slotID':int(slot[-1]),
+                    'on':0 
+                    }
+                # send a put to turn off the led
+                ACTUATOR.put(patID + "/" + devID, deviceURI, "/led", json.dumps(led_msg), due)
+                topic = patID +"/"+devID+"/timeShift"
+                timeShift.publish(topic, 2, slot[-1]) # send to thinkspeak that pill is not taken 
+            else: # every 10 min remind to take the pill
+                topic = patID +"/"+devID+"/timeShift"
+                timeShift.publish(topic, 1,slot[-1])
+                print('remind to take the pill')
+                lock.acquire()
+                schedule("remind", code, reminder[code] + min(elapsed + delta2, delta1))
+                lock.release()
         
         
     
 if __name__ == "__main__":
 
     DAILY_LIST = ListStat()   
+    if len(sys.argv) > 1: # more instances share the devices: name of this one
+        SERVICE = "timeShift-" + sys.argv[1]
+        SHARDS = ShardRing(SERVICE)
     # read from the conf file the URI of the catalog 
     catalogURI=json.load(open(confFile))["catalogURI"]
     conf = requests.get(catalogURI+"conf").json()
+    presence = conf.get("presence", "http") # "mqtt": the catalog knows we are alive from the presence topic, so no ping is needed
+    if conf.get("actuation", "http") == "mqtt": # the alarms and the leds are switched on and off with a message on the topics of the devices
+        ACTUATOR = CommandPublisher("appPills-TimeShift-cmd" + SERVICE[len("timeShift"):], conf["broker"], conf["port"], conf["baseTopic"], commandAcks)
+    ACTUATOR.start()
+    if presence != "mqtt": # the other instances know about us before we take our devices
+        requests.put(catalogURI+"ping", data=json.dumps({"service": SERVICE}))
     
-    # request to the catalog the schedule from every pair of user-device
-    cat = requests.get(catalogURI+'getSchedules').json()
-    last_update_cat = '00:00:00' 
-    ''' 
-    generate an ID for each time a pill is scheduled: it is going to be
-    patient/device/slot/alarm/rep+deviceURI  and it corresponds to the key, while the time scheduled is 
-    the value. all pairs key-value are stored in a list ordered by the value (so by the time)
-    iterate for all devices
-    '''
-    # save all pairs user-device
-    user = cat.keys()
-    
-    # add every pill scheduled to the list
-    for us in user:
-        temp1 = str(us)
-        temp_pat = temp1.split('/')[0]
-        temp_dev = temp1.split('/')[1]
-        num = requests.get(catalogURI+"getSlotsNumber/"+temp1).json()
-        dev_URI = requests.get(catalogURI+"getDeviceURI/"+temp1).json() 
-        dev_URI = dev_URI["deviceURI"]
-        DAILY_LIST.addDev(temp_pat, temp_dev,num["slots"])
-        for i, slot in enumerate(cat[us]):
-            # add to list only slot that has a schedule
-            if slot: 
-                temp2 = temp1 + '/slot' + str(i)
-                rep = 0 
-                for sch in slot:
-                    # add if alarm is on or off with 1 and 0 
-                    code = temp2 + '/' + str(sch['alarm']) + '/' + str(rep) + '+' + dev_URI
-                    rep = rep + 1
-                    sch_time = str(sch['time'])
-                    MY_SCHED[code]=sch_time
+    # request to the catalog the schedule from every pair of user-device (of this instance)
+    alive = requests.get(catalogURI+"aliveServices").json()
+    lock.acquire()
+    updateShards(alive)
+    lock.release()
+    answer = fetchSchedules(catalogURI, None)
+    lock.acquire()
+    catalogVersion = applySchedules(answer) # Version of the catalog up to which all the modifications were applied: the next reads start from it
+    lock.release()
 
     thread1 = SchedulingThread(1, "thread1", catalogURI)
     thread1.start()
     
     print('--------------')
-    # every 10 sec make a request to the catalog to read the schedule for each patient/device 
+    # the modifications of the devices are published by the catalog and received by TimeShift.notify. When the connection to the broker is (re)established, only the devices modified in the meantime are read again
+    # the catalog is always read without the lock, and only the answer is applied with the lock acquired, so a slow catalog never delays an alarm
+    catchUp = None # Set when the instances changed: the devices that move must be read again, and the alarms due since catchUp rung immediately
     while True:
-        # Ping the catalog every 5 seconds saying that I'm alive 
-        requests.put(catalogURI+"ping", data=json.dumps({"service": "timeShift"}))
-        # save in a variable last update of catalog, check everytime if the time is the same,
-        # if it's not, read catalog again
-        cat_last_update = requests.get(catalogURI+'getLU').json()["LU"]
-        cat_last_update = cat_last_update.split(" ")[4]
-        
-        if cat_last_update!=last_update_cat:
-            print("update catalog")
-            schedul =  requests.get(catalogURI+'getSchedules').json() 
-            lock.acquire()
-            MY_SCHED={}
+        try:
+            # Ping the catalog every 5 seconds saying that I'm alive 
+            if presence != "mqtt":
+                requests.put(catalogURI+"ping", data=json.dumps({"service": SERVICE}), timeout=catalogTimeout)
             
-            user = schedul.keys()
-            for us in user:
-                temp1 = str(us)
-                temp_pat = temp1.split('/')[0]
-                temp_dev = temp1.split('/')[1]
-                dev_URI = requests.get(catalogURI+"getDeviceURI/"+temp1).json() 
-                dev_URI = dev_URI["deviceURI"]
-                num = requests.get(catalogURI+"getSlotsNumber/"+temp1).json()
-                DAILY_LIST.addDev(temp_pat, temp_dev, num["slots"])
-                for i, slot in enumerate(schedul[us]):
-                    # add to list only slots that have a schedule
-                    if slot: 
-                        temp2 = temp1 + '/slot' + str(i)
-                        rep = 0 
-                        for sch in slot:
-                            # add if alarm is on or off with 1 and 0 
-                            code = temp2 + '/' + str(sch['alarm']) + '/' + str(rep) + '+' + dev_URI
-                            rep = rep + 1
-                            sch_time = str(sch['time'])
-                            MY_SCHED[code]=sch_time
-                            
-            last_update_cat = cat_last_update
+            # the instances of TimeShift alive share the devices: when one joins or leaves, the devices that move are read again, and
+            # the alarms that an instance that left did not ring are rung immediately
+            alive = requests.get(catalogURI+"aliveServices", timeout=catalogTimeout).json()
+            lock.acquire()
+            since = updateShards(alive)
             lock.release()
-        
+            if since != None:
+                catchUp = min(catchUp, since) if catchUp != None else since
+            if catchUp != None: # kept until the devices are read, even if the catalog does not answer now
+                answer = fetchSchedules(catalogURI, None)
+                lock.acquire()
+                catalogVersion = applySchedules(answer, catchUp)
+                lock.release()
+                catchUp = None
+            
+            if RESYNC.is_set():
+                RESYNC.clear()
+                print("update catalog")
+                try:
+                    answer = fetchSchedules(catalogURI, catalogVersion) # Only what was modified while we were disconnected. The versions of the events received since do not count: the modifications before them may be lost
+                except requests.exceptions.RequestException:
+                    RESYNC.set() # Try again at the next loop
+                    raise
+                lock.acquire()
+                catalogVersion = applySchedules(answer)
+                lock.release()
+        except requests.exceptions.RequestException as e:
+            print("[",time.ctime(),"] - Catalog not reachable:", e.__class__.__name__)
+
         time.sleep(5)